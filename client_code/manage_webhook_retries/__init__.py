@@ -34,6 +34,8 @@ class manage_webhook_retries(manage_webhook_retriesTemplate):
     # Set event handlers for form controls
     self.dd_filter_by_status.set_event_handler('change', self.dd_filter_by_status_change)
     self.btn_refresh.set_event_handler('click', self.btn_refresh_click)
+    self.btn_run_due_retries.set_event_handler('click', self.btn_run_due_retries_click)
+    self.timer_retry_progress.set_event_handler('tick', self.timer_retry_progress_tick)
 
     # Add Home button navigation if navbar_links is used for that
     if hasattr(self.navbar_links, 'btn_home'): # Example if you add a home button to navbar_links
@@ -42,6 +44,7 @@ class manage_webhook_retries(manage_webhook_retriesTemplate):
 
       # Load initial data
     self.load_webhook_logs()
+    self.refresh_retry_progress() # Show progress if a scheduled run is already going
     log("INFO", self.module_name, "__init__", "Form initialization complete.")
 
   def load_webhook_logs(self, **event_args):
@@ -80,6 +83,50 @@ class manage_webhook_retries(manage_webhook_retriesTemplate):
     """Handles refresh button click."""
     self.load_webhook_logs()
 
+  def btn_run_due_retries_click(self, **event_args):
+    """Starts a reprocessing run for all due retries and begins polling its progress."""
+    log("INFO", self.module_name, "btn_run_due_retries_click", "Starting reprocessing run for due retries.")
+    try:
+      progress = anvil.server.call('start_deferred_webhook_reprocessing')
+      self.show_retry_progress(progress)
+      self.timer_retry_progress.interval = 2
+    except Exception as e:
+      alert(f"Error starting reprocessing run: {e}", title="Error")
+      log("ERROR", self.module_name, "btn_run_due_retries_click", f"Error: {e}")
+
+  def refresh_retry_progress(self):
+    """Fetches the progress of the running reprocessing run, if any, and keeps polling while it runs."""
+    try:
+      progress = anvil.server.call_s('get_deferred_reprocessing_progress')
+    except Exception as e:
+      log("WARNING", self.module_name, "refresh_retry_progress", f"Could not fetch reprocessing progress: {e}")
+      progress = None
+    was_running = self.timer_retry_progress.interval > 0
+    self.show_retry_progress(progress)
+    if progress is None:
+      self.timer_retry_progress.interval = 0
+      if was_running:
+        self.load_webhook_logs() # Run finished; show the updated statuses
+    else:
+      self.timer_retry_progress.interval = 2
+
+  def show_retry_progress(self, progress):
+    """Displays a reprocessing progress dict from the server (or hides the label when idle)."""
+    if not progress:
+      self.lbl_retry_progress.visible = False
+      self.btn_run_due_retries.enabled = True
+      return
+    self.btn_run_due_retries.enabled = False
+    self.lbl_retry_progress.visible = True
+    self.lbl_retry_progress.text = (
+      f"Reprocessing: {progress.get('done', 0)} of {progress.get('total', 0)} done "
+      f"({progress.get('succeeded', 0)} succeeded, {progress.get('failed', 0)} failed, "
+      f"{progress.get('skipped', 0)} skipped) across {progress.get('workers', 0)} worker(s)."
+    )
+
+  def timer_retry_progress_tick(self, **event_args):
+    self.refresh_retry_progress()
+
     # --- Event Handlers from Item Template ---
   def handle_attempt_reprocess_event(self, webhook_log_anvil_id, **event_args):
     """Handles the x_attempt_reprocess event from the item template."""
@@ -19,6 +19,9 @@ class report_transaction_all(report_transaction_allTemplate):
     self.page_size = 15 # Or whatever you prefer as a default
     self.total_transactions = 0
     self.total_pages = 1
+    # Date sorts page with server cursors: page_cursors[i] is the cursor for page i + 1
+    self.page_cursors = [None]
+    self.has_next_page = False
 
     # --- Initialize Filters & Sort ---
     self.dd_status_filter.items = [
@@ -72,6 +75,7 @@ class report_transaction_all(report_transaction_allTemplate):
   def filter_or_sort_changed(self, **event_args):
     """Common handler for when filters or sort order change."""
     self.current_page = 1 # Reset to first page when filters/sort change
+    self.page_cursors = [None]
     self.load_transactions()
 
   def load_transactions(self):
@@ -91,7 +95,8 @@ class report_transaction_all(report_transaction_allTemplate):
     # self.btn_filter.text = 'Loading...' # Or keep as "Apply Filters"
 
     try:
-      # Server function now returns a dict: {'items': [...], 'total_count': X}
+      # Server function returns a dict: {'items': [...], 'total_count': X, 'next_cursor': ...}
+      cursor = self.page_cursors[self.current_page - 1] if self.current_page - 1 < len(self.page_cursors) else None
       response_dict = anvil.server.call(
         'get_all_transactions',
         start_date=start_date,
@@ -99,11 +104,18 @@ class report_transaction_all(report_transaction_allTemplate):
         status_filter=status_filter,
         sort_by=sort_by_value,
         page_number=self.current_page,
-        page_size=self.page_size
+        page_size=self.page_size,
+        cursor=cursor
       )
 
       transactions_list = response_dict.get('items', [])
       self.total_transactions = response_dict.get('total_count', 0)
+      next_cursor = response_dict.get('next_cursor')
+      del self.page_cursors[self.current_page:]
+      if next_cursor:
+        self.page_cursors.append(next_cursor)
+      # Cursor-paged sorts know for certain whether a next page exists; others rely on the count
+      self.has_next_page = bool(next_cursor) if sort_by_value in (None, "billed_at_desc", "billed_at_asc") else None
 
       self.rp_transactions.items = transactions_list
       self.update_pagination_controls()
@@ -112,6 +124,7 @@ class report_transaction_all(report_transaction_allTemplate):
       alert(f"An error occurred while loading transactions: {e}")
       self.rp_transactions.items = [] 
       self.total_transactions = 0
+      self.has_next_page = False
       self.update_pagination_controls() # Still update to show "Page 0 of 0" or similar
     finally:
       self.btn_filter.enabled = True
@@ -120,16 +133,22 @@ class report_transaction_all(report_transaction_allTemplate):
 
   def update_pagination_controls(self):
     """Updates the pagination buttons and label based on current state."""
-    if self.total_transactions == 0:
+    # The total is a cached count and may lag new transactions, so emptiness comes from the
+    # page itself. current_page is left alone; it indexes page_cursors on the next load.
+    if not self.rp_transactions.items:
       self.total_pages = 0
-      self.current_page = 0 # Or 1 if you prefer to show "Page 1 of 0"
+      self.lbl_page_info.text = "Page 0 of 0"
     else:
       self.total_pages = (self.total_transactions + self.page_size - 1) // self.page_size # Ceiling division
-
-    self.lbl_page_info.text = f"Page {self.current_page} of {self.total_pages}"
+      # Never show fewer pages than we have reached or can reach
+      self.total_pages = max(self.total_pages, self.current_page + 1 if self.has_next_page else self.current_page)
+      self.lbl_page_info.text = f"Page {self.current_page} of {self.total_pages}"
 
     self.btn_previous_page.enabled = (self.current_page > 1)
-    self.btn_next_page.enabled = (self.current_page < self.total_pages)
+    if self.has_next_page is None:
+      self.btn_next_page.enabled = (self.current_page < self.total_pages)
+    else:
+      self.btn_next_page.enabled = self.has_next_page
 
     # Hide pagination controls if only one page or no results
     self.btn_previous_page.visible = (self.total_pages > 1)
@@ -145,6 +164,6 @@ class report_transaction_all(report_transaction_allTemplate):
 
   def btn_next_page_click(self, **event_args):
     """Handles click for the Next Page button."""
-    if self.current_page < self.total_pages:
+    if self.btn_next_page.enabled:
       self.current_page += 1
       self.load_transactions()
\ No newline at end of file
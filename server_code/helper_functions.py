@@ -12,7 +12,7 @@ import anvil.server
 import csv
 import io
 import datetime as datetime
-from sm_logs_mod import log
+from sm_logs_mod import log, refresh_log_settings
 import anvil.media
 from anvil import server  # ✅ Required import
 import traceback # <<< --- ADD THIS IMPORT
@@ -79,6 +79,7 @@ def update_setting(row_id, new_value, is_boolean, bool_value):
                 row.update(value_number=float(new_value), value_text=None)
             else:
                 row.update(value_text=new_value, value_number=None)
+        refresh_log_settings() # In case log_level or DEBUG_MODE was the setting changed
         return "Setting updated successfully!"
     return "Setting not found."
 
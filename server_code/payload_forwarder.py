@@ -4,25 +4,255 @@ import anvil.http
 import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables # Needed for checking event existence
-from sm_logs_mod import log
+import gzip
+import json
+import random
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from sm_logs_mod import log, buffered_logging
 # --- Function to Forward Payload to Hub ---
 # --- MODIFIED: Import vault and logging ---
-from .vault_server import get_secret_for_server_use
+from .vault_server import get_secrets_for_server_use
 from .sessions_server import is_admin_user # Ensure this is imported
 
+try:
+  import zstandard # Optional: only needed when the Hub is configured for zstd
+except ImportError:
+  zstandard = None
+
 # --- END MODIFICATION ---
 
 # --- Constants for R2Hub (ensure these are defined if not already) ---
 R2HUB_API_ENDPOINT_VAULT_KEY = "r2hub_api_endpoint"
 R2HUB_TENANT_ID_VAULT_KEY = "r2hub_tenant_id"
 R2HUB_API_KEY_VAULT_KEY = "r2hub_api_key"
+# Optional: "gzip" or "zstd" to compress forwarded bodies; unset sends them uncompressed
+R2HUB_CONTENT_ENCODING_VAULT_KEY = "r2hub_content_encoding"
+HUB_COMPRESSION_MIN_BYTES = 1024 # Smaller bodies are sent as-is; compression wouldn't pay off
+
+
+def _get_hub_credentials():
+  """Returns (hub_url_base, tenant_id_for_hub, tenant_api_key) from the MyBizz Vault in one lookup."""
+  secrets = get_secrets_for_server_use([R2HUB_API_ENDPOINT_VAULT_KEY, R2HUB_TENANT_ID_VAULT_KEY, R2HUB_API_KEY_VAULT_KEY])
+  return (secrets.get(R2HUB_API_ENDPOINT_VAULT_KEY),
+          secrets.get(R2HUB_TENANT_ID_VAULT_KEY),
+          secrets.get(R2HUB_API_KEY_VAULT_KEY))
+
+
+# --- R2Hub Circuit Breaker ---
+# Shared by every server process through the hub_circuit_breaker table. After
+# HUB_BREAKER_FAILURE_THRESHOLD consecutive outage-type failures (timeouts, connection
+# errors, 5xx) the circuit opens and Hub calls fail fast. Once the open period expires,
+# one caller is let through as a half-open probe: success closes the circuit, failure
+# re-opens it for twice as long (up to HUB_BREAKER_MAX_OPEN_SECONDS).
+HUB_REQUEST_TIMEOUT_SECONDS = 30 # Timeout for every Hub request
+HUB_BREAKER_NAME = "r2hub"
+HUB_BREAKER_FAILURE_THRESHOLD = 5
+HUB_BREAKER_BASE_OPEN_SECONDS = 60
+HUB_BREAKER_MAX_OPEN_SECONDS = 1800
+HUB_BREAKER_PROBE_TIMEOUT_SECONDS = 60 # A half-open probe older than this is assumed lost
+HUB_CIRCUIT_OPEN_MESSAGE = "R2Hub circuit open; forwarding deferred."
+
+class HubCircuitOpenError(Exception):
+  """Raised instead of calling the Hub while the circuit breaker is open."""
+  pass
+
+def _get_hub_breaker_row():
+  """
+    Returns the breaker state row, creating it (closed) on first use. The create runs in its
+    own transaction so concurrent first calls cannot add duplicate rows; callers that re-read
+    the row inside a transaction have always fetched it once beforehand, so the row exists.
+    """
+  row = app_tables.hub_circuit_breaker.get(name=HUB_BREAKER_NAME)
+  if row:
+    return row
+  with anvil.server.Transaction():
+    row = app_tables.hub_circuit_breaker.get(name=HUB_BREAKER_NAME)
+    if not row:
+      row = app_tables.hub_circuit_breaker.add_row(
+        name=HUB_BREAKER_NAME, state='Closed', consecutive_failures=0, updated_at=datetime.now(timezone.utc)
+      )
+  return row
+
+def _probe_is_stale(row, now):
+  probe_started_at = row['probe_started_at']
+  return not probe_started_at or (now - probe_started_at).total_seconds() > HUB_BREAKER_PROBE_TIMEOUT_SECONDS
+
+def is_hub_circuit_open():
+  """Read-only check: True while Hub calls would be refused (open and not yet due for a probe)."""
+  row = _get_hub_breaker_row()
+  now = datetime.now(timezone.utc)
+  if row['state'] == 'Open':
+    return not row['next_probe_at'] or now < row['next_probe_at']
+  if row['state'] == 'Half-Open':
+    return not _probe_is_stale(row, now)
+  return False
+
+def _acquire_hub_call_permit():
+  """Returns True if a Hub call may proceed. Claims the half-open probe slot when one is due."""
+  row = _get_hub_breaker_row()
+  if row['state'] == 'Closed':
+    return True
+  now = datetime.now(timezone.utc)
+  with anvil.server.Transaction():
+    row = _get_hub_breaker_row()
+    due_for_probe = (
+      (row['state'] == 'Open' and row['next_probe_at'] and now >= row['next_probe_at']) or
+      (row['state'] == 'Half-Open' and _probe_is_stale(row, now))
+    )
+    if row['state'] == 'Closed':
+      return True
+    if not due_for_probe:
+      return False
+    row.update(state='Half-Open', probe_started_at=now, updated_at=now)
+  log("INFO", "payload_forwarder", "_acquire_hub_call_permit", "R2Hub circuit half-open; sending probe request.")
+  return True
+
+def _record_hub_call_result(success, error_msg=None):
+  """Updates the breaker after a Hub call. success means the Hub answered (even with a 4xx)."""
+  row = _get_hub_breaker_row()
+  if success and row['state'] == 'Closed' and not row['consecutive_failures']:
+    return # Nothing to change on the common path
+  now = datetime.now(timezone.utc)
+  with anvil.server.Transaction():
+    row = _get_hub_breaker_row()
+    previous_state = row['state']
+    if success:
+      row.update(state='Closed', consecutive_failures=0, open_seconds=None, next_probe_at=None,
+                 probe_started_at=None, updated_at=now)
+    else:
+      failures = (row['consecutive_failures'] or 0) + 1
+      open_seconds = None
+      if previous_state == 'Half-Open':
+        open_seconds = min((row['open_seconds'] or HUB_BREAKER_BASE_OPEN_SECONDS) * 2, HUB_BREAKER_MAX_OPEN_SECONDS)
+      elif previous_state == 'Closed' and failures >= HUB_BREAKER_FAILURE_THRESHOLD:
+        open_seconds = HUB_BREAKER_BASE_OPEN_SECONDS
+      if open_seconds:
+        # Jitter keeps workers from probing in lockstep
+        next_probe_at = now + timedelta(seconds=open_seconds * random.uniform(1.0, 1.1))
+        row.update(state='Open', consecutive_failures=failures, open_seconds=open_seconds, opened_at=now,
+                   next_probe_at=next_probe_at, probe_started_at=None, last_error=(error_msg or "")[:900], updated_at=now)
+      else:
+        row.update(consecutive_failures=failures, last_error=(error_msg or "")[:900], updated_at=now)
+    new_state = row['state']
+  if new_state != previous_state:
+    level = "INFO" if new_state == 'Closed' else "WARNING"
+    log(level, "payload_forwarder", "_record_hub_call_result", f"R2Hub circuit {previous_state} -> {new_state}.",
+        {"consecutive_failures": row['consecutive_failures'], "open_seconds": row['open_seconds'], "error": error_msg})
+
+def _is_hub_outage_status(status):
+  """Statuses that mean the Hub is unavailable, as opposed to rejecting this particular request."""
+  return status is None or status >= 500 or status in (408, 429)
+
+def _hub_request(**request_kwargs):
+  """anvil.http.request wrapped in the circuit breaker. Raises HubCircuitOpenError while open."""
+  if not _acquire_hub_call_permit():
+    raise HubCircuitOpenError(HUB_CIRCUIT_OPEN_MESSAGE)
+  try:
+    response = anvil.http.request(**request_kwargs)
+  except anvil.http.HttpError as e:
+    _record_hub_call_result(not _is_hub_outage_status(e.status), f"HTTP Error: Status {e.status}")
+    raise
+  except Exception as e:
+    _record_hub_call_result(False, str(e))
+    raise
+  _record_hub_call_result(True)
+  return response
+
+
+# --- Compressed POSTs and Forward Metrics ---
+def _get_hub_content_encoding():
+  """Returns the configured request-body encoding for the Hub ('gzip', 'zstd' or 'identity')."""
+  secrets = get_secrets_for_server_use([R2HUB_CONTENT_ENCODING_VAULT_KEY], optional_keys=(R2HUB_CONTENT_ENCODING_VAULT_KEY,))
+  return (secrets.get(R2HUB_CONTENT_ENCODING_VAULT_KEY) or 'identity').strip().lower()
+
+def _encode_hub_body(body_string, content_encoding):
+  """Compresses a request body. Returns (data, encoding actually used)."""
+  body_bytes = body_string.encode('utf-8')
+  if len(body_bytes) < HUB_COMPRESSION_MIN_BYTES:
+    return body_string, 'identity'
+  if content_encoding == 'zstd':
+    if zstandard is not None:
+      return zstandard.ZstdCompressor().compress(body_bytes), 'zstd'
+    log("WARNING", "payload_forwarder", "_encode_hub_body", "zstd configured for R2Hub but the zstandard package is not installed; using gzip.")
+    content_encoding = 'gzip'
+  if content_encoding == 'gzip':
+    return gzip.compress(body_bytes), 'gzip'
+  return body_string, 'identity'
+
+def _record_forward_metric(event_count, raw_bytes, sent_bytes, content_encoding, latency_ms, hub_status, success):
+  """Stores size/latency for one POST to the Hub. Never raises."""
+  try:
+    app_tables.hub_forward_metrics.add_row(
+      sent_at=datetime.now(timezone.utc),
+      event_count=event_count,
+      raw_bytes=raw_bytes,
+      sent_bytes=sent_bytes,
+      content_encoding=content_encoding,
+      latency_ms=latency_ms,
+      hub_status=hub_status,
+      success=success
+    )
+  except Exception as e:
+    print(f"Warning: Could not record hub forward metric: {e}")
+
+def _post_to_hub(url, headers, body_string, event_count, content_encoding):
+  """
+    POSTs a body to the Hub through the circuit breaker, compressed per content_encoding,
+    and records its size and latency. Returns the response; raises like _hub_request.
+    """
+  data, encoding_used = _encode_hub_body(body_string, content_encoding)
+  if encoding_used != 'identity':
+    headers = {**headers, 'Content-Encoding': encoding_used}
+  raw_bytes = len(body_string.encode('utf-8'))
+  sent_bytes = len(data) if isinstance(data, bytes) else raw_bytes
+  started = time.monotonic()
+  hub_status = None
+  try:
+    response = _hub_request(url=url, method='POST', headers=headers, data=data, timeout=HUB_REQUEST_TIMEOUT_SECONDS)
+    hub_status = response.get_status()
+    return response
+  except anvil.http.HttpError as e:
+    hub_status = e.status
+    raise
+  except HubCircuitOpenError:
+    started = None # Nothing was sent
+    raise
+  finally:
+    if started is not None:
+      _record_forward_metric(event_count, raw_bytes, sent_bytes, encoding_used, int((time.monotonic() - started) * 1000),
+                             hub_status, hub_status is not None and 200 <= hub_status < 300)
+
+@anvil.server.callable
+def get_hub_forward_metrics_summary(hours=24):
+  """Totals for Hub forwards over the last `hours`: requests, events, bytes before/after compression, latency. Admin only."""
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Administrator privileges required.")
+  since = datetime.now(timezone.utc) - timedelta(hours=hours)
+  rows = app_tables.hub_forward_metrics.search(sent_at=q.greater_than_or_equal_to(since))
+  summary = {"requests": 0, "events": 0, "raw_bytes": 0, "sent_bytes": 0, "failed_requests": 0, "total_latency_ms": 0}
+  for row in rows:
+    summary["requests"] += 1
+    summary["events"] += row['event_count'] or 0
+    summary["raw_bytes"] += row['raw_bytes'] or 0
+    summary["sent_bytes"] += row['sent_bytes'] or 0
+    summary["total_latency_ms"] += row['latency_ms'] or 0
+    if not row['success']:
+      summary["failed_requests"] += 1
+  summary["avg_latency_ms"] = summary["total_latency_ms"] / summary["requests"] if summary["requests"] else None
+  summary["bytes_saved"] = summary["raw_bytes"] - summary["sent_bytes"]
+  summary["compression_ratio"] = summary["sent_bytes"] / summary["raw_bytes"] if summary["raw_bytes"] else None
+  return summary
 
 
 # --- Function to Forward Payload to Hub ---
-def forward_payload_to_hub(raw_payload_string, event_id): # event_id is passed from webhook_handler
+def forward_payload_to_hub(raw_payload_string, event_id, credentials=None, content_encoding=None): # event_id is passed from webhook_handler
   """
     Forwards the raw webhook payload to the Central R2 Hub.
-    Sends Tenant ID and API Key headers for authentication, retrieved from MyBizz Vault.
+    Sends Tenant ID and API Key headers for authentication, retrieved from MyBizz Vault
+    unless already-fetched credentials (as returned by _get_hub_credentials) are passed in.
+    The body is compressed if the vault configures a content encoding for the Hub.
     Uses sm_logs_mod for logging.
     """
   module_name = "payload_forwarder" # For logging
@@ -32,9 +262,7 @@ def forward_payload_to_hub(raw_payload_string, event_id): # event_id is passed f
   log("INFO", module_name, function_name, "Attempting to forward payload to Hub.", log_context)
   try:
     # 1. Retrieve Hub URL, Tenant API Key, and Tenant ID from MyBizz Vault
-    hub_url_base = get_secret_for_server_use(R2HUB_API_ENDPOINT_VAULT_KEY)
-    tenant_id_for_hub = get_secret_for_server_use(R2HUB_TENANT_ID_VAULT_KEY)
-    tenant_api_key = get_secret_for_server_use(R2HUB_API_KEY_VAULT_KEY)
+    hub_url_base, tenant_id_for_hub, tenant_api_key = credentials or _get_hub_credentials()
 
     log_context['hub_url_retrieved'] = bool(hub_url_base)
     log_context['tenant_id_for_hub_retrieved'] = bool(tenant_id_for_hub)
@@ -46,9 +274,9 @@ def forward_payload_to_hub(raw_payload_string, event_id): # event_id is passed f
       log("ERROR", module_name, function_name, error_msg, log_context)
       return False, error_msg
 
-      # Endpoint path is defined in R2Hub's hub_receiver.py
-      # Assuming hub_url_base is the full endpoint URL including /_/api/log_payload
-      hub_log_url = hub_url_base
+    # Endpoint path is defined in R2Hub's hub_receiver.py
+    # Assuming hub_url_base is the full endpoint URL including /_/api/log_payload
+    hub_log_url = hub_url_base
     log("DEBUG", module_name, function_name, f"Using Hub Log URL: {hub_log_url}", log_context)
 
     # 2. Prepare Request Headers
@@ -61,13 +289,9 @@ def forward_payload_to_hub(raw_payload_string, event_id): # event_id is passed f
 
     # 3. Make HTTP POST Request to Hub
     log("DEBUG", module_name, function_name, f"Sending POST to {hub_log_url}", log_context)
-    response = anvil.http.request(
-      url=hub_log_url,
-      method='POST',
-      headers=headers,
-      data=raw_payload_string, # Send raw string as received
-      timeout=30
-    )
+    if content_encoding is None:
+      content_encoding = _get_hub_content_encoding()
+    response = _post_to_hub(hub_log_url, headers, raw_payload_string, 1, content_encoding) # Raw string as received, possibly compressed
     log_context['hub_response_status'] = response.get_status()
 
     # 4. Handle Hub Response
@@ -91,8 +315,10 @@ def forward_payload_to_hub(raw_payload_string, event_id): # event_id is passed f
     error_msg = f"HTTP Error during forwarding: Status {e.status}."
     log("ERROR", module_name, function_name, error_msg, log_context)
     return False, error_msg
+  except HubCircuitOpenError:
+    log("WARNING", module_name, function_name, HUB_CIRCUIT_OPEN_MESSAGE, log_context)
+    return False, HUB_CIRCUIT_OPEN_MESSAGE
   except Exception as e:
-    import traceback
     log_context['exception_type'] = type(e).__name__
     log_context['trace'] = traceback.format_exc()
     error_msg = f"Unexpected error during forwarding: {str(e)}"
@@ -100,6 +326,11 @@ def forward_payload_to_hub(raw_payload_string, event_id): # event_id is passed f
     return False, error_msg
 
 
+def _hub_api_url(hub_url_base, endpoint_path):
+  """Joins the Hub base URL and an API path with exactly one slash between them."""
+  return f"{hub_url_base.rstrip('/')}/{endpoint_path.lstrip('/')}"
+
+
 # --- Function to Request Payload from Hub ---
 @anvil.server.callable # Removed require_user=True, check is now explicit
 def request_payload_from_hub(event_id):
@@ -120,7 +351,7 @@ def request_payload_from_hub(event_id):
     log("WARNING", module_name, function_name, "Permission denied to request payload from hub.", log_context)
     raise anvil.server.PermissionDenied("Administrator privileges required to retrieve raw payloads.")
 
-    log("INFO", module_name, function_name, "Requesting payload from Hub (permission granted).", log_context)
+  log("INFO", module_name, function_name, "Requesting payload from Hub (permission granted).", log_context)
 
   # Optional: Check if event_id exists in local log first, as per original code
   # log_entry = tables.app_tables.webhook_log.get(event_id=event_id)
@@ -131,9 +362,7 @@ def request_payload_from_hub(event_id):
 
   try:
     # 1. Retrieve Hub URL, Tenant API Key, and Tenant ID from MyBizz Vault
-    hub_url_base = get_secret_for_server_use(R2HUB_API_ENDPOINT_VAULT_KEY)
-    tenant_id_for_hub = get_secret_for_server_use(R2HUB_TENANT_ID_VAULT_KEY)
-    tenant_api_key = get_secret_for_server_use(R2HUB_API_KEY_VAULT_KEY)
+    hub_url_base, tenant_id_for_hub, tenant_api_key = _get_hub_credentials()
 
     log_context['hub_url_base_retrieved'] = bool(hub_url_base)
     log_context['tenant_id_for_hub_retrieved'] = bool(tenant_id_for_hub)
@@ -145,17 +374,9 @@ def request_payload_from_hub(event_id):
       # Raise a more specific error that client can potentially handle or just a generic one
       raise Exception("Server configuration error: Hub connection details missing.")
 
-      # Construct the specific endpoint URL for retrieval (from R2Hub's hub_receiver.py)
-      get_endpoint_path = f'/_/api/get_payload/{event_id}'
-    # Ensure hub_url_base doesn't have trailing slash if get_endpoint_path starts with one
-    if hub_url_base.endswith('/') and get_endpoint_path.startswith('/'):
-      hub_get_url = f"{hub_url_base.rstrip('/')}{get_endpoint_path}"
-    elif not hub_url_base.endswith('/') and not get_endpoint_path.startswith('/'):
-      hub_get_url = f"{hub_url_base}/{get_endpoint_path}"
-    else:
-      hub_get_url = f"{hub_url_base}{get_endpoint_path}"
-
-      log("DEBUG", module_name, function_name, f"Using Hub Get URL: {hub_get_url}", log_context)
+    # Construct the specific endpoint URL for retrieval (from R2Hub's hub_receiver.py)
+    hub_get_url = _hub_api_url(hub_url_base, f'/_/api/get_payload/{event_id}')
+    log("DEBUG", module_name, function_name, f"Using Hub Get URL: {hub_get_url}", log_context)
 
     # 2. Prepare Request Headers
     headers = {
@@ -166,11 +387,11 @@ def request_payload_from_hub(event_id):
 
     # 3. Make HTTP GET Request to Hub
     log("DEBUG", module_name, function_name, f"Sending GET to {hub_get_url}", log_context)
-    response = anvil.http.request(
+    response = _hub_request(
       url=hub_get_url,
       method='GET',
       headers=headers,
-      timeout=30
+      timeout=HUB_REQUEST_TIMEOUT_SECONDS
     )
     log_context['hub_response_status_for_get'] = response.get_status()
 
@@ -193,6 +414,9 @@ def request_payload_from_hub(event_id):
     log_context['http_error_content'] = error_body
     log("ERROR", module_name, function_name, f"Hub returned HTTP error: Status {e.status}", log_context)
     raise e # Re-raise to be caught by client if needed
+  except HubCircuitOpenError:
+    log("WARNING", module_name, function_name, "R2Hub circuit open; payload request not sent.", log_context)
+    raise Exception("R2Hub is currently unavailable. Please try again later.")
   except anvil.server.NoServerFunctionError as e: # If local log check (if reinstated) fails
     log("WARNING", module_name, function_name, str(e), log_context)
     raise e
@@ -200,7 +424,6 @@ def request_payload_from_hub(event_id):
     # Already logged, just re-raise
     raise e
   except Exception as e:
-    import traceback
     log_context['exception_type'] = type(e).__name__
     log_context['trace'] = traceback.format_exc()
     error_msg = f"Unexpected error retrieving payload: {str(e)}"
@@ -208,7 +431,10 @@ def request_payload_from_hub(event_id):
     # Raise a generic exception or a specific one if the client needs to distinguish
     raise Exception(f"An unexpected error occurred while retrieving payload for {event_id}.")
 
+# Kept so forwarding tasks launched before the outbox existed can still finish.
+# New payloads are queued with enqueue_payload_for_hub and delivered by drain_hub_outbox.
 @anvil.server.background_task
+@buffered_logging
 def forward_payload_to_hub_background(log_row_id, raw_payload_string):
   module_name = "payload_forwarder_task" 
   function_name = "forward_payload_to_hub_background"
@@ -265,4 +491,343 @@ def forward_payload_to_hub_background(log_row_id, raw_payload_string):
             log_row_to_update_on_error['processing_details'] = f"{current_details_on_error}{separator_on_error}{error_details[:900]}" 
             log_row_to_update_on_error['forwarded_to_hub'] = False
       except Exception as db_update_err:
-        log("CRITICAL", module_name, function_name, f"Failed to update log_row with background task error: {db_update_err}", log_context)
\ No newline at end of file
+        log("CRITICAL", module_name, function_name, f"Failed to update log_row with background task error: {db_update_err}", log_context)
+
+
+# --- Bulk Payload Fetch from Hub ---
+# Used by the retry workers (server-side only, no user check). One POST to
+# /_/api/get_payloads per HUB_PAYLOAD_FETCH_CHUNK event ids. The Hub may answer with a JSON
+# object {"payloads": {event_id: payload}} or stream newline-delimited JSON records
+# {"event_id": ..., "payload": ...}. If the Hub has no bulk endpoint, falls back to one
+# GET per event id with the same credentials.
+HUB_PAYLOAD_FETCH_CHUNK = 50
+
+def _parse_bulk_payload_response(body_text):
+  """Parses either response shape of the bulk endpoint into {event_id: payload_string}."""
+  body_text = body_text.strip()
+  if not body_text:
+    return {}
+  try:
+    parsed = json.loads(body_text) # A single JSON document, even if pretty-printed over several lines
+  except ValueError:
+    records = [json.loads(line) for line in body_text.splitlines() if line.strip()]
+  else:
+    if isinstance(parsed, dict) and 'payloads' in parsed:
+      return {event_id: payload for event_id, payload in (parsed['payloads'] or {}).items() if payload is not None}
+    records = parsed if isinstance(parsed, list) else [parsed]
+  return {record['event_id']: record['payload'] for record in records if record.get('event_id') and record.get('payload') is not None}
+
+def _fetch_payloads_individually(hub_url_base, headers, event_ids, log_context, request_fn=_hub_request):
+  payloads = {}
+  for event_id in event_ids:
+    try:
+      response = request_fn(url=_hub_api_url(hub_url_base, f'/_/api/get_payload/{event_id}'), method='GET', headers=headers, timeout=HUB_REQUEST_TIMEOUT_SECONDS)
+      payloads[event_id] = response.get_bytes().decode('utf-8')
+    except anvil.http.HttpError as e:
+      log("WARNING", "payload_forwarder", "_fetch_payloads_individually", f"Hub returned HTTP error: Status {e.status}", {**log_context, "event_id": event_id})
+    except HubCircuitOpenError:
+      break
+  return payloads
+
+def request_payloads_from_hub(event_ids, hub_url_base=None, credentials=None, request_fn=_hub_request):
+  """
+    Fetches raw payloads for many event ids from the Central R2 Hub.
+    Returns {event_id: payload_string}; ids the Hub could not supply are simply absent.
+    hub_url_base/credentials override the vault settings and request_fn replaces the
+    circuit-breaker-wrapped HTTP call (both used by test_bulk_payload_fetch).
+    """
+  module_name = "payload_forwarder"
+  function_name = "request_payloads_from_hub"
+  event_ids = list(dict.fromkeys(e for e in event_ids if e)) # De-duplicate, keep order
+  log_context = {"requested_count": len(event_ids)}
+  if not event_ids:
+    return {}
+
+  vault_url, tenant_id_for_hub, tenant_api_key = credentials or _get_hub_credentials()
+  hub_url_base = hub_url_base or vault_url
+  if not all([hub_url_base, tenant_api_key, tenant_id_for_hub]):
+    log("ERROR", module_name, function_name, "R2Hub retrieval configuration missing in MyBizz Vault.", log_context)
+    return {}
+  headers = {
+    'Authorization': f'Bearer {tenant_api_key}',
+    'X-Tenant-ID': tenant_id_for_hub
+  }
+
+  payloads = {}
+  for start in range(0, len(event_ids), HUB_PAYLOAD_FETCH_CHUNK):
+    chunk = event_ids[start:start + HUB_PAYLOAD_FETCH_CHUNK]
+    try:
+      response = request_fn(
+        url=_hub_api_url(hub_url_base, '/_/api/get_payloads'),
+        method='POST',
+        headers={**headers, 'Content-Type': 'application/json'},
+        data=json.dumps({"event_ids": chunk}),
+        timeout=HUB_REQUEST_TIMEOUT_SECONDS
+      )
+      payloads.update(_parse_bulk_payload_response(response.get_bytes().decode('utf-8')))
+    except anvil.http.HttpError as e:
+      if e.status in (404, 405, 501):
+        log("WARNING", module_name, function_name, f"Hub bulk payload endpoint unavailable (Status {e.status}); fetching individually.", log_context)
+        payloads.update(_fetch_payloads_individually(hub_url_base, headers, event_ids[start:], log_context, request_fn))
+        break
+      log("ERROR", module_name, function_name, f"Hub returned HTTP error: Status {e.status}", {**log_context, "chunk_size": len(chunk)})
+    except HubCircuitOpenError:
+      log("WARNING", module_name, function_name, "R2Hub circuit open; remaining payloads not requested.", log_context)
+      break
+    except Exception as e:
+      log("ERROR", module_name, function_name, f"Unexpected error fetching payloads: {str(e)}", {**log_context, "trace": traceback.format_exc()})
+
+  log("INFO", module_name, function_name, f"Retrieved {len(payloads)} of {len(event_ids)} payloads from Hub.", log_context)
+  return payloads
+
+
+# --- Test Function: bulk fetch against a stand-in Hub ---
+# An in-process stand-in plays the Hub, so the test needs no public endpoint and its
+# requests never reach the shared R2Hub circuit breaker. It answers /_/api/get_payloads
+# for ids starting with BULK_FETCH_TEST_PREFIX, as NDJSON or as one pretty-printed JSON object.
+BULK_FETCH_TEST_PREFIX = "evt_bulkfetchtest_"
+
+def _stand_in_payload(event_id):
+  return json.dumps({"event_id": event_id, "event_type": "test.bulk_fetch", "data": {"id": event_id}})
+
+class _StandInHubResponse:
+  def __init__(self, body_text):
+    self._body = body_text.encode('utf-8')
+
+  def get_bytes(self):
+    return self._body
+
+  def get_status(self):
+    return 200
+
+def _stand_in_hub_request(response_shape, request_log):
+  """Returns a request_fn for request_payloads_from_hub that answers like the Hub would."""
+  def stand_in_request(url, method, headers, data=None, timeout=None):
+    request_log.append(url)
+    event_ids = [e for e in json.loads(data).get('event_ids', []) if str(e).startswith(BULK_FETCH_TEST_PREFIX)]
+    if response_shape == 'json':
+      return _StandInHubResponse(json.dumps({"payloads": {e: _stand_in_payload(e) for e in event_ids}}, indent=2))
+    return _StandInHubResponse("\n".join(json.dumps({"event_id": e, "payload": _stand_in_payload(e)}) for e in event_ids))
+  return stand_in_request
+
+@anvil.server.callable
+def test_bulk_payload_fetch(event_count=120):
+  """
+    Runs request_payloads_from_hub against the stand-in Hub for both response shapes and
+    checks that every payload comes back intact, in ceil(event_count / HUB_PAYLOAD_FETCH_CHUNK) requests.
+    """
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Administrator privileges required.")
+  event_ids = [f"{BULK_FETCH_TEST_PREFIX}{i:05d}" for i in range(event_count)]
+  stand_in_base = "https://stand-in-hub.invalid"
+  results = {}
+  for response_shape in ('ndjson', 'json'):
+    request_log = []
+    started = time.monotonic()
+    payloads = request_payloads_from_hub(event_ids, hub_url_base=stand_in_base, credentials=(stand_in_base, "test-tenant", "test-key"),
+                                         request_fn=_stand_in_hub_request(response_shape, request_log))
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    mismatched = [e for e in event_ids if payloads.get(e) != _stand_in_payload(e)]
+    results[response_shape] = {
+      "requested": len(event_ids),
+      "returned": len(payloads),
+      "mismatched": len(mismatched),
+      "requests": len(request_log),
+      "expected_requests": -(-len(event_ids) // HUB_PAYLOAD_FETCH_CHUNK),
+      "elapsed_ms": elapsed_ms
+    }
+  return results
+
+
+# --- R2Hub Outbox ---
+# Processed webhooks are queued in hub_outbox instead of each launching its own
+# forwarding task. A single drain_hub_outbox task delivers them in batches: one POST
+# per batch to the optional r2hub_batch_endpoint, or one POST per event (reusing the
+# same credentials) when no batch endpoint is configured or the Hub rejects batches.
+R2HUB_BATCH_ENDPOINT_VAULT_KEY = "r2hub_batch_endpoint"
+HUB_OUTBOX_BATCH_SIZE = 25
+HUB_OUTBOX_MAX_ATTEMPTS = 5
+HUB_OUTBOX_RETRY_BASE_SECONDS = 60 # Wait before retry n is base * 2**(n-1), plus jitter
+HUB_OUTBOX_RETRY_MAX_SECONDS = 3600
+# 'Sending' rows older than this are assumed abandoned. A batch can take one batch POST plus
+# one POST per event, each up to HUB_REQUEST_TIMEOUT_SECONDS; allow twice that.
+HUB_OUTBOX_STALE_CLAIM_MINUTES = 2 * (HUB_OUTBOX_BATCH_SIZE + 1) * HUB_REQUEST_TIMEOUT_SECONDS // 60 + 1
+
+def enqueue_payload_for_hub(log_row, raw_payload_string):
+  """Adds a processed webhook to the Hub outbox. Call inside the caller's transaction."""
+  return app_tables.hub_outbox.add_row(
+    webhook_log=log_row,
+    event_id=log_row['event_id'],
+    raw_payload=raw_payload_string,
+    status='Pending',
+    attempts=0,
+    enqueued_at=datetime.now(timezone.utc)
+  )
+
+def ensure_hub_outbox_drain(log_context=None):
+  """Launches drain_hub_outbox unless one is already running."""
+  try:
+    for task in anvil.server.list_background_tasks():
+      if task.get_task_name() == 'drain_hub_outbox' and task.is_running():
+        return
+    anvil.server.launch_background_task('drain_hub_outbox')
+  except Exception as e:
+    # The scheduled run of drain_hub_outbox will still deliver the entry
+    log("ERROR", "payload_forwarder", "ensure_hub_outbox_drain", "Failed to launch Hub outbox drain task.", {**(log_context or {}), "error": str(e)})
+
+def _outbox_retry_at(attempts, now):
+  """When a row that has failed `attempts` times becomes due again."""
+  delay = min(HUB_OUTBOX_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0)), HUB_OUTBOX_RETRY_MAX_SECONDS)
+  return now + timedelta(seconds=delay * random.uniform(1.0, 1.1))
+
+def _claim_outbox_batch():
+  """Moves the oldest due outbox rows to 'Sending' in one transaction and returns them."""
+  now = datetime.now(timezone.utc)
+  stale_cutoff = now - timedelta(minutes=HUB_OUTBOX_STALE_CLAIM_MINUTES)
+  with anvil.server.Transaction():
+    candidates = app_tables.hub_outbox.search(
+      tables.order_by('enqueued_at'),
+      q.any_of(
+        q.all_of(status='Sending', last_attempt_at=q.less_than(stale_cutoff)),
+        q.all_of(status='Pending', next_attempt_at=q.any_of(None, q.less_than_or_equal_to(now)))
+      )
+    )
+    batch = []
+    for row in candidates:
+      row.update(status='Sending', attempts=(row['attempts'] or 0) + 1, last_attempt_at=now)
+      batch.append(row)
+      if len(batch) >= HUB_OUTBOX_BATCH_SIZE:
+        break
+    return batch
+
+def _post_batch_to_hub(batch_url, credentials, entries, content_encoding, log_context):
+  """
+    Sends several payloads to the Hub batch endpoint in one request.
+    Returns {event_id: (success, message)}, or None if the Hub does not accept batches.
+    """
+  _, tenant_id_for_hub, tenant_api_key = credentials
+  body = json.dumps({"payloads": [{"event_id": e['event_id'], "payload": e['raw_payload']} for e in entries]})
+  try:
+    headers = {
+      'Content-Type': 'application/json',
+      'Authorization': f'Bearer {tenant_api_key}',
+      'X-Tenant-ID': tenant_id_for_hub
+    }
+    response = _post_to_hub(batch_url, headers, body, len(entries), content_encoding)
+  except anvil.http.HttpError as e:
+    if e.status in (404, 405, 501):
+      log("WARNING", "payload_forwarder", "_post_batch_to_hub", f"Hub batch endpoint unavailable (Status {e.status}); sending events individually.", log_context)
+      return None
+    error_msg = f"HTTP Error during batch forwarding: Status {e.status}."
+    return {e_row['event_id']: (False, error_msg) for e_row in entries}
+  except HubCircuitOpenError:
+    return {e_row['event_id']: (False, HUB_CIRCUIT_OPEN_MESSAGE) for e_row in entries}
+
+  # The Hub may report per-event results; anything it does not mention was accepted with the batch
+  per_event = {}
+  try:
+    per_event = json.loads(response.get_bytes().decode('utf-8')).get('results') or {}
+  except Exception:
+    pass
+  results = {}
+  for entry in entries:
+    outcome = per_event.get(entry['event_id'])
+    if isinstance(outcome, dict) and not outcome.get('success', True):
+      results[entry['event_id']] = (False, f"Hub rejected payload in batch: {outcome.get('message', 'no details')}")
+    else:
+      results[entry['event_id']] = (True, f"Payload forwarded successfully in batch. Hub Status: {response.get_status()}")
+  return results
+
+def _deliver_outbox_batch(entries, log_context):
+  """Delivers a claimed batch to the Hub. Returns {event_id: (success, message)}."""
+  optional_keys = (R2HUB_BATCH_ENDPOINT_VAULT_KEY, R2HUB_CONTENT_ENCODING_VAULT_KEY)
+  secrets = get_secrets_for_server_use([R2HUB_API_ENDPOINT_VAULT_KEY, R2HUB_TENANT_ID_VAULT_KEY, R2HUB_API_KEY_VAULT_KEY, *optional_keys],
+                                       optional_keys=optional_keys)
+  credentials = (secrets.get(R2HUB_API_ENDPOINT_VAULT_KEY), secrets.get(R2HUB_TENANT_ID_VAULT_KEY), secrets.get(R2HUB_API_KEY_VAULT_KEY))
+  batch_url = secrets.get(R2HUB_BATCH_ENDPOINT_VAULT_KEY)
+  content_encoding = (secrets.get(R2HUB_CONTENT_ENCODING_VAULT_KEY) or 'identity').strip().lower()
+
+  if batch_url and all(credentials):
+    results = _post_batch_to_hub(batch_url, credentials, entries, content_encoding, log_context)
+    if results is not None:
+      return results
+
+  # No batch endpoint: one request per event, without re-reading the vault for each
+  return {entry['event_id']: forward_payload_to_hub(entry['raw_payload'], entry['event_id'],
+                                                    credentials=credentials if all(credentials) else None,
+                                                    content_encoding=content_encoding)
+          for entry in entries}
+
+def _record_outbox_results(batch, results):
+  """Writes delivery outcomes back to hub_outbox and webhook_log in one transaction."""
+  now = datetime.now(timezone.utc)
+  with anvil.server.Transaction():
+    for outbox_row in batch:
+      success, message = results.get(outbox_row['event_id'], (False, "No delivery result recorded."))
+      if message == HUB_CIRCUIT_OPEN_MESSAGE:
+        # Never sent, so it does not count as an attempt
+        outbox_row.update(status='Pending', attempts=max((outbox_row['attempts'] or 1) - 1, 0))
+        continue
+      gave_up = not success and (outbox_row['attempts'] or 0) >= HUB_OUTBOX_MAX_ATTEMPTS
+      if success:
+        outbox_row.update(status='Delivered', delivered_at=now, last_error=None)
+      else:
+        outbox_row.update(status='Failed' if gave_up else 'Pending', last_error=message[:900],
+                          next_attempt_at=None if gave_up else _outbox_retry_at(outbox_row['attempts'] or 1, now))
+
+      log_row = outbox_row['webhook_log']
+      if not log_row:
+        continue
+      if success or gave_up:
+        log_row['forwarded_to_hub'] = success
+      current_details = log_row['processing_details'] or ""
+      separator = " | " if current_details else ""
+      if success:
+        log_row['processing_details'] = f"{current_details}{separator}Forwarding to R2Hub: {message}"
+        if 'Error' not in (log_row['status'] or ""):
+          log_row['status'] = 'Forwarded to Hub'
+      elif gave_up:
+        log_row['processing_details'] = f"{current_details}{separator}Forwarding to R2Hub failed after {outbox_row['attempts']} attempts: {message}"
+        log_row['status'] = 'Forwarding Error'
+
+@anvil.server.background_task
+@buffered_logging
+def drain_hub_outbox():
+  """
+    Delivers due hub_outbox entries in batches until none are due or a whole batch fails
+    (Hub unavailable), in which case the scheduled run retries later. A failed entry is
+    not due again until its backoff (next_attempt_at) has passed.
+    """
+  module_name = "payload_forwarder"
+  function_name = "drain_hub_outbox"
+  delivered_count = 0
+  failed_count = 0
+  log("INFO", module_name, function_name, "Hub outbox drain started.")
+
+  try:
+    while True:
+      if is_hub_circuit_open():
+        log("INFO", module_name, function_name, "R2Hub circuit open; leaving outbox entries queued.")
+        break
+      batch = _claim_outbox_batch()
+      if not batch:
+        break
+      entries = [{'event_id': row['event_id'], 'raw_payload': row['raw_payload']} for row in batch]
+      log_context = {"batch_size": len(entries)}
+      try:
+        results = _deliver_outbox_batch(entries, log_context)
+      except Exception as e:
+        log("ERROR", module_name, function_name, "Unexpected error delivering outbox batch.", {**log_context, "error": str(e), "trace": traceback.format_exc()})
+        results = {entry['event_id']: (False, f"Unexpected error during forwarding: {str(e)}") for entry in entries}
+      _record_outbox_results(batch, results)
+
+      batch_delivered = sum(1 for success, _ in results.values() if success)
+      delivered_count += batch_delivered
+      failed_count += len(batch) - batch_delivered
+      if batch_delivered == 0:
+        log("WARNING", module_name, function_name, "Entire outbox batch failed; stopping until the next scheduled run.", log_context)
+        break
+  except Exception as e:
+    log("CRITICAL", module_name, function_name, f"Hub outbox drain failed: {str(e)}", {"trace": traceback.format_exc()})
+
+  log("INFO", module_name, function_name, f"Hub outbox drain finished. Delivered: {delivered_count}. Failed attempts: {failed_count}.")
@@ -5,16 +5,20 @@ import anvil.users
 import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
+import itertools
 import json
-from datetime import datetime, timezone
+import random
+import time
+from datetime import datetime, timedelta, timezone
 import traceback # Ensure traceback is imported
 
 # Assuming these modules are in the same directory or accessible via Python's import path
-from .sm_logs_mod import log
+from .sm_logs_mod import log, buffered_logging
 from .sessions_server import is_admin_user # For permission checks
-from .payload_forwarder import request_payload_from_hub # To fetch payload from R2Hub
+from .payload_forwarder import request_payload_from_hub, request_payloads_from_hub, is_hub_circuit_open, HUB_PAYLOAD_FETCH_CHUNK # To fetch payload from R2Hub
+from .payload_store import get_stored_payload, is_payload_store_enabled
 # Import the _process_... functions from webhook_handler.py
-from .webhook_handler import _process_transaction, _process_subscription, _process_product, _process_price, _process_customer, _process_discount
+from .webhook_handler import _process_transaction, _process_subscription, _process_product, _process_price, _process_customer, _process_discount, lookup_cache_scope, _invalidate_reports_for_event
 
 
 @anvil.server.callable(require_user=True)
@@ -46,7 +50,8 @@ def get_webhook_logs_for_retry_ui(status_filter=None):
             "Reprocess Failed - MyBizz Logic",    # Added this status
             "Reprocess Error - JSON",             # Added this status
             "Reprocess Error - Unexpected",       # Added this status
-            "Reprocess Error - Trigger Failed"    # Added this status
+            "Reprocess Error - Trigger Failed",   # Added this status
+            "Reprocess Error - Task Exception"
         ]
         query_conditions.append(app_tables.webhook_log.status.any_of(*actionable_statuses))
 
@@ -66,6 +71,7 @@ def get_webhook_logs_for_retry_ui(status_filter=None):
                 'status': row['status'],
                 'retry_count': row.get('retry_count', 0),
                 'last_retry_timestamp': row.get('last_retry_timestamp'),
+                'next_retry_at': row.get('next_retry_at'),
                 'processing_details': row['processing_details']
             })
         log("INFO", module_name, function_name, f"Retrieved {len(results)} log entries.", {"status_filter": status_filter})
@@ -75,6 +81,15 @@ def get_webhook_logs_for_retry_ui(status_filter=None):
         raise anvil.server.AnvilWrappedError(f"Could not retrieve webhook logs: {str(e)}")
 
 
+def _get_payload_for_reprocess(event_id):
+    """Returns the raw payload for a retry: the local payload store first, R2Hub if it isn't stored locally."""
+    raw_payload_string = get_stored_payload(event_id)
+    if raw_payload_string is not None:
+        return raw_payload_string
+    return request_payload_from_hub(event_id)
+
+
+@lookup_cache_scope
 def _reprocess_single_webhook(log_row, raw_payload_string):
     """
     Internal helper to re-process a single webhook payload.
@@ -151,9 +166,12 @@ def _reprocess_single_webhook(log_row, raw_payload_string):
         except Exception: 
           pass
         return False, error_msg
+    finally:
+        _invalidate_reports_for_event(event_type, log_context) # Even a failed attempt may have committed some changes
 
 
 @anvil.server.callable(require_user=True)
+@buffered_logging
 def trigger_reprocess_webhook_log(webhook_log_anvil_id):
     """
     Manually triggers the reprocessing of a single webhook log entry.
@@ -180,8 +198,13 @@ def trigger_reprocess_webhook_log(webhook_log_anvil_id):
     event_id = log_row['event_id']
     log_context['event_id'] = event_id
 
+    log_row = _claim_retry_row(webhook_log_anvil_id, require_due=False)
+    if not log_row:
+        log("WARNING", module_name, function_name, "Webhook log entry is being reprocessed by a retry worker.", log_context)
+        return "Error: This entry is currently being reprocessed by a retry worker. Please try again shortly."
+
     try:
-        raw_payload_string = request_payload_from_hub(event_id) 
+        raw_payload_string = _get_payload_for_reprocess(event_id)
 
         if raw_payload_string is None:
             log("ERROR", module_name, function_name, "Failed to fetch payload from R2Hub for reprocessing.", log_context)
@@ -208,6 +231,8 @@ def trigger_reprocess_webhook_log(webhook_log_anvil_id):
         except Exception: 
           pass 
         return f"Error: {error_msg}"
+    finally:
+        _release_retry_claim(log_row)
 
 
 @anvil.server.callable(require_user=True)
@@ -248,98 +273,266 @@ def mark_webhook_log_resolved(webhook_log_anvil_id):
         log("ERROR", module_name, function_name, error_msg, {**log_context, "trace": traceback.format_exc()})
         return f"Error: {error_msg}"
 
-@anvil.server.callable
+# --- Retry Scheduling ---
+# Each retryable status has its own backoff: the wait before retry n is base * 2**n seconds,
+# capped at max, plus up to RETRY_JITTER_FRACTION extra so rows that failed together
+# (e.g. during an R2Hub outage) don't all come due at the same moment.
+MAX_RETRIES = 5
+RETRY_BACKOFF_POLICY = {
+    # status: (base_seconds, max_seconds)
+    "Pending Retry - Missing Link": (300, 6 * 3600), # The missing parent usually arrives within minutes
+    "Reprocess Failed - MyBizz Logic": (900, 12 * 3600),
+    "Reprocess Error - R2Hub Fetch Failed": (600, 6 * 3600),
+    "Reprocess Error - JSON": (3600, 24 * 3600),
+    "Reprocess Error - Unexpected": (900, 12 * 3600),
+    "Reprocess Error - Trigger Failed": (900, 12 * 3600), # If manual trigger failed, task might pick it up
+    "Reprocess Error - Task Exception": (900, 12 * 3600),
+}
+DEFAULT_RETRY_BACKOFF = (900, 12 * 3600)
+RETRY_JITTER_FRACTION = 0.2
+RETRY_BATCH_LIMIT = 50 # Rows retried per scheduled run, most overdue first
+
+
+def compute_next_retry_at(status, retry_count, now=None):
+    """Returns when a row in `status` that has been retried `retry_count` times is next due."""
+    base_seconds, max_seconds = RETRY_BACKOFF_POLICY.get(status, DEFAULT_RETRY_BACKOFF)
+    delay = min(base_seconds * (2 ** retry_count), max_seconds)
+    delay += random.uniform(0, delay * RETRY_JITTER_FRACTION)
+    return (now or datetime.now(timezone.utc)) + timedelta(seconds=delay)
+
+
+def _record_failed_retry(log_row, retry_count):
+    """Bumps retry_count and schedules the next attempt, or parks the row for manual review. Call inside a transaction."""
+    now = datetime.now(timezone.utc)
+    log_row['retry_count'] = retry_count + 1
+    log_row['last_retry_timestamp'] = now
+    if log_row['retry_count'] >= MAX_RETRIES:
+        log_row['status'] = "Max Retries Reached - Manual Review"
+        log_row['next_retry_at'] = None
+    else:
+        log_row['next_retry_at'] = compute_next_retry_at(log_row['status'], log_row['retry_count'], now)
+
+
+def _get_due_retries(now):
+    """Unclaimed rows in a retryable status whose next_retry_at has passed (or was never set), most overdue first."""
+    due_rows = app_tables.webhook_log.search(
+        tables.order_by('next_retry_at'),
+        status=q.any_of(*RETRY_BACKOFF_POLICY.keys()),
+        retry_count=q.any_of(None, q.less_than(MAX_RETRIES)),
+        next_retry_at=q.any_of(None, q.less_than_or_equal_to(now)),
+        retry_claimed_until=q.any_of(None, q.less_than(now))
+    )
+    return list(itertools.islice(due_rows, RETRY_BATCH_LIMIT))
+
+
+# --- Parallel Reprocessing Workers ---
+# reprocess_deferred_webhooks splits the due rows into up to REPROCESS_WORKER_COUNT shards
+# and runs each shard in its own reprocess_webhook_shard task. Workers claim each row
+# (retry_claimed_until) in a transaction before touching it, so a row is never processed by
+# two workers, or by a worker and a manual retry, at the same time. A claim left behind by a
+# crashed worker expires after RETRY_CLAIM_MINUTES.
+REPROCESS_WORKER_COUNT = 4
+RETRY_CLAIM_MINUTES = 15
+REPROCESS_PROGRESS_POLL_SECONDS = 2
+
+
+def _claim_retry_row(row_id, require_due=True):
+    """Claims a webhook_log row for reprocessing. Returns the row, or None if it is claimed elsewhere or no longer due."""
+    now = datetime.now(timezone.utc)
+    with anvil.server.Transaction():
+        log_row = app_tables.webhook_log.get_by_id(row_id)
+        if not log_row:
+            return None
+        if log_row['retry_claimed_until'] and log_row['retry_claimed_until'] > now:
+            return None
+        if require_due and (
+            log_row['status'] not in RETRY_BACKOFF_POLICY or
+            (log_row['retry_count'] or 0) >= MAX_RETRIES or
+            (log_row['next_retry_at'] and log_row['next_retry_at'] > now)
+        ):
+            return None # Another run already handled it
+        log_row['retry_claimed_until'] = now + timedelta(minutes=RETRY_CLAIM_MINUTES)
+        return log_row
+
+
+def _release_retry_claim(log_row):
+    try:
+        log_row['retry_claimed_until'] = None
+    except Exception as e:
+        # The claim simply expires after RETRY_CLAIM_MINUTES
+        log("WARNING", "payload_retry", "_release_retry_claim", f"Could not release retry claim: {e}", {"webhook_log_id": log_row.get_id()})
+
+
+def _reprocess_due_row(log_row, raw_payload_string):
+    """One scheduled retry attempt for a claimed row, with its prefetched payload (None if unavailable). Returns True on success."""
+    module_name = "payload_retry"
+    function_name = "reprocess_deferred_webhooks_task"
+    event_id = log_row['event_id']
+    current_retry_count = log_row['retry_count'] or 0
+    log_context_item = {"webhook_log_id": log_row.get_id(), "event_id": event_id, "current_retry_count": current_retry_count}
+
+    log("INFO", module_name, function_name, "Attempting to reprocess item via scheduled task.", log_context_item)
+
+    try:
+        if raw_payload_string is None:
+            log("WARNING", module_name, function_name, "Failed to fetch payload from R2Hub for scheduled reprocessing.", log_context_item)
+            with anvil.server.Transaction():
+                log_row_to_update_fetch_fail = app_tables.webhook_log.get_by_id(log_row.get_id())
+                if log_row_to_update_fetch_fail:
+                    log_row_to_update_fetch_fail['status'] = "Reprocess Error - R2Hub Fetch Failed"
+                    log_row_to_update_fetch_fail['processing_details'] = f"{log_row_to_update_fetch_fail['processing_details'] or ''} | Scheduled Reprocess: R2Hub payload fetch failed."
+                    _record_failed_retry(log_row_to_update_fetch_fail, current_retry_count)
+            return False
+
+        success, message = _reprocess_single_webhook(log_row, raw_payload_string)
+
+        if success:
+            log("INFO", module_name, function_name, f"Successfully reprocessed: {message}", log_context_item)
+            with anvil.server.Transaction():
+                log_row_to_update_done = app_tables.webhook_log.get_by_id(log_row.get_id())
+                if log_row_to_update_done:
+                    log_row_to_update_done['next_retry_at'] = None
+        else:
+            log("WARNING", module_name, function_name, f"Failed to reprocess: {message}", log_context_item)
+            with anvil.server.Transaction(): # Ensure retry count is updated even if _reprocess_single_webhook updated status
+                log_row_to_update_retry = app_tables.webhook_log.get_by_id(log_row.get_id())
+                if log_row_to_update_retry:
+                    _record_failed_retry(log_row_to_update_retry, current_retry_count)
+                else:
+                    log("CRITICAL", module_name, function_name, "Log row disappeared during retry count update.", log_context_item)
+        return success
+
+    except Exception as e_task_item:
+        log("ERROR", module_name, function_name, f"Unexpected error reprocessing item in scheduled task: {str(e_task_item)}", 
+            {**log_context_item, "trace": traceback.format_exc()})
+        try:
+            with anvil.server.Transaction():
+                log_row_to_update_task_err = app_tables.webhook_log.get_by_id(log_row.get_id())
+                if log_row_to_update_task_err:
+                    log_row_to_update_task_err['status'] = "Reprocess Error - Task Exception"
+                    log_row_to_update_task_err['processing_details'] = f"{log_row_to_update_task_err['processing_details'] or ''} | Task Exception: {str(e_task_item)[:200]}"
+                    _record_failed_retry(log_row_to_update_task_err, current_retry_count)
+        except Exception: 
+          pass
+        return False
+
+
+@anvil.server.background_task
+@buffered_logging
+def reprocess_webhook_shard(row_ids):
+    """Worker: reprocesses one shard of due webhook_log rows, reporting progress in task_state."""
+    progress = {"total": len(row_ids), "done": 0, "succeeded": 0, "failed": 0, "skipped": 0}
+    anvil.server.task_state.update(progress)
+
+    # Claim and prefetch payloads a chunk at a time: local copies first, then one bulk
+    # request to R2Hub for the rest, instead of a Hub round-trip per row
+    for start in range(0, len(row_ids), HUB_PAYLOAD_FETCH_CHUNK):
+        claimed_rows = []
+        for row_id in row_ids[start:start + HUB_PAYLOAD_FETCH_CHUNK]:
+            log_row = _claim_retry_row(row_id)
+            if log_row:
+                claimed_rows.append(log_row)
+            else:
+                progress["skipped"] += 1
+                progress["done"] += 1
+
+        payloads = {}
+        try:
+            for log_row in claimed_rows:
+                stored_payload = get_stored_payload(log_row['event_id'])
+                if stored_payload is not None:
+                    payloads[log_row['event_id']] = stored_payload
+            missing_event_ids = [r['event_id'] for r in claimed_rows if r['event_id'] not in payloads]
+            if missing_event_ids:
+                payloads.update(request_payloads_from_hub(missing_event_ids))
+        except Exception as e:
+            log("ERROR", "payload_retry", "reprocess_webhook_shard", f"Payload prefetch failed: {e}", {"trace": traceback.format_exc()})
+
+        for log_row in claimed_rows:
+            try:
+                if _reprocess_due_row(log_row, payloads.get(log_row['event_id'])):
+                    progress["succeeded"] += 1
+                else:
+                    progress["failed"] += 1
+            finally:
+                _release_retry_claim(log_row)
+            progress["done"] += 1
+            anvil.server.task_state.update(progress)
+    anvil.server.task_state.update(progress)
+    return progress
+
+
 @anvil.server.background_task
+@buffered_logging
 def reprocess_deferred_webhooks():
     """
-    Scheduled task to attempt reprocessing of webhook logs that are pending retry.
+    Scheduled task to attempt reprocessing of webhook logs that are due for retry.
+    Picks up at most RETRY_BATCH_LIMIT rows per run, in next_retry_at order, and fans them
+    out to reprocess_webhook_shard workers. Combined progress is published in task_state.
     """
     module_name = "payload_retry"
     function_name = "reprocess_deferred_webhooks_task"
     log("INFO", module_name, function_name, "Scheduled task started: Reprocessing deferred webhooks.")
 
-    MAX_RETRIES = 5 
-    retry_statuses = [
-        "Pending Retry - Missing Link", 
-        "Reprocess Failed - MyBizz Logic", 
-        "Reprocess Error - R2Hub Fetch Failed",
-        "Reprocess Error - JSON",
-        "Reprocess Error - Unexpected",
-        "Reprocess Error - Trigger Failed" # If manual trigger failed, task might pick it up
-    ] 
-
-    logs_to_retry = app_tables.webhook_log.search(
-        status=q.any_of(*retry_statuses),
-        retry_count=q.less_than(MAX_RETRIES) # Ensure retry_count field exists in webhook_log
-    )
+    # Without local payload copies every retry needs R2Hub; don't burn retry attempts while it is down
+    if is_hub_circuit_open() and not is_payload_store_enabled():
+        log("WARNING", module_name, function_name, "R2Hub circuit open; skipping this reprocessing run.")
+        return
+
+    row_ids = [row.get_id() for row in _get_due_retries(datetime.now(timezone.utc))]
+    progress = {"total": len(row_ids), "done": 0, "succeeded": 0, "failed": 0, "skipped": 0, "workers": 0}
+    anvil.server.task_state.update(progress)
+    if not row_ids:
+        log("INFO", module_name, function_name, "Scheduled task finished. No webhooks due for retry.")
+        return progress
+
+    # Round-robin shards so each worker gets a similar mix of overdue rows
+    worker_count = min(REPROCESS_WORKER_COUNT, len(row_ids))
+    shards = [row_ids[i::worker_count] for i in range(worker_count)]
+    workers = [anvil.server.launch_background_task('reprocess_webhook_shard', shard) for shard in shards]
+    progress["workers"] = len(workers)
+
+    while True:
+        worker_states = [worker.get_state() or {} for worker in workers]
+        for key in ("done", "succeeded", "failed", "skipped"):
+            progress[key] = sum(state.get(key, 0) for state in worker_states)
+        anvil.server.task_state.update(progress)
+        if all(worker.is_completed() or not worker.is_running() for worker in workers):
+            break
+        time.sleep(REPROCESS_PROGRESS_POLL_SECONDS)
+
+    log("INFO", module_name, function_name,
+        f"Scheduled task finished. Successfully reprocessed: {progress['succeeded']}. Failed attempts: {progress['failed']}. Skipped (claimed elsewhere): {progress['skipped']}.",
+        {"workers": len(workers)})
+    return progress
 
-    reprocessed_count = 0
-    failed_reprocess_count = 0
 
-    for log_row in logs_to_retry:
-        event_id = log_row['event_id']
-        current_retry_count = log_row.get('retry_count', 0)
-        log_context_item = {"webhook_log_id": log_row.get_id(), "event_id": event_id, "current_retry_count": current_retry_count}
+@anvil.server.callable(require_user=True)
+def start_deferred_webhook_reprocessing():
+    """Starts a reprocessing run now (unless one is already running). Returns its progress, as for get_deferred_reprocessing_progress."""
+    if not is_admin_user():
+        log("WARNING", "payload_retry", "start_deferred_webhook_reprocessing", "Permission denied to start reprocessing run.")
+        raise anvil.server.PermissionDenied("Admin privileges required.")
+    if not _find_running_reprocess_task():
+        anvil.server.launch_background_task('reprocess_deferred_webhooks')
+        log("INFO", "payload_retry", "start_deferred_webhook_reprocessing", "Reprocessing run started manually.",
+            {"triggered_by_user": anvil.users.get_user()['email']})
+    return get_deferred_reprocessing_progress()
 
-        # Max retries check already done by search query, but double check for safety
-        if current_retry_count >= MAX_RETRIES:
-            if log_row['status'] != "Max Retries Reached - Manual Review":
-                log_row.update(status="Max Retries Reached - Manual Review", last_retry_timestamp=datetime.now(timezone.utc))
-            continue
 
-        log("INFO", module_name, function_name, "Attempting to reprocess item via scheduled task.", log_context_item)
-        
-        try:
-            raw_payload_string = request_payload_from_hub(event_id)
-
-            if raw_payload_string is None:
-                log("WARNING", module_name, function_name, "Failed to fetch payload from R2Hub for scheduled reprocessing.", log_context_item)
-                with anvil.server.Transaction():
-                    log_row_to_update_fetch_fail = app_tables.webhook_log.get_by_id(log_row.get_id())
-                    if log_row_to_update_fetch_fail:
-                        log_row_to_update_fetch_fail['status'] = "Reprocess Error - R2Hub Fetch Failed"
-                        log_row_to_update_fetch_fail['retry_count'] = current_retry_count + 1
-                        log_row_to_update_fetch_fail['last_retry_timestamp'] = datetime.now(timezone.utc)
-                        log_row_to_update_fetch_fail['processing_details'] = f"{log_row_to_update_fetch_fail['processing_details'] or ''} | Scheduled Reprocess: R2Hub payload fetch failed."
-                        if log_row_to_update_fetch_fail['retry_count'] >= MAX_RETRIES:
-                            log_row_to_update_fetch_fail['status'] = "Max Retries Reached - Manual Review"
-                failed_reprocess_count += 1
-                continue
-
-            success, message = _reprocess_single_webhook(log_row, raw_payload_string)
-
-            if success:
-                reprocessed_count += 1
-                log("INFO", module_name, function_name, f"Successfully reprocessed: {message}", log_context_item)
-            else:
-                failed_reprocess_count += 1
-                log("WARNING", module_name, function_name, f"Failed to reprocess: {message}", log_context_item)
-                with anvil.server.Transaction(): # Ensure retry count is updated even if _reprocess_single_webhook updated status
-                    log_row_to_update_retry = app_tables.webhook_log.get_by_id(log_row.get_id())
-                    if log_row_to_update_retry:
-                        log_row_to_update_retry['retry_count'] = current_retry_count + 1
-                        log_row_to_update_retry['last_retry_timestamp'] = datetime.now(timezone.utc)
-                        if log_row_to_update_retry['retry_count'] >= MAX_RETRIES and "Error" in log_row_to_update_retry['status']: # Only set to Max Retries if still in an error state
-                            log_row_to_update_retry['status'] = "Max Retries Reached - Manual Review"
-                    else:
-                        log("CRITICAL", module_name, function_name, "Log row disappeared during retry count update.", log_context_item)
-
-        except Exception as e_task_item:
-            failed_reprocess_count += 1
-            log("ERROR", module_name, function_name, f"Unexpected error reprocessing item in scheduled task: {str(e_task_item)}", 
-                {**log_context_item, "trace": traceback.format_exc()})
-            try:
-                with anvil.server.Transaction():
-                    log_row_to_update_task_err = app_tables.webhook_log.get_by_id(log_row.get_id())
-                    if log_row_to_update_task_err:
-                        log_row_to_update_task_err['status'] = "Reprocess Error - Task Exception"
-                        log_row_to_update_task_err['processing_details'] = f"{log_row_to_update_task_err['processing_details'] or ''} | Task Exception: {str(e_task_item)[:200]}"
-                        log_row_to_update_task_err['retry_count'] = current_retry_count + 1
-                        log_row_to_update_task_err['last_retry_timestamp'] = datetime.now(timezone.utc)
-                        if log_row_to_update_task_err['retry_count'] >= MAX_RETRIES:
-                             log_row_to_update_task_err['status'] = "Max Retries Reached - Manual Review"
-            except Exception: 
-              pass
-
-    log("INFO", module_name, function_name, f"Scheduled task finished. Successfully reprocessed: {reprocessed_count}. Failed attempts: {failed_reprocess_count}.")
+def _find_running_reprocess_task():
+    for task in anvil.server.list_background_tasks():
+        if task.get_task_name() == 'reprocess_deferred_webhooks' and task.is_running():
+            return task
+    return None
+
 
+@anvil.server.callable(require_user=True)
+def get_deferred_reprocessing_progress():
+    """Returns the running reprocessing run's progress dict (total/done/succeeded/failed/skipped/workers), or None if idle."""
+    if not is_admin_user():
+        raise anvil.server.PermissionDenied("Admin privileges required.")
+    task = _find_running_reprocess_task()
+    if not task:
+        return None
+    return dict(task.get_state() or {})
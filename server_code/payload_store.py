@@ -0,0 +1,98 @@
+# Server Module: payload_store.py
+# Optional local copy of raw webhook payloads, so retries and manual reprocessing
+# don't need a round-trip to R2Hub. Payloads are gzip-compressed, linked to their
+# webhook_log row, and pruned by age (PAYLOAD_STORE_RETENTION_DAYS) and by total
+# size (PAYLOAD_STORE_MAX_TOTAL_BYTES). Enabled with the WEBHOOK_LOCAL_PAYLOAD_STORE setting.
+
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import gzip
+import traceback
+from datetime import datetime, timedelta, timezone
+from .sm_logs_mod import log, buffered_logging
+
+# --- Constants ---
+PAYLOAD_STORE_SETTING_NAME = 'WEBHOOK_LOCAL_PAYLOAD_STORE'
+PAYLOAD_STORE_RETENTION_DAYS = 30
+PAYLOAD_STORE_MAX_TOTAL_BYTES = 250 * 1024 * 1024 # Compressed bytes across all stored payloads
+PAYLOAD_STORE_MAX_PAYLOAD_BYTES = 1024 * 1024 # Larger (compressed) payloads are left to R2Hub
+
+
+def is_payload_store_enabled():
+  """Checks the app_settings flag that turns on the local payload store."""
+  try:
+    setting = app_tables.app_settings.get(setting_name=PAYLOAD_STORE_SETTING_NAME)
+    return bool(setting and setting['value_bool'])
+  except Exception as e:
+    print(f"Warning: Could not read '{PAYLOAD_STORE_SETTING_NAME}' setting, not storing payloads locally: {e}")
+    return False
+
+
+def store_payload(log_row, raw_payload_string):
+  """Saves a compressed copy of a webhook's raw payload against its webhook_log row. Never raises."""
+  if not raw_payload_string or not log_row or not is_payload_store_enabled():
+    return False
+  try:
+    raw_bytes = raw_payload_string.encode('utf-8')
+    compressed = gzip.compress(raw_bytes)
+    if len(compressed) > PAYLOAD_STORE_MAX_PAYLOAD_BYTES:
+      log("INFO", "payload_store", "store_payload", "Payload too large for local store; R2Hub copy only.",
+          {"event_id": log_row['event_id'], "stored_bytes": len(compressed)})
+      return False
+    app_tables.webhook_payload_store.add_row(
+      webhook_log=log_row,
+      event_id=log_row['event_id'],
+      payload=anvil.BlobMedia('application/gzip', compressed, name=f"{log_row['event_id']}.json.gz"),
+      raw_bytes=len(raw_bytes),
+      stored_bytes=len(compressed),
+      stored_at=datetime.now(timezone.utc)
+    )
+    return True
+  except Exception as e:
+    log("WARNING", "payload_store", "store_payload", f"Could not store payload locally: {e}", {"event_id": log_row['event_id']})
+    return False
+
+
+def get_stored_payload(event_id):
+  """Returns the locally stored raw payload string for event_id, or None if it isn't stored."""
+  if not event_id:
+    return None
+  try:
+    stored = app_tables.webhook_payload_store.get(event_id=event_id)
+    if not stored or not stored['payload']:
+      return None
+    return gzip.decompress(stored['payload'].get_bytes()).decode('utf-8')
+  except Exception as e:
+    log("WARNING", "payload_store", "get_stored_payload", f"Could not read locally stored payload: {e}", {"event_id": event_id})
+    return None
+
+
+@anvil.server.background_task
+@buffered_logging
+def prune_payload_store():
+  """Scheduled task: deletes stored payloads past the retention window, then the oldest ones until under the size cap."""
+  module_name = "payload_store"
+  function_name = "prune_payload_store"
+  try:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=PAYLOAD_STORE_RETENTION_DAYS)
+    expired_count = 0
+    for row in app_tables.webhook_payload_store.search(stored_at=q.less_than(cutoff)):
+      row.delete()
+      expired_count += 1
+
+    # Newest first: keep adding up sizes, delete everything past the cap
+    total_bytes = 0
+    capped_count = 0
+    for row in app_tables.webhook_payload_store.search(tables.order_by('stored_at', ascending=False)):
+      total_bytes += row['stored_bytes'] or 0
+      if total_bytes > PAYLOAD_STORE_MAX_TOTAL_BYTES:
+        row.delete()
+        capped_count += 1
+
+    log("INFO", module_name, function_name,
+        f"Payload store pruned. Expired: {expired_count}. Removed for size cap: {capped_count}.",
+        {"retention_days": PAYLOAD_STORE_RETENTION_DAYS, "max_total_bytes": PAYLOAD_STORE_MAX_TOTAL_BYTES})
+  except Exception as e:
+    log("ERROR", module_name, function_name, f"Failed to prune payload store: {e}", {"trace": traceback.format_exc()})
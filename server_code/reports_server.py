@@ -11,6 +11,16 @@ from collections import defaultdict # Ensure defaultdict is imported
 # in this file or imported correctly if they are in a different helper module.
 from datetime import datetime, date, timezone, timedelta # Ensure 'date' is explicitly imported
 import traceback
+import base64
+import json
+import bisect
+import random
+from .sm_revenue_rollup_mod import get_revenue_daily_rows, earnings_value
+from .sm_last_paid_mod import PAID_TRANSACTION_STATUSES
+from .sm_subs_history_mod import get_states_at, get_state_entries_between, load_state_intervals
+from .sm_report_cache_mod import cached_report
+from .sm_backfill_mod import ensure_backfill
+from .sessions_server import is_admin_user
 
 
 
@@ -110,6 +120,7 @@ def _normalize_price_to_monthly(amount_in_system_currency, interval, frequency):
 # In reports_server.py
 
 @anvil.server.callable(require_user=True)
+@cached_report('revenue_trend')
 def get_revenue_sales_trend_data(period_type="monthly", periods=12):
   """
     Fetches data for the Revenue & Sales Trend report.
@@ -117,20 +128,35 @@ def get_revenue_sales_trend_data(period_type="monthly", periods=12):
     MODIFIED: Uses 'details_totals_earnings' for revenue.
     """
   results = []
-  for i in range(periods - 1, -1, -1): # Iterate from oldest to newest period
-    start_dt, end_dt = _get_period_start_end(period_type, i) # Assumes _get_period_start_end helper exists
-    period_label = start_dt.strftime("%Y-%m") if period_type=="monthly" else start_dt.strftime("%Y-Q%q").replace('%q', str(math.ceil(start_dt.month/3))) # Assumes math is imported
+  period_bounds = [_get_period_start_end(period_type, i) for i in range(periods - 1, -1, -1)] # Oldest to newest period
+
+  # Month/quarter periods start at midnight UTC, so they can be summed from the revenue_daily
+  # rollup with a single query once the rollup has been backfilled. Anything else, or a
+  # rollup still waiting for its backfill, falls back to scanning transactions.
+  daily_totals = None
+  if period_type in ("month", "quarter") and period_bounds and ensure_backfill('backfill_revenue_daily'):
+    daily_totals = {
+      r['day']: (r['total_earnings'] or 0, r['num_transactions'] or 0)
+      for r in get_revenue_daily_rows(period_bounds[0][0].date(), period_bounds[-1][1].date())
+    }
 
-    paid_transactions = list(app_tables.transaction.search(
-      status='paid', 
-      billed_at=q.between(start_dt, end_dt, min_inclusive=True, max_inclusive=False)
-    ))
+  for start_dt, end_dt in period_bounds:
+    period_label = start_dt.strftime("%Y-%m") if period_type=="monthly" else start_dt.strftime("%Y-Q%q").replace('%q', str(math.ceil(start_dt.month/3))) # Assumes math is imported
 
-    # MODIFICATION: Use 'details_totals_earnings' for revenue
-    # Ensure this field is consistently populated in your 'transaction' table
-    # and represents the value in your system/payout currency.
-    total_revenue = sum(t['details_totals_earnings'] or 0 for t in paid_transactions)
-    num_transactions = len(paid_transactions)
+    if daily_totals is not None:
+      period_days = [v for day, v in daily_totals.items() if start_dt.date() <= day < end_dt.date()]
+      total_revenue = sum(earnings for earnings, _ in period_days)
+      num_transactions = sum(count for _, count in period_days)
+    else:
+      paid_transactions = list(app_tables.transaction.search(
+        status='paid', 
+        billed_at=q.between(start_dt, end_dt, min_inclusive=True, max_inclusive=False)
+      ))
+      # MODIFICATION: Use 'details_totals_earnings' for revenue
+      # Ensure this field is consistently populated in your 'transaction' table
+      # and represents the value in your system/payout currency.
+      total_revenue = sum(earnings_value(t['details_totals_earnings']) for t in paid_transactions)
+      num_transactions = len(paid_transactions)
     avg_transaction_value = total_revenue / num_transactions if num_transactions > 0 else 0
 
     results.append({
@@ -146,144 +172,280 @@ def get_revenue_sales_trend_data(period_type="monthly", periods=12):
 # Report 2: Subscription Overview & MRR Insights
 # In reports_server.py
 
+# --- MRR Engine ---
+# Subscriptions and paid transactions are loaded once per report. Each subscription's
+# paid earnings are indexed by billed_at, so the per-period MRR figures are bucketed
+# in memory instead of searching transaction once per subscription per period.
+# Paid transactions without billed_at are left out of the index.
+# "Active at the end of a period" comes from subs_state_history intervals when given, and
+# from the current columns for subscriptions that have no history yet.
+
+def _load_mrr_subscriptions():
+  """Plain records for every subscription, with the columns the MRR engine reads."""
+  return [{
+    'id': sub_row.get_id(),
+    'status': sub_row['status'],
+    'started_at': sub_row['started_at'],
+    'canceled_at': sub_row['canceled_at'],
+    'billing_cycle_interval': sub_row['billing_cycle_interval'],
+    'billing_cycle_frequency': sub_row['billing_cycle_frequency']
+  } for sub_row in app_tables.subs.search()]
+
+def _load_paid_subscription_transactions():
+  """(subscription row id, billed_at, earnings) for every paid transaction linked to a subscription."""
+  paid_txns = app_tables.transaction.search(
+    q.fetch_only('billed_at', 'details_totals_earnings', subscription_id=q.fetch_only()),
+    status='paid'
+  )
+  return [(txn['subscription_id'].get_id(), txn['billed_at'], txn['details_totals_earnings'])
+          for txn in paid_txns if txn['subscription_id'] is not None]
+
+def _build_paid_earnings_index(paid_txns):
+  """Maps subscription id -> ([billed_at, ...], [earnings, ...]), both sorted by billed_at."""
+  grouped = defaultdict(list)
+  for sub_id, billed_at, earnings in paid_txns:
+    if billed_at is not None:
+      grouped[sub_id].append((billed_at, earnings))
+  index = {}
+  for sub_id, entries in grouped.items():
+    entries.sort(key=lambda entry: entry[0])
+    index[sub_id] = ([entry[0] for entry in entries], [entry[1] for entry in entries])
+  return index
+
+def _sub_mrr_values(sub, earnings_index):
+  """
+    Returns the subscription's (active, new, churn) monthly values:
+    its latest paid earnings, its first paid earnings at/after started_at,
+    and its last paid earnings at/before canceled_at.
+    """
+  billed, earnings = earnings_index.get(sub['id'], ([], []))
+  monthly = lambda amount: _normalize_price_to_monthly(amount, sub['billing_cycle_interval'], sub['billing_cycle_frequency'])
+  active_value = monthly(earnings[-1]) if earnings else 0.0
+  new_value = churn_value = 0.0
+  if sub['started_at'] is not None:
+    first_idx = bisect.bisect_left(billed, sub['started_at'])
+    if first_idx < len(billed):
+      new_value = monthly(earnings[first_idx])
+  if sub['canceled_at'] is not None:
+    last_idx = bisect.bisect_right(billed, sub['canceled_at']) - 1
+    if last_idx >= 0:
+      churn_value = monthly(earnings[last_idx])
+  return active_value, new_value, churn_value
+
+def _active_at(intervals, moment):
+  """True if any (valid_from, valid_to) interval covers the instant just before moment."""
+  return any(valid_from < moment and (valid_to is None or valid_to >= moment) for valid_from, valid_to in intervals)
+
+def _compute_mrr_periods(subs, earnings_index, period_bounds, active_intervals=None):
+  """
+    One pass over the subscriptions, bucketing each into the periods it affects.
+    period_bounds is a list of (start_dt, end_dt), oldest first and contiguous.
+    active_intervals maps subscription id -> [(valid_from, valid_to), ...] of active state
+    (see load_state_intervals). A subscription missing from it, or every subscription when
+    it is None, counts as active from started_at if it is active now.
+    """
+  period_starts = [start_dt for start_dt, _ in period_bounds]
+  periods_out = [{'active_subscriptions': 0, 'new_subscriptions': 0, 'canceled_subscriptions': 0,
+                  'estimated_mrr': 0.0, 'new_mrr': 0.0, 'churn_mrr': 0.0} for _ in period_bounds]
+
+  def period_index(moment):
+    idx = bisect.bisect_right(period_starts, moment) - 1
+    return idx if idx >= 0 and moment < period_bounds[idx][1] else None
+
+  for sub in subs:
+    active_value, new_value, churn_value = _sub_mrr_values(sub, earnings_index)
+    started_at, canceled_at = sub['started_at'], sub['canceled_at']
+
+    if active_intervals is not None and sub['id'] in active_intervals:
+      intervals = active_intervals[sub['id']]
+    elif sub['status'] == 'active' and canceled_at is None and started_at is not None:
+      intervals = ((started_at, None),)
+    else:
+      intervals = ()
+    if intervals:
+      for idx, (_, end_dt) in enumerate(period_bounds):
+        if _active_at(intervals, end_dt):
+          periods_out[idx]['active_subscriptions'] += 1
+          periods_out[idx]['estimated_mrr'] += active_value
+
+    idx = period_index(started_at) if started_at is not None else None
+    if idx is not None:
+      periods_out[idx]['new_subscriptions'] += 1
+      periods_out[idx]['new_mrr'] += new_value
+
+    idx = period_index(canceled_at) if canceled_at is not None else None
+    if idx is not None:
+      periods_out[idx]['canceled_subscriptions'] += 1
+      periods_out[idx]['churn_mrr'] += churn_value
+  return periods_out
+
 @anvil.server.callable(require_user=True)
+@cached_report('subscription_mrr')
 def get_subscription_mrr_data(period_type="month", periods=12):
   """
     Fetches data for the Subscription Overview & MRR Insights report.
     MODIFIED: Calculates Estimated MRR, New MRR, and Churn MRR based on
               normalized 'details_totals_earnings' from relevant transactions.
+    Reads subs, paid transactions and active state history once; see the MRR engine above.
     """
-  results = []
+  period_bounds = [_get_period_start_end(period_type, i) for i in range(periods - 1, -1, -1)] # Oldest to newest period
+  earnings_index = _build_paid_earnings_index(_load_paid_subscription_transactions())
+  period_values = _compute_mrr_periods(_load_mrr_subscriptions(), earnings_index, period_bounds,
+                                       active_intervals=load_state_intervals('active'))
 
-  for i in range(periods - 1, -1, -1): # Iterate from oldest to newest period
-    start_dt, end_dt = _get_period_start_end(period_type, i)
+  results = []
+  for (start_dt, end_dt), values in zip(period_bounds, period_values):
     period_label = start_dt.strftime("%Y-%m") if period_type=="month" else start_dt.strftime("%Y-Q%q").replace('%q', str(math.ceil(start_dt.month/3)))
-
-    # --- Subscriptions active at the END of the period ---
-    active_subs_at_end_rows = list(app_tables.subs.search(
-      status='active',
-      started_at=q.less_than(end_dt),
-      canceled_at=None
-    ))
-    active_subs_count = len(active_subs_at_end_rows)
-
-    # --- Subscriptions started WITHIN the period ---
-    new_subs_in_period_rows = list(app_tables.subs.search(
-      started_at=q.between(start_dt, end_dt, min_inclusive=True, max_inclusive=False)
-    ))
-    new_subs_count = len(new_subs_in_period_rows)
-
-    # --- Subscriptions canceled WITHIN the period ---
-    canceled_in_period_rows = list(app_tables.subs.search(
-      canceled_at=q.between(start_dt, end_dt, min_inclusive=True, max_inclusive=False)
-    ))
-    canceled_count = len(canceled_in_period_rows)
-
-    # --- MRR Calculations ---
-    estimated_mrr = 0.0
-    new_mrr = 0.0
-    churn_mrr = 0.0
-
-    # Calculate Total Estimated MRR from subs active at period end
-    for sub_row in active_subs_at_end_rows:
-      # Find the most recent 'paid' transaction for this subscription
-      # to get its earnings in system currency.
-      latest_paid_txn = app_tables.transaction.search(
-        tables.order_by("billed_at", ascending=False),
-        subscription_id=sub_row,
-        status='paid',
-        # Optimization: consider billed_at <= end_dt if relevant
-      )
-      if latest_paid_txn and len(latest_paid_txn) > 0:
-        txn_earnings = latest_paid_txn[0]['details_totals_earnings']
-        if txn_earnings is not None: # Ensure earnings is not None
-          monthly_value = _normalize_price_to_monthly(
-            txn_earnings, # Already in system currency
-            sub_row['billing_cycle_interval'],
-            sub_row['billing_cycle_frequency']
-          )
-          estimated_mrr += monthly_value
-          # If no paid transaction found, it contributes 0 to this MRR calculation
-
-        # Calculate New MRR from subs started in period
-    for sub_row in new_subs_in_period_rows:
-      # Find the first 'paid' transaction for this new subscription
-      # (ideally billed within the current or very near future period)
-      first_paid_txn = app_tables.transaction.search(
-        tables.order_by("billed_at", ascending=True),
-        subscription_id=sub_row,
-        status='paid',
-        billed_at=q.greater_equal(sub_row['started_at']) # Ensure txn is not from before start
-      )
-      if first_paid_txn and len(first_paid_txn) > 0:
-        txn_earnings = first_paid_txn[0]['details_totals_earnings']
-        if txn_earnings is not None:
-          monthly_value = _normalize_price_to_monthly(
-            txn_earnings,
-            sub_row['billing_cycle_interval'],
-            sub_row['billing_cycle_frequency']
-          )
-          new_mrr += monthly_value
-          # If no paid transaction yet, it contributes 0 to New MRR (as per your instruction)
-
-        # Calculate Churn MRR from subs canceled in period
-    for sub_row in canceled_in_period_rows:
-      # Find the last 'paid' transaction before or at cancellation to represent lost MRR
-      last_paid_txn = app_tables.transaction.search(
-        tables.order_by("billed_at", ascending=False),
-        subscription_id=sub_row,
-        status='paid',
-        billed_at=q.less_than_or_equal_to(sub_row['canceled_at']) # Txn before or at cancellation
-      )
-      if last_paid_txn and len(last_paid_txn) > 0:
-        txn_earnings = last_paid_txn[0]['details_totals_earnings']
-        if txn_earnings is not None:
-          monthly_value = _normalize_price_to_monthly(
-            txn_earnings,
-            sub_row['billing_cycle_interval'],
-            sub_row['billing_cycle_frequency']
-          )
-          churn_mrr += monthly_value
-          # If no prior paid transaction, it means it churned before any value was realized/recorded as earnings.
-
     results.append({
       'period': period_label,
       'start_date': start_dt,
       'end_date': end_dt,
-      'active_subscriptions': active_subs_count,
-      'new_subscriptions': new_subs_count,
-      'canceled_subscriptions': canceled_count,
-      'estimated_mrr': estimated_mrr,
-      'new_mrr': new_mrr,
-      'churn_mrr': churn_mrr
+      **values
     })
   return results
 
+def _reference_mrr_periods(subs, paid_txns, period_bounds, state_changes=None):
+  """
+    The per-period, per-subscription lookups get_subscription_mrr_data used to run as
+    table searches, done as linear scans. Only used by test_mrr_engine.
+    state_changes maps subscription id -> [(changed_at, status), ...] in order; a subscription
+    in it is active at a moment if its last change before that moment was to 'active'.
+    """
+  def active_at_end(sub, end_dt):
+    if state_changes is not None and sub['id'] in state_changes:
+      earlier = [status for changed_at, status in state_changes[sub['id']] if changed_at < end_dt]
+      return bool(earlier) and earlier[-1] == 'active'
+    return sub['status'] == 'active' and sub['started_at'] is not None and sub['started_at'] < end_dt and sub['canceled_at'] is None
+
+  def paid_for(sub):
+    return [(billed_at, earnings) for sub_id, billed_at, earnings in paid_txns if sub_id == sub['id'] and billed_at is not None]
+
+  def monthly(sub, amount):
+    return _normalize_price_to_monthly(amount, sub['billing_cycle_interval'], sub['billing_cycle_frequency'])
+
+  periods_out = []
+  for start_dt, end_dt in period_bounds:
+    active = [s for s in subs if active_at_end(s, end_dt)]
+    new = [s for s in subs if s['started_at'] is not None and start_dt <= s['started_at'] < end_dt]
+    canceled = [s for s in subs if s['canceled_at'] is not None and start_dt <= s['canceled_at'] < end_dt]
+    estimated_mrr = new_mrr = churn_mrr = 0.0
+    for s in active:
+      txns = sorted(paid_for(s), key=lambda t: t[0])
+      if txns and txns[-1][1] is not None:
+        estimated_mrr += monthly(s, txns[-1][1])
+    for s in new:
+      txns = sorted([t for t in paid_for(s) if t[0] >= s['started_at']], key=lambda t: t[0])
+      if txns and txns[0][1] is not None:
+        new_mrr += monthly(s, txns[0][1])
+    for s in canceled:
+      txns = sorted([t for t in paid_for(s) if t[0] <= s['canceled_at']], key=lambda t: t[0])
+      if txns and txns[-1][1] is not None:
+        churn_mrr += monthly(s, txns[-1][1])
+    periods_out.append({'active_subscriptions': len(active), 'new_subscriptions': len(new), 'canceled_subscriptions': len(canceled),
+                        'estimated_mrr': estimated_mrr, 'new_mrr': new_mrr, 'churn_mrr': churn_mrr})
+  return periods_out
+
+TEST_MRR_MAX_SUBSCRIPTIONS = 2000
+
+@anvil.server.callable
+def test_mrr_engine(sub_count=300, seed=7):
+  """
+    Regression test: runs the MRR engine and the old per-subscription lookups on the same
+    synthetic subscriptions and transactions and checks every period matches, first with
+    the column rule alone, then with state history for about half the subscriptions.
+    The history pauses and resumes subscriptions, and the rest fall back to their columns.
+    Requires admin privileges; sub_count is capped at TEST_MRR_MAX_SUBSCRIPTIONS.
+    """
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Administrator privileges required.")
+  sub_count = max(1, min(int(sub_count), TEST_MRR_MAX_SUBSCRIPTIONS))
+  rng = random.Random(seed)
+  now = datetime.now(timezone.utc)
+  period_bounds = [_get_period_start_end("month", i) for i in range(11, -1, -1)]
+  intervals = [('month', 1), ('month', 3), ('year', 1), ('week', 2), ('day', 30), (None, 1)]
+  subs, paid_txns, state_changes = [], [], {}
+  for n in range(sub_count):
+    started_at = now - timedelta(days=rng.randint(0, 500), minutes=rng.randint(0, 1440)) if rng.random() > 0.05 else None
+    canceled_at = None
+    if started_at and rng.random() < 0.3:
+      canceled_at = started_at + timedelta(days=rng.randint(0, 400))
+    interval, frequency = rng.choice(intervals)
+    sub = {'id': f"[sub,{n}]", 'status': 'canceled' if canceled_at else rng.choice(['active', 'active', 'active', 'paused']),
+           'started_at': started_at, 'canceled_at': canceled_at,
+           'billing_cycle_interval': interval, 'billing_cycle_frequency': frequency}
+    subs.append(sub)
+    if started_at and rng.random() < 0.5:
+      # Active from started_at, then paused and resumed a few times, then canceled if it was
+      changes = [(started_at, 'active')]
+      end = canceled_at or now
+      for offset in sorted(rng.uniform(0, (end - started_at).total_seconds()) for _ in range(rng.randint(0, 4))):
+        changes.append((started_at + timedelta(seconds=offset), 'paused' if changes[-1][1] == 'active' else 'active'))
+      if canceled_at:
+        changes.append((canceled_at, 'canceled'))
+      state_changes[sub['id']] = changes
+      sub['status'] = changes[-1][1]
+    for _ in range(rng.randint(0, 6)):
+      billed_at = (started_at or now) + timedelta(days=rng.randint(-20, 450)) if rng.random() > 0.05 else None
+      earnings = f"{rng.uniform(1, 500):.2f}" if rng.random() > 0.05 else None
+      paid_txns.append((sub['id'], billed_at, earnings))
+
+  earnings_index = _build_paid_earnings_index(paid_txns)
+  # Intervals as record_subscription_state writes them: each change closes the previous one
+  active_intervals = {}
+  for sub_id, changes in state_changes.items():
+    bounds = [changed_at for changed_at, _ in changes[1:]] + [None]
+    active_intervals[sub_id] = [(changed_at, valid_to) for (changed_at, status), valid_to in zip(changes, bounds) if status == 'active']
+  mismatches = []
+  for source, expected, actual in (
+    ('columns', _reference_mrr_periods(subs, paid_txns, period_bounds), _compute_mrr_periods(subs, earnings_index, period_bounds)),
+    ('history', _reference_mrr_periods(subs, paid_txns, period_bounds, state_changes),
+     _compute_mrr_periods(subs, earnings_index, period_bounds, active_intervals=active_intervals))
+  ):
+    for idx, (exp, act) in enumerate(zip(expected, actual)):
+      for key, exp_value in exp.items():
+        if not math.isclose(exp_value, act[key], rel_tol=1e-9, abs_tol=1e-9):
+          mismatches.append({'source': source, 'period': period_bounds[idx][0].strftime("%Y-%m"), 'field': key, 'expected': exp_value, 'actual': act[key]})
+  return {"subscriptions": len(subs), "paid_transactions": len(paid_txns), "periods": len(period_bounds),
+          "subscriptions_with_history": len(state_changes),
+          "resumed_subscriptions": sum(1 for changes in state_changes.values() if [s for _, s in changes].count('active') > 1),
+          "mismatches": mismatches}
+
 # Report 3: Customer Churn Rate
 @anvil.server.callable(require_user=True)
+@cached_report('customer_churn')
 def get_customer_churn_data(period_type="monthly", periods=12):
     """
     Fetches data for the Customer Churn Rate report.
     NOTE: Calculation is simplified. Assumes churn based on cancellations within the period
           relative to active customers at the start. Needs refinement for accuracy.
+    Subscription state at each point in time comes from subs_state_history once
+    backfill_subscription_state_history has completed, and from the subs columns until then.
     """
+    use_history = ensure_backfill('backfill_subscription_state_history')
     results = []
     for i in range(periods - 1, -1, -1):
         start_dt, end_dt = _get_period_start_end(period_type, i)
         period_label = start_dt.strftime("%Y-%m") if period_type=="monthly" else start_dt.strftime("%Y-Q%q").replace('%q', str(math.ceil(start_dt.month/3)))
 
-        active_at_start_subs = app_tables.subs.search(
-            status='active',
-            started_at=q.less_than(start_dt),
-            canceled_at=q.any_of(None, q.greater_equal(start_dt))
-        )
-        starting_customers = {s['customer_id'].get_id() for s in active_at_start_subs if s['customer_id']}
-        starting_customer_count = len(starting_customers)
+        if use_history:
+            active_at_start_states = get_states_at(start_dt, status='active')
+            starting_customers = {s['customer'].get_id() for s in active_at_start_states if s['customer']}
 
-        canceled_in_period_subs = app_tables.subs.search(
-            canceled_at=q.between(start_dt, end_dt, min_inclusive=True, max_inclusive=False)
-        )
-        canceled_customers = {s['customer_id'].get_id() for s in canceled_in_period_subs if s['customer_id'] and s['customer_id'].get_id() in starting_customers}
+            canceled_in_period_states = get_state_entries_between('canceled', start_dt, end_dt)
+            canceled_customers = {s['customer'].get_id() for s in canceled_in_period_states if s['customer'] and s['customer'].get_id() in starting_customers}
+        else:
+            active_at_start_subs = app_tables.subs.search(
+                status='active',
+                started_at=q.less_than(start_dt),
+                canceled_at=q.any_of(None, q.greater_equal(start_dt))
+            )
+            starting_customers = {s['customer_id'].get_id() for s in active_at_start_subs if s['customer_id']}
+
+            canceled_in_period_subs = app_tables.subs.search(
+                canceled_at=q.between(start_dt, end_dt, min_inclusive=True, max_inclusive=False)
+            )
+            canceled_customers = {s['customer_id'].get_id() for s in canceled_in_period_subs if s['customer_id'] and s['customer_id'].get_id() in starting_customers}
+        starting_customer_count = len(starting_customers)
         canceled_customer_count = len(canceled_customers)
 
         churn_rate = (canceled_customer_count / starting_customer_count * 100) if starting_customer_count > 0 else 0
@@ -476,8 +638,31 @@ def get_paddle_item_performance_data():
     transformed_data_for_datagrid.append(new_item_dict)
 
   return transformed_data_for_datagrid
+
+def _last_paid_earnings_before(sub_row, end_dt, pointer_backfilled=True):
+  """
+    Earnings of the subscription's most recent paid/completed transaction billed before end_dt.
+    Reads the subs row's last_paid_* columns (kept by sm_last_paid_mod); only searches when
+    that transaction was billed at or after end_dt, or when the columns are empty and
+    backfill_last_paid_transactions has not completed yet. Returns None if there is none.
+    """
+  last_paid_billed_at = sub_row['last_paid_billed_at']
+  if last_paid_billed_at is None and pointer_backfilled:
+    return None
+  if last_paid_billed_at is not None and last_paid_billed_at < end_dt:
+    return sub_row['last_paid_earnings']
+  for txn_row in app_tables.transaction.search(
+    tables.order_by("billed_at", ascending=False),
+    subscription_id=sub_row,
+    status=q.any_of(*PAID_TRANSACTION_STATUSES),
+    billed_at=q.less_than(end_dt)
+  ):
+    return txn_row['details_totals_earnings']
+  return None
+
 # Report 5: Subscription Plan Performance
 @anvil.server.callable(require_user=True) # Or add specific permission check
+@cached_report('plan_performance')
 def get_subscription_plan_performance_data(period_type="monthly", periods=0, filter_group_id=None, filter_level_num=None):
   """
     Fetches performance data per subscription plan (Group/Level/Tier).
@@ -500,6 +685,7 @@ def get_subscription_plan_performance_data(period_type="monthly", periods=0, fil
 
   all_groups_list = list(app_tables.subscription_group.search())
   all_groups_map = {g.get_id(): g for g in all_groups_list}
+  last_paid_backfilled = ensure_backfill('backfill_last_paid_transactions', log_context)
 
   # --- Determine calculation mode ---
   is_snapshot = (periods == 0)
@@ -567,30 +753,20 @@ def get_subscription_plan_performance_data(period_type="monthly", periods=0, fil
 
         # Calculate MRR based on most recent 'paid'/'completed' transaction earnings
         if sub_row['tier_num'] and str(sub_row['tier_num']).upper().startswith('T') and int(str(sub_row['tier_num'])[1:]) > 1: # Assuming T1 is free
-          most_recent_paid_txn = app_tables.transaction.search(
-            tables.order_by("billed_at", ascending=False),
-            subscription_id=sub_row,
-            status=q.any_of('paid', 'completed'),
-            billed_at=q.less_than(current_period_end_dt) # Transaction must be within or before period end
-          )
-
-          if most_recent_paid_txn and len(most_recent_paid_txn) > 0:
-            latest_txn = most_recent_paid_txn[0]
-            # Use details_totals_earnings, assumed to be in system currency
-            earnings_minor_units = latest_txn['details_totals_earnings']
-
-            if earnings_minor_units is not None:
-              try:
-                earnings_amount = int(str(earnings_minor_units))
-                monthly_value = _normalize_price_to_monthly(
-                  earnings_amount, # Already in system currency (minor units)
-                  sub_row['billing_cycle_interval'],
-                  sub_row['billing_cycle_frequency']
-                )
-                plan_performance[glt_key]['estimated_mrr'] += monthly_value
-                period_total_mrr_for_trend += monthly_value
-              except (ValueError, TypeError) as e:
-                log("WARNING", module_name, function_name, f"Could not parse/normalize earnings for MRR. Sub: {sub_row['paddle_id']}, Txn: {latest_txn['paddle_id']}, Earnings: {earnings_minor_units}. Error: {e}", period_log_context)
+          earnings_minor_units = _last_paid_earnings_before(sub_row, current_period_end_dt, last_paid_backfilled)
+
+          if earnings_minor_units is not None:
+            try:
+              earnings_amount = int(str(earnings_minor_units))
+              monthly_value = _normalize_price_to_monthly(
+                earnings_amount, # Already in system currency (minor units)
+                sub_row['billing_cycle_interval'],
+                sub_row['billing_cycle_frequency']
+              )
+              plan_performance[glt_key]['estimated_mrr'] += monthly_value
+              period_total_mrr_for_trend += monthly_value
+            except (ValueError, TypeError) as e:
+              log("WARNING", module_name, function_name, f"Could not parse/normalize earnings for MRR. Sub: {sub_row['paddle_id']}, Earnings: {earnings_minor_units}. Error: {e}", period_log_context)
                 # else:
                 # log("DEBUG", module_name, function_name, f"No earnings found on latest paid transaction {latest_txn['paddle_id']} for sub {sub_row['paddle_id']}.", period_log_context)
                 # else:
@@ -653,113 +829,131 @@ def get_subscription_group_list():
 
 
 # Report 6: Review Transactions
-@anvil.server.callable(require_user=True)
-def get_all_transactions(start_date=None, end_date=None, status_filter=None, 
-                         sort_by=None, page_number=1, page_size=15):
-  """
-    Fetches a paginated and sorted list of transactions.
-    Returns a dictionary: {'items': [...], 'total_count': X}
-    """
-  # Basic permission check (can be enhanced with roles if needed)
-  # user = anvil.users.get_user()
-  # if not user:
-  #     raise anvil.server.PermissionDenied("You must be logged in to view transactions.")
-
-  query_args = [] # Use a list for query expressions for q.all_of / q.any_of if needed
-
-  # Date filtering
+# Date sorts page with an opaque keyset cursor instead of an offset: each page continues
+# from the last billed_at returned, so page 50 costs the same as page 1. The cursor also
+# holds the ids already returned at that billed_at, so rows sharing a timestamp across a
+# page boundary are neither repeated nor skipped. Rows without billed_at come last, paged
+# by offset. Other sorts keep page_number paging. Total counts are cached in report_cache
+# (invalidated by transaction webhooks) unless an exact count is requested.
+TRANSACTION_KEYSET_SORTS = {"billed_at_desc": False, "billed_at_asc": True} # sort_by -> ascending
+_TRANSACTION_OFFSET_SORTS = { # sort_by -> (column, ascending)
+  # 'details_totals_total' is a string column, so this is a string sort, not a numeric one
+  "total_desc": ("details_totals_total", False),
+  "total_asc": ("details_totals_total", True),
+  # Placeholder: sorts by the customer link (internal id), not email; needs a denormalized email column
+  "customer_email_asc": ("customer_id", True),
+  "customer_email_desc": ("customer_id", False),
+  "status_asc": ("status", True),
+  "status_desc": ("status", False),
+}
+
+def _transaction_filters(start_date, end_date, status_filter):
+  """Column -> list of query conditions for the transaction list filters."""
+  filters = {}
   if start_date:
     # Ensure start_date is datetime for comparison if billed_at includes time
     if isinstance(start_date, date) and not isinstance(start_date, datetime):
       start_date = datetime.combine(start_date, datetime.min.time(), tzinfo=timezone.utc)
-    query_args.append(q.billed_at >= start_date)
-
+    filters.setdefault('billed_at', []).append(q.greater_than_or_equal_to(start_date))
   if end_date:
     # Ensure end_date is datetime and represents end of day for inclusive range
     if isinstance(end_date, date) and not isinstance(end_date, datetime):
       end_date = datetime.combine(end_date, datetime.max.time(), tzinfo=timezone.utc)
-    query_args.append(q.billed_at <= end_date)
-
-    # Status filtering (case-insensitive if using q.ilike, direct match if not)
+    filters.setdefault('billed_at', []).append(q.less_than_or_equal_to(end_date))
   if status_filter and status_filter != "All Statuses": # Assuming "All Statuses" means no filter
-    # Using direct equality for status, assuming status values in DB match filter values
-    query_args.append(q.status == status_filter.lower()) # Match client's lowercase values
+    filters['status'] = [status_filter.lower()] # Match client's lowercase values
+  return filters
 
-    # Construct the final query using q.all_of if multiple conditions
-  final_query = None
-  if query_args:
-    final_query = q.all_of(*query_args)
+def _query_kwargs(filters):
+  return {column: conditions[0] if len(conditions) == 1 else q.all_of(*conditions) for column, conditions in filters.items()}
 
-    # Sorting
-  order_by_clause = None
-  if sort_by:
-    if sort_by == "billed_at_desc":
-      order_by_clause = tables.order_by("billed_at", ascending=False)
-    elif sort_by == "billed_at_asc":
-      order_by_clause = tables.order_by("billed_at", ascending=True)
-    elif sort_by == "total_desc":
-      # Sorting by 'details_totals_total' (string) directly might not be numerically correct.
-      # This requires fetching all, converting to number, then sorting, or storing as number.
-      # For simplicity now, we'll sort by the string representation, which is not ideal for numerics.
-      # A better solution would be to store 'details_totals_total' as a number if possible,
-      # or fetch all matching, convert, sort, then paginate in Python (less efficient for DB).
-      # For now, direct string sort:
-      order_by_clause = tables.order_by("details_totals_total", ascending=False)
-    elif sort_by == "total_asc":
-      order_by_clause = tables.order_by("details_totals_total", ascending=True)
-    elif sort_by == "customer_email_asc":
-      # Sorting by linked field requires a different approach or denormalization.
-      # For now, this won't work directly with tables.order_by on a linked field's attribute.
-      # We'll sort in Python after fetching for this, or skip if too complex for now.
-      # This example will sort by customer link's internal ID, not email.
-      # A proper solution involves denormalizing email or more complex query/post-processing.
-      # For now, let's sort by a field directly on the transaction table if possible, or omit this sort.
-      # To keep it simple and functional with direct DB sort, let's assume we sort by a direct field.
-      # If customer email sort is critical, it needs more advanced handling.
-      # For this iteration, we'll sort by customer_id (the link object itself, which sorts by internal ID)
-      order_by_clause = tables.order_by("customer_id", ascending=True) # Placeholder sort
-    elif sort_by == "customer_email_desc":
-      order_by_clause = tables.order_by("customer_id", ascending=False) # Placeholder sort
-    elif sort_by == "status_asc":
-      order_by_clause = tables.order_by("status", ascending=True)
-    elif sort_by == "status_desc":
-      order_by_clause = tables.order_by("status", ascending=False)
-    else: # Default sort
-      order_by_clause = tables.order_by("billed_at", ascending=False)
-  else: # Default sort if none provided
-    order_by_clause = tables.order_by("billed_at", ascending=False)
-
-    # Get total count for pagination before applying page limits
-  if final_query:
-    total_count = len(app_tables.transaction.search(final_query))
+@cached_report('transaction_count')
+def _count_transactions(start_date, end_date, status_filter):
+  return len(app_tables.transaction.search(**_query_kwargs(_transaction_filters(start_date, end_date, status_filter))))
+
+def _encode_transaction_cursor(state):
+  return base64.urlsafe_b64encode(json.dumps(state, sort_keys=True).encode("utf-8")).decode("ascii")
+
+def _decode_transaction_cursor(cursor, sort_by):
+  try:
+    state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+  except (ValueError, TypeError, AttributeError):
+    raise ValueError("Invalid transaction list cursor.")
+  if not isinstance(state, dict) or state.get('sort') != sort_by:
+    raise ValueError("Transaction list cursor does not match the requested sort.")
+  return state
+
+def _keyset_transaction_page(filters, sort_by, cursor_state, page_size):
+  """Returns (rows, next_cursor_state) for a billed_at sort; next_cursor_state is None on the last page."""
+  ascending = TRANSACTION_KEYSET_SORTS[sort_by]
+  state = cursor_state or {}
+  boundary = datetime.fromisoformat(state['billed_at']) if state.get('billed_at') else None
+  seen_ids = state.get('seen_ids', [])
+  null_offset = state.get('null_offset') # Set once the rows with billed_at are exhausted
+  rows = [] # Collects one row past the page to learn whether another page follows
+
+  if null_offset is None:
+    billed_conditions = filters.get('billed_at', []) + [q.not_(None)]
+    if boundary is not None:
+      billed_conditions.append(q.greater_than_or_equal_to(boundary) if ascending else q.less_than_or_equal_to(boundary))
+    seen = set(seen_ids)
+    for row in app_tables.transaction.search(tables.order_by("billed_at", ascending=ascending),
+                                             **_query_kwargs({**filters, 'billed_at': billed_conditions})):
+      if row['billed_at'] == boundary and row.get_id() in seen:
+        continue
+      rows.append(row)
+      if len(rows) > page_size:
+        break
+
+  if len(rows) <= page_size and 'billed_at' not in filters: # A date filter already excludes rows without billed_at
+    start = null_offset or 0
+    null_rows = app_tables.transaction.search(**_query_kwargs({**filters, 'billed_at': [None]}))
+    rows.extend(null_rows[start:start + page_size + 1 - len(rows)])
+
+  if len(rows) <= page_size:
+    return rows, None
+  rows = rows[:page_size]
+  last_billed_at = rows[-1]['billed_at']
+  if last_billed_at is None:
+    return rows, {'sort': sort_by, 'null_offset': (null_offset or 0) + sum(1 for r in rows if r['billed_at'] is None)}
+  tied_ids = [r.get_id() for r in rows if r['billed_at'] == last_billed_at]
+  if last_billed_at == boundary:
+    tied_ids += seen_ids
+  return rows, {'sort': sort_by, 'billed_at': last_billed_at.isoformat(), 'seen_ids': tied_ids}
+
+@anvil.server.callable(require_user=True)
+def get_all_transactions(start_date=None, end_date=None, status_filter=None, 
+                         sort_by=None, page_number=1, page_size=15, cursor=None, exact_count=False):
+  """
+    Fetches a page of transactions.
+    For date sorts pass the previous response's 'next_cursor' as cursor (None for the first page);
+    other sorts use page_number. total_count is cached unless exact_count is True.
+    Returns a dictionary: {'items': [...], 'total_count': X, 'total_count_exact': bool, 'next_cursor': str or None}
+    """
+  # Basic permission check (can be enhanced with roles if needed)
+  # user = anvil.users.get_user()
+  # if not user:
+  #     raise anvil.server.PermissionDenied("You must be logged in to view transactions.")
+
+  filters = _transaction_filters(start_date, end_date, status_filter)
+
+  if exact_count:
+    total_count = len(app_tables.transaction.search(**_query_kwargs(filters)))
   else:
-    total_count = len(app_tables.transaction.search())
-
-    # Fetch paginated results
-    # Anvil's search doesn't directly support offset for q.fetch_only with complex queries easily.
-    # A common pattern is to fetch IDs first if performance is an issue, or fetch a limited set.
-    # For robust pagination with sorting, it's often best to let the database handle it if possible.
-    # Anvil's simple search with `limit` and then slicing is not true DB pagination.
-    # However, for `RepeatingPanel` and typical Anvil use, fetching all matching rows
-    # (that match filters) and then slicing in Python for the current page is common
-    # if the total number of filtered items isn't excessively large (e.g., many tens of thousands).
-    # If it is, a more advanced pagination strategy is needed.
-
-    # Let's try a slice-based approach after sorting, assuming filtered results are manageable.
-  if final_query:
-    if order_by_clause:
-      all_matching_transactions = app_tables.transaction.search(final_query, order_by_clause)
-    else:
-      all_matching_transactions = app_tables.transaction.search(final_query)
+    total_count = _count_transactions(start_date, end_date, status_filter)
+
+  next_cursor = None
+  if sort_by in _TRANSACTION_OFFSET_SORTS:
+    sort_column, ascending = _TRANSACTION_OFFSET_SORTS[sort_by]
+    all_matching_transactions = app_tables.transaction.search(tables.order_by(sort_column, ascending=ascending), **_query_kwargs(filters))
+    start_index = (page_number - 1) * page_size
+    end_index = start_index + page_size
+    paginated_transactions = list(all_matching_transactions[start_index:end_index])
   else:
-    if order_by_clause:
-      all_matching_transactions = app_tables.transaction.search(order_by_clause)
-    else:
-      all_matching_transactions = app_tables.transaction.search()
-
-  start_index = (page_number - 1) * page_size
-  end_index = start_index + page_size
-  paginated_transactions = list(all_matching_transactions[start_index:end_index])
+    sort_by = sort_by if sort_by in TRANSACTION_KEYSET_SORTS else "billed_at_desc" # Default sort
+    cursor_state = _decode_transaction_cursor(cursor, sort_by) if cursor else None
+    paginated_transactions, next_state = _keyset_transaction_page(filters, sort_by, cursor_state, page_size)
+    next_cursor = _encode_transaction_cursor(next_state) if next_state else None
 
   results = []
   for t in paginated_transactions:
@@ -780,7 +974,7 @@ def get_all_transactions(start_date=None, end_date=None, status_filter=None,
       'collection_mode': t.get('collection_mode'),
     })
 
-  return {'items': results, 'total_count': total_count}
+  return {'items': results, 'total_count': total_count, 'total_count_exact': bool(exact_count), 'next_cursor': next_cursor}
 
 # Report 7: View a Transaction
 @anvil.server.callable(require_user=True)
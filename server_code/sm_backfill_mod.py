@@ -0,0 +1,45 @@
+# Server Module: sm_backfill_mod.py
+# Records which one-off data backfills have finished, as one value_bool row per backfill
+# task in app_settings. A report only reads a rollup or history table once the table's
+# backfill has finished. Until then it falls back to its original scan and starts the
+# backfill itself through ensure_backfill.
+
+import anvil.server
+from anvil.tables import app_tables
+from .sm_logs_mod import log
+
+BACKFILL_SETTING_PREFIX = "backfill_complete:"
+
+
+def is_backfill_complete(task_name):
+  """True once the background task task_name has run to completion."""
+  setting = app_tables.app_settings.get(setting_name=BACKFILL_SETTING_PREFIX + task_name)
+  return bool(setting and setting['value_bool'])
+
+
+def mark_backfill_complete(task_name):
+  """Called by a backfill task as its last step."""
+  setting_name = BACKFILL_SETTING_PREFIX + task_name
+  setting = app_tables.app_settings.get(setting_name=setting_name)
+  if setting:
+    setting['value_bool'] = True
+  else:
+    app_tables.app_settings.add_row(setting_name=setting_name, value_bool=True)
+
+
+def ensure_backfill(task_name, log_context=None):
+  """
+    Returns True if task_name has completed. Otherwise launches it, unless it is already
+    running, and returns False so the caller uses its fallback. Never raises.
+    """
+  try:
+    if is_backfill_complete(task_name):
+      return True
+    for task in anvil.server.list_background_tasks():
+      if task.get_task_name() == task_name and task.is_running():
+        return False
+    anvil.server.launch_background_task(task_name)
+    log("INFO", "sm_backfill_mod", "ensure_backfill", f"Launched {task_name}; reports use their fallback until it completes.", log_context)
+  except Exception as e:
+    log("ERROR", "sm_backfill_mod", "ensure_backfill", f"Could not check or launch {task_name}.", {**(log_context or {}), "error": str(e)})
+  return False
@@ -11,6 +11,7 @@ import traceback # For logging detailed errors
 import json # For custom_data handling
 import dateutil.parser #
 from .sm_logs_mod import log # Assuming this path is correct
+from .sm_id_mod import generate_id
 from .sessions_server import is_admin_user, is_owner_user # For permission checks
 from .paddle_api_client import create_paddle_discount, update_paddle_discount # To be created/confirmed
 
@@ -347,11 +348,7 @@ def save_mybizz_discount(discount_data_from_client):
         validated_db_data, paddle_payload_parts = _validate_discount_data_for_save(discount_data_from_client, is_update=False)
         
         # Generate MyBizz PK
-        timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-        mybizz_pk = f"DSC-{timestamp_str}"
-        while app_tables.discount.get(discount_id=mybizz_pk): # Ensure uniqueness
-            timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-            mybizz_pk = f"DSC-{timestamp_str}"
+        mybizz_pk = generate_id("DSC")
         validated_db_data['discount_id'] = mybizz_pk
         
         # Add Anvil timestamps
@@ -0,0 +1,99 @@
+# Server Module: sm_id_mod.py
+# Generates MyBizz primary keys (TRN-..., CUS-..., PRC-...) without probing the database.
+
+import anvil.server
+import secrets
+import threading
+import time
+from .sessions_server import is_admin_user
+
+# --- Constants ---
+# Crockford base32, as used by ULIDs: sortable and free of ambiguous characters (I, L, O, U).
+_CROCKFORD_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_NODE_BITS = 32
+_COUNTER_BITS = 48
+_ID_LENGTH = 26 # 48-bit ms timestamp + 32-bit node + 48-bit counter = 128 bits
+
+# --- Per-Process Generator State ---
+# Each server process picks a random node id once. The counter starts at a random value
+# and is incremented for every id, so ids from one process never repeat and ids from
+# different processes only collide if both the node id and the counter line up.
+_id_lock = threading.Lock()
+_node_id = secrets.randbits(_NODE_BITS)
+_counter = secrets.randbits(_COUNTER_BITS)
+_last_timestamp_ms = 0
+
+
+def _encode_crockford(value, length):
+  """Encodes a non-negative integer as fixed-length Crockford base32."""
+  chars = []
+  for _ in range(length):
+    chars.append(_CROCKFORD_ALPHABET[value & 31])
+    value >>= 5
+  return "".join(reversed(chars))
+
+
+def new_ulid():
+  """
+    Returns a 26-character, ULID-style identifier that is unique and strictly
+    increasing within this process, even if the system clock steps backwards.
+    """
+  global _counter, _last_timestamp_ms
+  with _id_lock:
+    # Never let the timestamp go backwards, so ids keep sorting in creation order
+    timestamp_ms = max(int(time.time() * 1000), _last_timestamp_ms)
+    _counter = (_counter + 1) % (1 << _COUNTER_BITS)
+    if _counter == 0: # Counter wrapped; move to the next millisecond to stay monotonic
+      timestamp_ms += 1
+    _last_timestamp_ms = timestamp_ms
+    value = (timestamp_ms << (_NODE_BITS + _COUNTER_BITS)) | (_node_id << _COUNTER_BITS) | _counter
+  return _encode_crockford(value, _ID_LENGTH)
+
+
+def generate_id(prefix, suffix=None):
+  """
+    Builds a MyBizz primary key such as 'TRN-01HZX3...-txn_01hz'.
+    The optional suffix (usually the first 8 characters of the Paddle id) is for readability only.
+    """
+  generated_id = f"{prefix}-{new_ulid()}"
+  return f"{generated_id}-{suffix}" if suffix else generated_id
+
+
+# --- Test Function ---
+TEST_MAX_THREADS = 16
+TEST_MAX_IDS_PER_THREAD = 20000
+
+@anvil.server.callable
+def test_id_generation_concurrency(thread_count=8, ids_per_thread=5000):
+  """
+    Stress test: generates ids from several threads at once and checks that none
+    repeat and that each thread saw strictly increasing ids.
+    Requires admin privileges; both arguments are clamped to the TEST_MAX_* limits.
+    """
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Administrator privileges required.")
+  thread_count = max(1, min(int(thread_count), TEST_MAX_THREADS))
+  ids_per_thread = max(1, min(int(ids_per_thread), TEST_MAX_IDS_PER_THREAD))
+  results = [None] * thread_count
+
+  def worker(index):
+    results[index] = [generate_id("TST") for _ in range(ids_per_thread)]
+
+  threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+  all_ids = [generated for thread_ids in results for generated in thread_ids]
+  unique_count = len(set(all_ids))
+  monotonic = all(
+    all(a < b for a, b in zip(thread_ids, thread_ids[1:]))
+    for thread_ids in results
+  )
+  return {
+    "generated": len(all_ids),
+    "unique": unique_count,
+    "duplicates": len(all_ids) - unique_count,
+    "monotonic_per_thread": monotonic
+  }
@@ -13,6 +13,7 @@ import traceback # For detailed error logging
 
 # Import RBAC functions (adjust path if necessary)
 from .sessions_server import is_admin_user, is_owner_user
+from .sm_id_mod import generate_id
 
 # Import Paddle API client functions (adjust path if necessary)
 from .paddle_api_client import create_paddle_product, update_paddle_product
@@ -219,10 +220,7 @@ def create_item(item_data):
   except (ValueError, TypeError) as e:
     raise ValueError(f"Invalid input data: {e}")
 
-  timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-  item_id = f"ITM-{timestamp_str}"
-  if app_tables.items.get(item_id=item_id):
-    raise Exception("Failed to generate unique item ID.")
+  item_id = generate_id("ITM")
 
   new_item = None
   try:
@@ -0,0 +1,137 @@
+# Server Module: sm_last_paid_mod.py
+# Keeps each subs row's "latest paid transaction" columns (last_paid_transaction,
+# last_paid_earnings, last_paid_billed_at) current, so reports read a subscription's
+# most recent paid earnings from the row instead of an ordered transaction search.
+# _process_transaction calls apply_last_paid_transaction after every upsert;
+# backfill_last_paid_transactions fills the columns for existing data. Until it has
+# completed, empty columns do not mean "no paid transaction" (see sm_backfill_mod).
+
+import anvil.server
+import anvil.users
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import traceback
+from .sm_logs_mod import log, buffered_logging
+from .sessions_server import is_admin_user
+from .sm_report_cache_mod import invalidate_reports_for
+from .sm_backfill_mod import mark_backfill_complete
+
+# Paddle moves a settled transaction from 'paid' to 'completed' on the same row
+PAID_TRANSACTION_STATUSES = ('paid', 'completed')
+
+
+def _is_paid(txn_values):
+  return bool(txn_values) and txn_values.get('status') in PAID_TRANSACTION_STATUSES and txn_values.get('billed_at') is not None
+
+
+def _last_paid_columns(txn_row):
+  """Column values for subs pointing at txn_row (or clearing the pointer if None)."""
+  if txn_row is None:
+    return {'last_paid_transaction': None, 'last_paid_earnings': None, 'last_paid_billed_at': None}
+  return {
+    'last_paid_transaction': txn_row,
+    'last_paid_earnings': txn_row['details_totals_earnings'],
+    'last_paid_billed_at': txn_row['billed_at']
+  }
+
+
+def find_last_paid_transaction(sub_row):
+  """The subscription's most recent paid/completed transaction, by billed_at, or None."""
+  for txn_row in app_tables.transaction.search(
+    tables.order_by("billed_at", ascending=False),
+    subscription_id=sub_row,
+    status=q.any_of(*PAID_TRANSACTION_STATUSES),
+    billed_at=q.not_(None)
+  ):
+    return txn_row
+  return None
+
+
+def _refresh_last_paid_transaction(sub_row):
+  """Recomputes the pointer columns for one subscription with a single ordered search."""
+  sub_row.update(**_last_paid_columns(find_last_paid_transaction(sub_row)))
+
+
+@tables.in_transaction # Retries on conflict: two transactions for one subscription can land together
+def apply_last_paid_transaction(txn_row, previous_values=None):
+  """
+    Updates the pointer on the transaction's subscription after an upsert.
+    previous_values holds the transaction's values before the update (empty for a new row).
+    Moves the pointer forward when this transaction is a newer paid one, and recomputes it
+    when the transaction it points at stops being paid, moves back in time or changes subscription.
+    """
+  previous_values = previous_values or {}
+  txn_row = app_tables.transaction.get_by_id(txn_row.get_id())
+  if txn_row is None:
+    return
+  current_sub = txn_row['subscription_id']
+  previous_sub = previous_values.get('subscription_id')
+
+  if previous_sub is not None and (current_sub is None or previous_sub.get_id() != current_sub.get_id()):
+    previous_sub = app_tables.subs.get_by_id(previous_sub.get_id())
+    if previous_sub is not None and previous_sub['last_paid_transaction'] == txn_row:
+      _refresh_last_paid_transaction(previous_sub)
+
+  if current_sub is None:
+    return
+  current_sub = app_tables.subs.get_by_id(current_sub.get_id())
+  if current_sub is None:
+    return
+
+  points_here = current_sub['last_paid_transaction'] == txn_row
+  if _is_paid(dict(txn_row)):
+    pointer_billed_at = current_sub['last_paid_billed_at']
+    if points_here and pointer_billed_at is not None and txn_row['billed_at'] < pointer_billed_at:
+      _refresh_last_paid_transaction(current_sub) # billed_at moved back; an older paid transaction may now be latest
+    elif points_here or pointer_billed_at is None or txn_row['billed_at'] >= pointer_billed_at:
+      current_sub.update(**_last_paid_columns(txn_row))
+  elif points_here:
+    _refresh_last_paid_transaction(current_sub)
+
+
+@anvil.server.callable(require_user=True)
+def start_last_paid_backfill():
+  """Launches backfill_last_paid_transactions. Requires admin privileges."""
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Admin privileges required.")
+  log("INFO", "sm_last_paid_mod", "start_last_paid_backfill", "Last paid transaction backfill launched.",
+      {"user_email": anvil.users.get_user()['email']})
+  return anvil.server.launch_background_task('backfill_last_paid_transactions')
+
+
+@anvil.server.background_task
+@buffered_logging
+def backfill_last_paid_transactions():
+  """
+    Sets the pointer columns on every subscription from one pass over paid transactions.
+    Subscriptions without a paid transaction are cleared.
+    """
+  module_name = "sm_last_paid_mod"
+  function_name = "backfill_last_paid_transactions"
+  log("INFO", module_name, function_name, "Last paid transaction backfill started.")
+  try:
+    latest_by_sub = {}
+    for txn_row in app_tables.transaction.search(status=q.any_of(*PAID_TRANSACTION_STATUSES)):
+      sub_row = txn_row['subscription_id']
+      if sub_row is None or txn_row['billed_at'] is None:
+        continue
+      latest = latest_by_sub.get(sub_row.get_id())
+      if latest is None or txn_row['billed_at'] >= latest['billed_at']:
+        latest_by_sub[sub_row.get_id()] = txn_row
+
+    updated = 0
+    for sub_row in app_tables.subs.search():
+      columns = _last_paid_columns(latest_by_sub.get(sub_row.get_id()))
+      if any(sub_row[k] != v for k, v in columns.items()):
+        sub_row.update(**columns)
+        updated += 1
+        if updated % 200 == 0:
+          anvil.server.task_state['updated'] = updated
+    anvil.server.task_state['updated'] = updated
+    mark_backfill_complete('backfill_last_paid_transactions')
+    invalidate_reports_for('transaction')
+    log("INFO", module_name, function_name, f"Last paid transaction backfill finished. {updated} subscriptions updated.")
+  except Exception as e:
+    log("CRITICAL", module_name, function_name, f"Last paid transaction backfill failed: {str(e)}", {"trace": traceback.format_exc()})
+    raise
@@ -3,9 +3,13 @@
 import anvil.server
 import anvil.users
 import anvil.tables as tables
+import anvil.tables.query as q
 from anvil.tables import app_tables
 from datetime import datetime
+import functools
 import json
+import threading
+import time
 import traceback
 
 
@@ -18,20 +22,58 @@ LOG_LEVELS = {
     'DEBUG': 0, 'INFO': 1, 'WARNING': 2, 'ERROR': 3, 'CRITICAL': 4
 }
 
-# --- Core Logging Functions ---
+# How long the in-process snapshot of the logging settings stays valid.
+LOG_SETTINGS_CACHE_TTL_SECONDS = 30
 
-def _get_min_log_level():
-    """Retrieves the minimum log level setting from app_settings."""
+# --- Logging Settings Snapshot ---
+# log() is called dozens of times per webhook, so the log level and debug mode are
+# read together in one query and reused until the TTL expires or a setter refreshes them.
+_log_settings_snapshot = None
+_log_settings_loaded_at = 0.0
+_log_settings_measure = threading.local() # Per-thread read count and snapshot bypass for measure_log_settings_reads
+
+def _load_log_settings():
+    """Reads the log level and debug mode settings from app_settings in a single query."""
+    _log_settings_measure.reads = getattr(_log_settings_measure, 'reads', 0) + 1
+    settings = {'log_level': DEFAULT_LOG_LEVEL, 'debug_mode': False}
     try:
-        min_level_setting = app_tables.app_settings.get(setting_name=LOG_LEVEL_SETTING_NAME)
-        level = min_level_setting['value_text'] if min_level_setting and min_level_setting['value_text'] else DEFAULT_LOG_LEVEL
-        if level not in LOG_LEVELS:
-            print(f"WARNING: Invalid log level '{level}' found in settings. Defaulting to {DEFAULT_LOG_LEVEL}.")
-            return DEFAULT_LOG_LEVEL
-        return level
+        rows = app_tables.app_settings.search(
+            setting_name=q.any_of(LOG_LEVEL_SETTING_NAME, DEBUG_MODE_SETTING_NAME)
+        )
+        for row in rows:
+            if row['setting_name'] == LOG_LEVEL_SETTING_NAME:
+                level = row['value_text'] or DEFAULT_LOG_LEVEL
+                if level not in LOG_LEVELS:
+                    print(f"WARNING: Invalid log level '{level}' found in settings. Defaulting to {DEFAULT_LOG_LEVEL}.")
+                    level = DEFAULT_LOG_LEVEL
+                settings['log_level'] = level
+            elif row['setting_name'] == DEBUG_MODE_SETTING_NAME:
+                # Ensure we check the boolean field correctly
+                settings['debug_mode'] = row['value_bool'] if row['value_bool'] is not None else False
     except Exception as e:
-        print(f"ERROR: Failed to retrieve log level setting: {e}. Defaulting to {DEFAULT_LOG_LEVEL}.")
-        return DEFAULT_LOG_LEVEL
+        print(f"ERROR: Failed to retrieve logging settings: {e}. Defaulting to {DEFAULT_LOG_LEVEL} and debug mode off.")
+    return settings
+
+def refresh_log_settings():
+    """Reloads the logging settings snapshot immediately. Call after changing log_level or DEBUG_MODE."""
+    global _log_settings_snapshot, _log_settings_loaded_at
+    _log_settings_snapshot = _load_log_settings()
+    _log_settings_loaded_at = time.monotonic()
+    return _log_settings_snapshot
+
+def _get_log_settings():
+    """Returns the cached logging settings, reloading them once the TTL has expired."""
+    if getattr(_log_settings_measure, 'bypass_snapshot', False):
+        return _load_log_settings()
+    if _log_settings_snapshot is None or time.monotonic() - _log_settings_loaded_at > LOG_SETTINGS_CACHE_TTL_SECONDS:
+        return refresh_log_settings()
+    return _log_settings_snapshot
+
+# --- Core Logging Functions ---
+
+def _get_min_log_level():
+    """Retrieves the minimum log level setting from the settings snapshot."""
+    return _get_log_settings()['log_level']
 
 def _should_log(level):
     """Determines if a message at a given level should be logged based on settings."""
@@ -42,39 +84,87 @@ def _should_log(level):
     return LOG_LEVELS[level] >= LOG_LEVELS[min_level]
 
 def _get_debug_mode():
-    """Checks if debug mode (console logging) is enabled in settings."""
-    try:
-        debug_setting = app_tables.app_settings.get(setting_name=DEBUG_MODE_SETTING_NAME)
-        # Ensure we check the boolean field correctly
-        return debug_setting['value_bool'] if debug_setting and debug_setting['value_bool'] is not None else False
-    except Exception as e:
-        print(f"ERROR: Failed to retrieve debug mode setting: {e}. Defaulting to False.")
-        return False
+    """Checks if debug mode (console logging) is enabled in the settings snapshot."""
+    return _get_log_settings()['debug_mode']
 
 def _create_log_entry_string(level, module, process, message, context_str):
     """Creates a formatted log entry string."""
     timestamp = datetime.now().isoformat() # Use ISO format for better parsing
     return f"{timestamp} - {level} - {module} - {process} - {message} - Context: {context_str}"
 
-def _write_to_log_table(level, module, process, message, context_str, concatenated_str):
-    """Writes the prepared log entry to the database table."""
+# --- Buffered Log Writing ---
+# Inside a buffered_logging scope (a server call or background task), log rows are
+# collected in memory and written with one add_rows call instead of one add_row each.
+LOG_BUFFER_FLUSH_SIZE = 50 # Flush early once this many entries are waiting
+_log_buffer_state = threading.local()
+
+def _get_log_buffer():
+    """Returns the active log buffer for this thread, or None outside a buffered_logging scope."""
+    return getattr(_log_buffer_state, 'entries', None)
+
+def _write_log_rows(entries):
+    """Writes prepared log entries to the logs table in one call, falling back to the console."""
     try:
-        app_tables.logs.add_row(
-            timestamp=datetime.now(), # Use consistent timestamp
-            level=level,
-            module=module,
-            process=process,
-            message=message, # Store potentially long message with traceback here
-            context=context_str, # Store JSON context string
-            concatenated=concatenated_str # Store the formatted string
-        )
+        if len(entries) == 1:
+            app_tables.logs.add_row(**entries[0])
+        else:
+            app_tables.logs.add_rows(entries)
     except Exception as e:
         # Log failure to console - critical if logging itself fails
-        print("CRITICAL: Failed to write log entry to database!")
-        print(f"Log Details: Level={level}, Module={module}, Process={process}")
+        print(f"CRITICAL: Failed to write {len(entries)} log entries to database!")
         print(f"Error: {e}")
+        for entry in entries:
+            print(entry['concatenated'])
         # Avoid infinite loop if DB is down - don't try to log this failure to DB
 
+def flush_log_buffer():
+    """Writes any buffered log entries for this thread. Returns the number of entries written."""
+    entries = _get_log_buffer()
+    if not entries:
+        return 0
+    _log_buffer_state.entries = []
+    _write_log_rows(entries)
+    return len(entries)
+
+def buffered_logging(func):
+    """
+    Decorator that buffers log() writes for the duration of a server function or
+    background task and flushes them in bulk when it returns or raises.
+    Place it below @anvil.server.callable / http_endpoint / background_task.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _get_log_buffer() is not None: # Already inside a buffered scope; the outermost one flushes
+            return func(*args, **kwargs)
+        _log_buffer_state.entries = []
+        try:
+            return func(*args, **kwargs)
+        finally:
+            flush_log_buffer()
+            _log_buffer_state.entries = None
+    return wrapper
+
+def _write_to_log_table(level, module, process, message, context_str, concatenated_str):
+    """Writes the prepared log entry to the database table, or to the buffer if one is active."""
+    entry = {
+        'timestamp': datetime.now(), # Use consistent timestamp
+        'level': level,
+        'module': module,
+        'process': process,
+        'message': message, # Store potentially long message with traceback here
+        'context': context_str, # Store JSON context string
+        'concatenated': concatenated_str # Store the formatted string
+    }
+    entries = _get_log_buffer()
+    if entries is None:
+        _write_log_rows([entry])
+        return
+
+    entries.append(entry)
+    # CRITICAL entries are written straight away so they survive a crash later in the request
+    if level == 'CRITICAL' or len(entries) >= LOG_BUFFER_FLUSH_SIZE:
+        flush_log_buffer()
+
 @anvil.server.callable
 def log(level, module, process, message, context=None):
     """
@@ -232,6 +322,7 @@ def update_setting_value(setting_name, value):
             raise TypeError(f"Unsupported value type for setting: {type(value)}")
 
         setting.update(**update_dict)
+        refresh_log_settings() # Pick up a changed log_level/DEBUG_MODE without waiting for the TTL
         log("INFO", "sm_logs_mod", "update_setting_value", f"Successfully updated setting '{setting_name}' to {log_value_type} value.",
             {"user": anvil.users.get_user()['email'] if anvil.users.get_user() else "N/A", "new_value": value})
         return True
@@ -261,6 +352,21 @@ def test_server_logging():
     log("CRITICAL", "sm_logs_mod", "test_server_logging", "Critical test message.")
     return True
 
+def measure_log_settings_reads(func, use_snapshot=True):
+    """
+    Calls func() and returns (result, app_settings reads made for logging settings on this
+    thread while it ran). With use_snapshot=False every log() call on this thread reads the
+    settings itself, as before the snapshot existed: once to check the level and once more
+    for DEBUG_MODE when the line is written. Other threads keep using the snapshot.
+    """
+    _log_settings_measure.reads = 0
+    _log_settings_measure.bypass_snapshot = not use_snapshot
+    try:
+        result = func()
+    finally:
+        _log_settings_measure.bypass_snapshot = False
+    return result, _log_settings_measure.reads
+
 @anvil.server.callable
 def get_all_logs_concatenated():
     # ... (import and permission check as before) ...
@@ -330,6 +436,7 @@ def set_log_level(new_level):
             )
             log("INFO", "sm_logs_mod", "set_log_level", f"Log level successfully created and set to {new_level}", {"user": requesting_user_email})
 
+        refresh_log_settings() # Apply the new level to this process immediately
         return True # Indicate success in either case
 
     except Exception as e:
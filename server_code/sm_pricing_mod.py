@@ -12,6 +12,7 @@ import traceback
 
 # Import RBAC functions (adjust path if necessary)
 from .sessions_server import is_admin_user, is_owner_user
+from .sm_id_mod import generate_id
 
 # Import Paddle API client functions (adjust path if necessary)
 from .paddle_api_client import create_paddle_price, update_paddle_price
@@ -350,10 +351,7 @@ def create_price(price_data):
     except (ValueError, TypeError) as e:
         raise ValueError(f"Invalid input data: {e}")
 
-    timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-    price_id = f"PRC-{timestamp_str}"
-    if app_tables.prices.get(price_id=price_id):
-         raise Exception("Failed to generate unique price ID.")
+    price_id = generate_id("PRC")
 
     new_price = None
     try:
@@ -498,10 +496,7 @@ def create_price_override(override_data):
     except (ValueError, TypeError) as e: 
       raise ValueError(f"Invalid input data: {e}")
 
-    timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-    override_id = f"OVR-{timestamp_str}"
-    if app_tables.price_unit_price_overrides.get(id=override_id): 
-      raise Exception("Failed to generate unique override ID.")
+    override_id = generate_id("OVR")
 
     new_override = None
     parent_price_row = validated_data['price_id']
@@ -0,0 +1,168 @@
+# Server Module: sm_report_cache_mod.py
+# Table-backed cache for report results, shared by every server instance.
+# Report functions are wrapped with @cached_report(report_name); results are stored in
+# report_cache keyed by report name and arguments. Once a webhook's processing has finished,
+# _process_received_webhook (or the retry path) calls invalidate_reports_for('transaction' /
+# 'subscription'), which drops the affected reports. A report that is already invalidated,
+# with no computation started since, is left alone, so a burst of webhooks does not rewrite
+# the same report_cache_state rows. Entries also expire after REPORT_CACHE_TTL_MINUTES,
+# since the reports' periods are relative to "now".
+
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import functools
+import inspect
+import json
+from datetime import datetime, date, timezone, timedelta
+from .sm_logs_mod import log
+
+REPORT_CACHE_TTL_MINUTES = 60
+
+# Which cached reports read which kind of webhook data
+REPORTS_AFFECTED_BY = {
+  'transaction': ('revenue_trend', 'subscription_mrr', 'plan_performance', 'transaction_count'),
+  'subscription': ('subscription_mrr', 'customer_churn', 'plan_performance'),
+}
+
+
+def _encode(value):
+  """Makes a report result JSON-safe for a simpleObject column; datetimes/dates are tagged."""
+  if isinstance(value, datetime):
+    return {'__datetime__': value.isoformat()}
+  if isinstance(value, date):
+    return {'__date__': value.isoformat()}
+  if isinstance(value, dict):
+    return {str(k): _encode(v) for k, v in value.items()}
+  if isinstance(value, (list, tuple)):
+    return [_encode(v) for v in value]
+  return value
+
+
+def _decode(value):
+  if isinstance(value, dict):
+    if '__datetime__' in value:
+      return datetime.fromisoformat(value['__datetime__'])
+    if '__date__' in value:
+      return date.fromisoformat(value['__date__'])
+    return {k: _decode(v) for k, v in value.items()}
+  if isinstance(value, list):
+    return [_decode(v) for v in value]
+  return value
+
+
+def _cache_key(report_name, func, args, kwargs):
+  """report_name plus the call's arguments, with defaults applied so equivalent calls share a key."""
+  bound = inspect.signature(func).bind(*args, **kwargs)
+  bound.apply_defaults()
+  return f"{report_name}:{json.dumps(bound.arguments, sort_keys=True, default=str)}"
+
+
+def _read_cached(cache_key, now):
+  row = app_tables.report_cache.get(cache_key=cache_key)
+  if row is None or (row['expires_at'] and row['expires_at'] <= now):
+    return None
+  return row
+
+
+@tables.in_transaction
+def _write_cached(report_name, cache_key, result, computation_started_at):
+  """Stores result unless the report was invalidated while it was being computed."""
+  state_row = app_tables.report_cache_state.get(report_name=report_name)
+  if state_row and state_row['invalidated_at'] and state_row['invalidated_at'] >= computation_started_at:
+    return
+  now = datetime.now(timezone.utc)
+  app_tables.report_cache.search(cache_key=cache_key).delete_all_rows()
+  app_tables.report_cache.add_row(
+    cache_key=cache_key,
+    report_name=report_name,
+    result=_encode(result),
+    computed_at=now,
+    expires_at=now + timedelta(minutes=REPORT_CACHE_TTL_MINUTES)
+  )
+
+
+@tables.in_transaction
+def _mark_computation_started(report_name, started_at):
+  """Records that report_name is being computed, so the next invalidation is not skipped."""
+  state_row = app_tables.report_cache_state.get(report_name=report_name)
+  if state_row is None:
+    app_tables.report_cache_state.add_row(report_name=report_name, computation_started_at=started_at)
+  elif state_row['computation_started_at'] is None or state_row['computation_started_at'] < started_at:
+    state_row['computation_started_at'] = started_at
+
+
+def cached_report(report_name):
+  """Decorator serving a report function's result from report_cache when one is stored."""
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      started_at = datetime.now(timezone.utc)
+      try:
+        cache_key = _cache_key(report_name, func, args, kwargs)
+        row = _read_cached(cache_key, started_at)
+        if row is not None:
+          return _decode(row['result'])
+        _mark_computation_started(report_name, started_at)
+      except Exception as e:
+        log("WARNING", "sm_report_cache_mod", "cached_report", f"Report cache read failed for {report_name}; computing directly.", {"error": str(e)})
+        return func(*args, **kwargs)
+
+      result = func(*args, **kwargs)
+      try:
+        _write_cached(report_name, cache_key, result, started_at)
+      except Exception as e:
+        log("WARNING", "sm_report_cache_mod", "cached_report", f"Report cache write failed for {report_name}.", {"error": str(e)})
+      return result
+    return wrapper
+  return decorator
+
+
+def _is_invalidated(state_row):
+  """
+    True if the report was invalidated and no computation has started since. Invalidation
+    deletes every cached row, and only a computation started after it may store a new one.
+    """
+  if state_row is None or state_row['invalidated_at'] is None:
+    return False
+  computation_started_at = state_row['computation_started_at']
+  return computation_started_at is None or computation_started_at <= state_row['invalidated_at']
+
+
+@tables.in_transaction
+def invalidate_report_cache(report_names=None):
+  """
+    Drops cached results for report_names (all reports if None) and marks them invalidated now.
+    Reports that are already invalidated are skipped.
+    """
+  now = datetime.now(timezone.utc)
+  if report_names is None:
+    report_names = sorted({name for names in REPORTS_AFFECTED_BY.values() for name in names})
+  state_rows = {name: app_tables.report_cache_state.get(report_name=name) for name in report_names}
+  stale_names = [name for name, state_row in state_rows.items() if not _is_invalidated(state_row)]
+  if not stale_names:
+    return
+  app_tables.report_cache.search(report_name=q.any_of(*stale_names)).delete_all_rows()
+  for report_name in stale_names:
+    state_row = state_rows[report_name]
+    if state_row:
+      state_row['invalidated_at'] = now
+    else:
+      app_tables.report_cache_state.add_row(report_name=report_name, invalidated_at=now)
+
+
+def invalidate_reports_for(change_kind, log_context=None):
+  """
+    Invalidates the reports that read change_kind data. Call once an event's processing has
+    finished, not from inside it. Never raises; a failure is logged.
+    """
+  try:
+    report_names = REPORTS_AFFECTED_BY[change_kind]
+    # Checked outside a transaction first: usually every report is still invalidated from
+    # the previous webhook, and a read-only check does not conflict with other workers
+    if all(_is_invalidated(app_tables.report_cache_state.get(report_name=name)) for name in report_names):
+      return
+    invalidate_report_cache(report_names)
+  except Exception as e:
+    log("ERROR", "sm_report_cache_mod", "invalidate_reports_for", f"Failed to invalidate cached reports after a {change_kind} change.",
+        {**(log_context or {}), "error": str(e)})
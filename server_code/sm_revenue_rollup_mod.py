@@ -0,0 +1,125 @@
+# Server Module: sm_revenue_rollup_mod.py
+# Maintains the revenue_daily rollup (paid earnings and transaction count per UTC day)
+# so revenue reports sum a few hundred rollup rows instead of every paid transaction.
+# _process_transaction applies deltas as transactions become or stop being paid;
+# backfill_revenue_daily rebuilds the table from transaction history; reports read the
+# table only once it has completed (see sm_backfill_mod).
+
+import anvil.server
+import anvil.users
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import traceback
+from collections import defaultdict
+from datetime import datetime, timezone
+from .sm_logs_mod import log, buffered_logging
+from .sessions_server import is_admin_user
+from .sm_report_cache_mod import invalidate_reports_for
+from .sm_backfill_mod import mark_backfill_complete
+
+
+def earnings_value(value):
+  """details_totals_earnings is stored as a string; returns it as a float (0.0 if missing or invalid)."""
+  if value is None or value == "":
+    return 0.0
+  try:
+    return float(str(value))
+  except (ValueError, TypeError):
+    return 0.0
+
+
+def revenue_contribution(values):
+  """
+    Returns (day, earnings) that a transaction adds to revenue_daily, or None if it adds nothing.
+    values is a dict (e.g. dict(row)) with status, billed_at and details_totals_earnings.
+    """
+  if not values or values.get('status') != 'paid' or not values.get('billed_at'):
+    return None
+  billed_at = values['billed_at']
+  if billed_at.tzinfo is not None:
+    billed_at = billed_at.astimezone(timezone.utc)
+  return billed_at.date(), earnings_value(values.get('details_totals_earnings'))
+
+
+@tables.in_transaction # Retries on conflict: revenue_daily rows are shared counters
+def apply_revenue_delta(previous_values, current_values):
+  """Moves a transaction's contribution from its previous state to its current one."""
+  previous = revenue_contribution(previous_values)
+  current = revenue_contribution(current_values)
+  if previous == current:
+    return
+
+  deltas = defaultdict(lambda: [0.0, 0])
+  if previous:
+    deltas[previous[0]][0] -= previous[1]
+    deltas[previous[0]][1] -= 1
+  if current:
+    deltas[current[0]][0] += current[1]
+    deltas[current[0]][1] += 1
+
+  now = datetime.now(timezone.utc)
+  for day, (earnings_delta, count_delta) in deltas.items():
+    day_row = app_tables.revenue_daily.get(day=day)
+    if day_row:
+      day_row.update(
+        total_earnings=(day_row['total_earnings'] or 0) + earnings_delta,
+        num_transactions=(day_row['num_transactions'] or 0) + count_delta,
+        updated_at=now
+      )
+    else:
+      app_tables.revenue_daily.add_row(day=day, total_earnings=earnings_delta, num_transactions=count_delta, updated_at=now)
+
+
+def get_revenue_daily_rows(start_date, end_date):
+  """revenue_daily rows for start_date <= day < end_date."""
+  return app_tables.revenue_daily.search(day=q.between(start_date, end_date, min_inclusive=True, max_inclusive=False))
+
+
+@anvil.server.callable(require_user=True)
+def start_revenue_daily_backfill():
+  """Launches backfill_revenue_daily. Requires admin privileges."""
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Admin privileges required.")
+  log("INFO", "sm_revenue_rollup_mod", "start_revenue_daily_backfill", "Revenue rollup backfill launched.",
+      {"user_email": anvil.users.get_user()['email']})
+  return anvil.server.launch_background_task('backfill_revenue_daily')
+
+
+@anvil.server.background_task
+@buffered_logging
+def backfill_revenue_daily():
+  """
+    Rebuilds revenue_daily from all paid transactions. The totals are computed first and
+    then swapped in within one transaction; webhooks landing mid-rebuild may need a re-run.
+    """
+  module_name = "sm_revenue_rollup_mod"
+  function_name = "backfill_revenue_daily"
+  log("INFO", module_name, function_name, "Revenue rollup backfill started.")
+  try:
+    totals = defaultdict(lambda: [0.0, 0])
+    scanned = 0
+    for txn in app_tables.transaction.search(status='paid'):
+      scanned += 1
+      contribution = revenue_contribution(dict(txn))
+      if contribution:
+        totals[contribution[0]][0] += contribution[1]
+        totals[contribution[0]][1] += 1
+      if scanned % 500 == 0:
+        anvil.server.task_state['scanned'] = scanned
+
+    now = datetime.now(timezone.utc)
+    with anvil.server.Transaction():
+      app_tables.revenue_daily.delete_all_rows()
+      if totals:
+        app_tables.revenue_daily.add_rows(
+          {'day': day, 'total_earnings': earnings, 'num_transactions': count, 'updated_at': now}
+          for day, (earnings, count) in totals.items()
+        )
+    anvil.server.task_state['scanned'] = scanned
+    mark_backfill_complete('backfill_revenue_daily')
+    invalidate_reports_for('transaction')
+    log("INFO", module_name, function_name, f"Revenue rollup backfill finished. {scanned} paid transactions over {len(totals)} days.")
+  except Exception as e:
+    log("CRITICAL", module_name, function_name, f"Revenue rollup backfill failed: {str(e)}", {"trace": traceback.format_exc()})
+    raise
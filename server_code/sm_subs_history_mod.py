@@ -0,0 +1,153 @@
+# Server Module: sm_subs_history_mod.py
+# Append-only history of subscription states in subs_state_history. Each row is one
+# interval: a subscription held `status` from valid_from until valid_to (None while current).
+# _process_subscription records a new interval whenever a subscription's status changes,
+# so reports can ask "which subscriptions were active at time T" with one range query
+# instead of inferring past state from the current status/started_at/canceled_at columns.
+# Subscriptions last changed before this table existed have no history until
+# backfill_subscription_state_history has run, so readers fall back to the columns for them.
+
+import anvil.server
+import anvil.users
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import traceback
+from datetime import datetime, timezone
+from .sm_logs_mod import log, buffered_logging
+from .sessions_server import is_admin_user
+from .sm_report_cache_mod import invalidate_reports_for
+from .sm_backfill_mod import mark_backfill_complete
+
+# Statuses whose start time Paddle reports on the subscription itself
+_STATUS_TIMESTAMP_COLUMNS = {'canceled': 'canceled_at', 'paused': 'paused_at'}
+
+
+def _first_intervals(status, started_at, changed_at):
+  """
+    Intervals for a subscription with no history yet: (status, valid_from, valid_to) tuples.
+    A subscription first seen as canceled/paused is given the active interval that preceded it.
+    """
+  if status == 'active':
+    return [(status, started_at or changed_at, None)]
+  if started_at and changed_at and started_at < changed_at and status in _STATUS_TIMESTAMP_COLUMNS:
+    return [('active', started_at, changed_at), (status, changed_at, None)]
+  return [(status, changed_at or started_at, None)]
+
+
+def state_changed_at(status, subs_values, fallback):
+  """When the subscription entered `status`: canceled_at/paused_at if Paddle sent them, else fallback."""
+  column = _STATUS_TIMESTAMP_COLUMNS.get(status)
+  return (subs_values.get(column) if column else None) or fallback
+
+
+@tables.in_transaction # Retries on conflict: two events for one subscription can land together
+def record_subscription_state(subs_row, status, customer_row, started_at, changed_at):
+  """
+    Closes the subscription's open interval and appends a new one if its status changed.
+    Intervals never overlap: a change dated before the open interval started is recorded
+    at that interval's start.
+    """
+  if not status:
+    return
+  changed_at = changed_at or datetime.now(timezone.utc)
+  open_rows = sorted(app_tables.subs_state_history.search(subscription=subs_row, valid_to=None),
+                     key=lambda r: r['valid_from'])
+  now = datetime.now(timezone.utc)
+
+  if not open_rows:
+    app_tables.subs_state_history.add_rows(
+      {'subscription': subs_row, 'customer': customer_row, 'status': s,
+       'valid_from': valid_from, 'valid_to': valid_to, 'recorded_at': now}
+      for s, valid_from, valid_to in _first_intervals(status, started_at, changed_at)
+    )
+    return
+
+  current = open_rows[-1]
+  for stray in open_rows[:-1]: # Should not happen; close anything left open by hand edits
+    stray['valid_to'] = current['valid_from']
+  if current['status'] == status:
+    return
+  changed_at = max(changed_at, current['valid_from'])
+  current['valid_to'] = changed_at
+  app_tables.subs_state_history.add_row(subscription=subs_row, customer=customer_row, status=status,
+                                        valid_from=changed_at, valid_to=None, recorded_at=now)
+
+
+def get_states_at(moment, status='active'):
+  """History rows for subscriptions that were in `status` at `moment`."""
+  return app_tables.subs_state_history.search(
+    status=status,
+    valid_from=q.less_than(moment),
+    valid_to=q.any_of(None, q.greater_equal(moment))
+  )
+
+
+def get_state_entries_between(status, start_dt, end_dt):
+  """History rows for subscriptions that entered `status` in [start_dt, end_dt)."""
+  return app_tables.subs_state_history.search(
+    status=status,
+    valid_from=q.between(start_dt, end_dt, min_inclusive=True, max_inclusive=False)
+  )
+
+
+def load_state_intervals(status='active'):
+  """
+    Maps subscription row id -> [(valid_from, valid_to), ...] for every interval in `status`.
+    Every subscription with any history has an entry (an empty list if it was never in
+    `status`); subscriptions without history are absent.
+    """
+  intervals = {}
+  for row in app_tables.subs_state_history.search(q.fetch_only('status', 'valid_from', 'valid_to', subscription=q.fetch_only())):
+    if row['subscription'] is not None:
+      sub_intervals = intervals.setdefault(row['subscription'].get_id(), [])
+      if row['status'] == status:
+        sub_intervals.append((row['valid_from'], row['valid_to']))
+  return intervals
+
+
+@anvil.server.callable(require_user=True)
+def start_subscription_history_backfill():
+  """Launches backfill_subscription_state_history. Requires admin privileges."""
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Admin privileges required.")
+  log("INFO", "sm_subs_history_mod", "start_subscription_history_backfill", "Subscription state history backfill launched.",
+      {"user_email": anvil.users.get_user()['email']})
+  return anvil.server.launch_background_task('backfill_subscription_state_history')
+
+
+@anvil.server.background_task
+@buffered_logging
+def backfill_subscription_state_history():
+  """
+    Seeds history for subscriptions that have none, from their current status,
+    started_at, paused_at and canceled_at. Subscriptions with history are left alone.
+    """
+  module_name = "sm_subs_history_mod"
+  function_name = "backfill_subscription_state_history"
+  log("INFO", module_name, function_name, "Subscription state history backfill started.")
+  try:
+    with_history = {row['subscription'].get_id()
+                    for row in app_tables.subs_state_history.search(q.fetch_only(subscription=q.fetch_only()))
+                    if row['subscription'] is not None}
+    now = datetime.now(timezone.utc)
+    seeded = 0
+    for subs_row in app_tables.subs.search():
+      if subs_row.get_id() in with_history or not subs_row['status']:
+        continue
+      changed_at = state_changed_at(subs_row['status'], dict(subs_row), subs_row['updated_at_anvil'] or subs_row['created_at_anvil'] or now)
+      app_tables.subs_state_history.add_rows(
+        {'subscription': subs_row, 'customer': subs_row['customer_id'], 'status': s,
+         'valid_from': valid_from, 'valid_to': valid_to, 'recorded_at': now}
+        for s, valid_from, valid_to in _first_intervals(subs_row['status'], subs_row['started_at'], changed_at)
+      )
+      seeded += 1
+      if seeded % 200 == 0:
+        anvil.server.task_state['seeded'] = seeded
+    anvil.server.task_state['seeded'] = seeded
+    mark_backfill_complete('backfill_subscription_state_history')
+    invalidate_reports_for('subscription')
+    log("INFO", module_name, function_name, f"Subscription state history backfill finished. {seeded} subscriptions seeded.")
+  except Exception as e:
+    log("CRITICAL", module_name, function_name, f"Subscription state history backfill failed: {str(e)}", {"trace": traceback.format_exc()})
+    raise
@@ -11,6 +11,7 @@ import traceback
 from sm_logs_mod import log
 # Import RBAC functions (adjust path if necessary)
 from .sessions_server import is_admin_user, is_owner_user
+from .sm_id_mod import generate_id
 
 # Import Paddle API client functions <<<--- ADDED IMPORT
 from .paddle_api_client import create_paddle_product, update_paddle_product
@@ -207,10 +208,7 @@ def create_subscription_group(group_data):
   except (ValueError, TypeError) as e:
     raise ValueError(f"Invalid input data: {e}")
 
-  timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-  group_number = f"GRP-{timestamp_str}"
-  if app_tables.subscription_group.get(group_number=group_number):
-    raise Exception("Failed to generate unique group number.")
+  group_number = generate_id("GRP")
 
   # --- Handle File Upload ---
   media_link_row = None
@@ -5,15 +5,94 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.server
-from datetime import datetime
+import anvil.secrets
+from datetime import datetime, timezone
 from sm_logs_mod import log
 import hashlib # <-- Import hashlib
 import hmac # <-- Import hmac for compare_digest
 import os # <-- Import os (though not directly used here, good practice)
-from cryptography.fernet import Fernet, InvalidToken # Keep for other secrets
+import threading
+import time
+import traceback
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken # Keep for other secrets
 # Import the centralized authorization functions and logging
 from .sessions_server import is_admin_user, OWNER_PASSWORD_VAULT_KEY, HASH_ITERATIONS # Import HASH_ITERATIONS
 
+# --- Decrypted Secret Cache ---
+# Webhook handling reads the same few secrets on every event. Decrypted values are kept
+# in-process for VAULT_SECRET_CACHE_TTL_SECONDS, re-encrypted under a random key that only
+# lives in this process's memory, so plaintext secrets are never held in the cache itself.
+# save_secret and delete_secret (and save_multiple_secrets through save_secret) invalidate entries.
+VAULT_SECRET_CACHE_TTL_SECONDS = 60
+_secret_cache = {} # key -> (token encrypted with _secret_cache_fernet, cached_at)
+_secret_cache_fernet = Fernet(Fernet.generate_key())
+_secret_cache_lock = threading.Lock()
+_vault_fernet = None # (Multi)Fernet built for _vault_fernet_keys
+_vault_fernet_keys = None # (VAULT_ENCRYPTION_KEY, VAULT_ENCRYPTION_KEY_PREVIOUS) it was built from
+
+# --- Key Rotation ---
+# To rotate: store the new key as VAULT_ENCRYPTION_KEY and the old one as
+# VAULT_ENCRYPTION_KEY_PREVIOUS in Anvil Secrets, then run start_vault_key_rotation.
+# While both keys are set, decryption accepts either and encryption uses the new key.
+# Once rotation reports 'Completed', VAULT_ENCRYPTION_KEY_PREVIOUS can be removed.
+VAULT_PREVIOUS_KEY_SECRET_NAME = "VAULT_ENCRYPTION_KEY_PREVIOUS"
+VAULT_ROTATION_BATCH_SIZE = 50
+
+def _get_secret_if_set(secret_name):
+    """Returns an Anvil Secret, or None if it is not defined."""
+    try:
+        return anvil.secrets.get_secret(secret_name)
+    except Exception:
+        return None
+
+def _get_vault_fernet():
+    """
+    Returns the Fernet for VAULT_ENCRYPTION_KEY. If VAULT_ENCRYPTION_KEY_PREVIOUS is set,
+    returns a MultiFernet that encrypts with the current key and decrypts with either.
+    Both secrets are read on every call, so every server instance switches to the
+    MultiFernet as soon as a rotation is set up; only the Fernet objects are reused.
+    """
+    global _vault_fernet, _vault_fernet_keys
+    encryption_key_str = anvil.secrets.get_secret("VAULT_ENCRYPTION_KEY")
+    if not encryption_key_str:
+        log("CRITICAL", "vault_server", "_get_vault_fernet", "VAULT_ENCRYPTION_KEY not found in Anvil Secrets.")
+        raise Exception("FATAL: VAULT_ENCRYPTION_KEY not found in Anvil Secrets.")
+    previous_key_str = _get_secret_if_set(VAULT_PREVIOUS_KEY_SECRET_NAME)
+    keys = (encryption_key_str, previous_key_str)
+    if _vault_fernet is None or _vault_fernet_keys != keys:
+        fernets = [Fernet(encryption_key_str.encode('utf-8'))]
+        if previous_key_str and previous_key_str != encryption_key_str:
+            fernets.append(Fernet(previous_key_str.encode('utf-8')))
+        _vault_fernet = MultiFernet(fernets) if len(fernets) > 1 else fernets[0]
+        _vault_fernet_keys = keys
+    return _vault_fernet
+
+def _get_cached_secret(key):
+    """Returns the cached decrypted value for key, or None if absent or expired."""
+    with _secret_cache_lock:
+        cached = _secret_cache.get(key)
+        if not cached:
+            return None
+        token, cached_at = cached
+        if time.monotonic() - cached_at > VAULT_SECRET_CACHE_TTL_SECONDS:
+            del _secret_cache[key]
+            return None
+    return _secret_cache_fernet.decrypt(token).decode('utf-8')
+
+def _cache_secret(key, value):
+    """Stores a decrypted value in the cache, encrypted under the process-local cache key."""
+    token = _secret_cache_fernet.encrypt(value.encode('utf-8'))
+    with _secret_cache_lock:
+        _secret_cache[key] = (token, time.monotonic())
+
+def invalidate_secret_cache(key=None):
+    """Drops one key from the decrypted secret cache, or the whole cache if no key is given."""
+    with _secret_cache_lock:
+        if key is None:
+            _secret_cache.clear()
+        else:
+            _secret_cache.pop(key, None)
+
 # --- Vault Operations ---
 @anvil.server.callable
 def validate_owner_password(password_attempt):
@@ -146,12 +225,7 @@ def save_secret(key, value, scope, description):
 
     try:
         # --- Encryption Step (Fernet) ---
-        encryption_key_str = anvil.secrets.get_secret("VAULT_ENCRYPTION_KEY")
-        if not encryption_key_str:
-             log("CRITICAL", "vault_server", "save_secret", "VAULT_ENCRYPTION_KEY not found in Anvil Secrets. Cannot save secret.")
-             raise Exception("FATAL: VAULT_ENCRYPTION_KEY not found in Anvil Secrets.")
-        encryption_key = encryption_key_str.encode('utf-8')
-        f = Fernet(encryption_key)
+        f = _get_vault_fernet()
         encrypted_value_bytes = f.encrypt(value.encode('utf-8'))
         encrypted_value_str = encrypted_value_bytes.decode('utf-8')
         # --- End Encryption Step ---
@@ -180,6 +254,7 @@ def save_secret(key, value, scope, description):
                 owner=user
                 # Note: 'value' and 'salt' columns are NOT used for general secrets
             )
+        invalidate_secret_cache(key)
         return True
     except Exception as e:
         log("ERROR", "vault_server", "save_secret", f"Failed to save secret '{key}' for user {user['email']}", {"user_id": user.get_id(), "error": str(e)})
@@ -233,6 +308,10 @@ def _get_decrypted_secret_value(key):
         return None # Owner password is not encrypted with Fernet
 
     try:
+        cached_value = _get_cached_secret(key)
+        if cached_value is not None:
+            return cached_value
+
         secret_row = app_tables.vault.get(key=key)
         if not secret_row:
             log("WARNING", "vault_server", "_get_decrypted_secret_value", f"Secret '{key}' not found in vault.")
@@ -244,15 +323,11 @@ def _get_decrypted_secret_value(key):
              return None
 
         # --- Decryption Step (Fernet) ---
-        encryption_key_str = anvil.secrets.get_secret("VAULT_ENCRYPTION_KEY")
-        if not encryption_key_str:
-             log("CRITICAL", "vault_server", "_get_decrypted_secret_value", "VAULT_ENCRYPTION_KEY not found in Anvil Secrets. Cannot decrypt.")
-             raise Exception("FATAL: VAULT_ENCRYPTION_KEY not found in Anvil Secrets.")
-        encryption_key = encryption_key_str.encode('utf-8')
-        f = Fernet(encryption_key)
+        f = _get_vault_fernet()
         decrypted_value_bytes = f.decrypt(encrypted_value_str.encode('utf-8'))
         decrypted_value_str = decrypted_value_bytes.decode('utf-8')
         # --- End Decryption Step ---
+        _cache_secret(key, decrypted_value_str)
 
         log("DEBUG", "vault_server", "_get_decrypted_secret_value", f"Successfully decrypted secret '{key}'.")
         return decrypted_value_str
@@ -284,6 +359,7 @@ def delete_secret(row_id):
 
             key_deleted = secret_row['key']
             secret_row.delete()
+            invalidate_secret_cache(key_deleted)
             log("INFO", "vault_server", "delete_secret", f"Secret '{key_deleted}' (ID: {row_id}) deleted by user {user['email']}", {"user_id": user.get_id()})
         else:
             log("WARNING", "vault_server", "delete_secret", f"Secret with ID {row_id} not found for deletion.", {"user_email": user['email']})
@@ -321,6 +397,57 @@ def get_secret_for_server_use(secret_key_name):
         # log("DEBUG", "vault_server", "get_secret_for_server_use", f"Successfully retrieved secret '{secret_key_name}' for server use.")
         return decrypted_value
 
+# NOTE: This function is NOT decorated with @anvil.server.callable
+# It is intended to be called ONLY by other server modules, like get_secret_for_server_use.
+def get_secrets_for_server_use(secret_key_names, optional_keys=()):
+    """
+    Bulk version of get_secret_for_server_use.
+    Returns a dict mapping each requested key to its decrypted value (None if not found/decryption fails).
+    Keys not already cached are fetched from the vault table in a single query.
+    Keys listed in optional_keys are not reported as missing.
+    Does NOT handle the owner password entry.
+    """
+    log("DEBUG", "vault_server", "get_secrets_for_server_use", f"Server request for secret keys: {secret_key_names}")
+    results = {}
+    keys_to_fetch = []
+    for key in secret_key_names:
+        if not key or key in results:
+            continue
+        if key == OWNER_PASSWORD_VAULT_KEY:
+            log("ERROR", "vault_server", "get_secrets_for_server_use", f"Attempt to retrieve owner password entry '{key}' using general secret retrieval function.")
+            results[key] = None
+            continue
+        cached_value = _get_cached_secret(key)
+        results[key] = cached_value
+        if cached_value is None:
+            keys_to_fetch.append(key)
+
+    if not keys_to_fetch:
+        return results
+
+    try:
+        f = _get_vault_fernet()
+        for secret_row in app_tables.vault.search(key=q.any_of(*keys_to_fetch)):
+            key = secret_row['key']
+            encrypted_value_str = secret_row['encrypted_value']
+            if not encrypted_value_str:
+                log("WARNING", "vault_server", "get_secrets_for_server_use", f"Secret '{key}' found but encrypted value is empty.")
+                continue
+            try:
+                decrypted_value_str = f.decrypt(encrypted_value_str.encode('utf-8')).decode('utf-8')
+            except InvalidToken:
+                log("ERROR", "vault_server", "get_secrets_for_server_use", f"DECRYPTION FAILED (InvalidToken) for secret '{key}'. Key mismatch or data corruption?")
+                continue
+            _cache_secret(key, decrypted_value_str)
+            results[key] = decrypted_value_str
+    except Exception as e:
+        log("ERROR", "vault_server", "get_secrets_for_server_use", "Failed to retrieve secrets", {"keys": keys_to_fetch, "error": str(e)})
+
+    missing = [key for key in keys_to_fetch if results.get(key) is None and key not in optional_keys]
+    if missing:
+        log("WARNING", "vault_server", "get_secrets_for_server_use", f"Failed to get/decrypt secrets {missing} for server use.")
+    return results
+
 
 # Add this function to vault_server.py
 
@@ -431,8 +558,10 @@ def get_essential_credentials_status():
   statuses = {}
 
   try:
+    # One query for all keys instead of a vault.get per key
+    vault_entries = {row['key']: row for row in app_tables.vault.search(key=q.any_of(*essential_keys))}
     for key_name in essential_keys:
-      vault_entry = app_tables.vault.get(key=key_name)
+      vault_entry = vault_entries.get(key_name)
       is_set = False
       if vault_entry:
         if key_name == OWNER_PASSWORD_VAULT_KEY:
@@ -453,4 +582,99 @@ def get_essential_credentials_status():
     log("ERROR", module_name, function_name, "Error retrieving credential statuses.", {**log_context, "error": str(e)})
     # Raise the exception to inform the client of a failure.
     # The client-side will handle displaying an error message.
-    raise Exception(f"An error occurred while checking credential statuses: {e}")
\ No newline at end of file
+    raise Exception(f"An error occurred while checking credential statuses: {e}")
+
+
+# --- Vault Key Rotation Job ---
+@anvil.server.callable
+def start_vault_key_rotation():
+    """
+    Launches the background re-encryption of all vault secrets under the current
+    VAULT_ENCRYPTION_KEY. Resumes from the last checkpoint if a previous run did not finish.
+    Requires admin privileges.
+    """
+    if not is_admin_user():
+        user_email = anvil.users.get_user()['email'] if anvil.users.get_user() else "None"
+        log("WARNING", "vault_server", "start_vault_key_rotation", "Permission denied", {"user_email": user_email})
+        raise anvil.server.PermissionDenied("Admin privileges required to rotate the vault key.")
+
+    if not _get_secret_if_set(VAULT_PREVIOUS_KEY_SECRET_NAME):
+        raise Exception(f"Set {VAULT_PREVIOUS_KEY_SECRET_NAME} to the old key in Anvil Secrets before rotating.")
+
+    for task in anvil.server.list_background_tasks():
+        if task.get_task_name() == 'rotate_vault_encryption_key' and task.is_running():
+            raise Exception("A vault key rotation is already running.")
+
+    task = anvil.server.launch_background_task('rotate_vault_encryption_key')
+    log("INFO", "vault_server", "start_vault_key_rotation", "Vault key rotation launched.", {"user_email": anvil.users.get_user()['email']})
+    return task
+
+@anvil.server.callable
+def get_vault_key_rotation_status():
+    """Returns the most recent rotation run as a dict, or None. Requires admin privileges."""
+    if not is_admin_user():
+        raise anvil.server.PermissionDenied("Admin privileges required to view vault key rotation status.")
+    run = next(iter(app_tables.vault_key_rotation.search(tables.order_by('started_at', ascending=False))), None)
+    if not run:
+        return None
+    return {column: run[column] for column in ('status', 'last_key', 'rows_rotated', 'started_at', 'updated_at', 'finished_at', 'last_error')}
+
+@anvil.server.background_task
+def rotate_vault_encryption_key():
+    """
+    Re-encrypts every vault secret under the current VAULT_ENCRYPTION_KEY, in key order and
+    in batches of VAULT_ROTATION_BATCH_SIZE. The checkpoint is the list of vault row ids already
+    rotated; each batch and its checkpoint are written in one transaction, so a failed run
+    leaves every row readable and resumes where it stopped.
+    """
+    module_name = "vault_server"
+    function_name = "rotate_vault_encryption_key"
+    now = datetime.now(timezone.utc)
+
+    # Resume an unfinished run, otherwise start a new one
+    run = next(iter(app_tables.vault_key_rotation.search(
+        tables.order_by('started_at', ascending=False), status=q.any_of('Running', 'Failed'))), None)
+    if run:
+        run.update(status='Running', updated_at=now, last_error=None)
+        log("INFO", module_name, function_name, f"Resuming vault key rotation after key '{run['last_key']}'.", {"rows_rotated": run['rows_rotated']})
+    else:
+        run = app_tables.vault_key_rotation.add_row(status='Running', last_key=None, rows_rotated=0, rotated_row_ids=[],
+                                                    started_at=now, updated_at=now)
+        log("INFO", module_name, function_name, "Starting vault key rotation.")
+
+    try:
+        f = _get_vault_fernet()
+        if not isinstance(f, MultiFernet):
+            raise Exception(f"{VAULT_PREVIOUS_KEY_SECRET_NAME} is not set; nothing to rotate from.")
+
+        rotated_ids = set(run['rotated_row_ids'] or [])
+        while True:
+            anvil.server.task_state['rows_rotated'] = run['rows_rotated']
+            batch = []
+            for row in app_tables.vault.search(tables.order_by('key')):
+                if row.get_id() in rotated_ids:
+                    continue
+                batch.append(row)
+                if len(batch) >= VAULT_ROTATION_BATCH_SIZE:
+                    break
+            if not batch:
+                break
+
+            with anvil.server.Transaction():
+                for row in batch:
+                    # The owner password is a salted hash, not a Fernet token
+                    if row['key'] != OWNER_PASSWORD_VAULT_KEY and row['encrypted_value']:
+                        rotated = f.rotate(row['encrypted_value'].encode('utf-8')).decode('utf-8')
+                        row.update(encrypted_value=rotated, updated_at=datetime.now(timezone.utc))
+                rotated_ids.update(row.get_id() for row in batch)
+                run.update(last_key=batch[-1]['key'], rows_rotated=(run['rows_rotated'] or 0) + len(batch),
+                           rotated_row_ids=sorted(rotated_ids), updated_at=datetime.now(timezone.utc))
+
+        run.update(status='Completed', finished_at=datetime.now(timezone.utc), updated_at=datetime.now(timezone.utc))
+        anvil.server.task_state['rows_rotated'] = run['rows_rotated']
+        log("INFO", module_name, function_name, f"Vault key rotation completed. {run['rows_rotated']} rows processed.")
+    except Exception as e:
+        run.update(status='Failed', last_error=str(e), updated_at=datetime.now(timezone.utc))
+        log("CRITICAL", module_name, function_name, "Vault key rotation failed; it will resume from the last checkpoint.",
+            {"last_key": run['last_key'], "error": str(e), "trace": traceback.format_exc()})
+        raise
@@ -1,5 +1,5 @@
 # Server Module: webhook_handler.py (Tenant App)
-from sm_logs_mod import log
+from sm_logs_mod import log, buffered_logging, measure_log_settings_reads
 import anvil.server
 import anvil.tables as tables
 import anvil.tables.query as q
@@ -8,13 +8,24 @@ import anvil.secrets
 import hmac
 import hashlib
 import json
+import functools
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone
 import dateutil.parser # For parsing ISO 8601 dates from Paddle
+from .sm_id_mod import generate_id
+from .sm_revenue_rollup_mod import apply_revenue_delta
+from .sm_last_paid_mod import apply_last_paid_transaction
+from .sm_subs_history_mod import record_subscription_state, state_changed_at
+from .sm_report_cache_mod import invalidate_reports_for
 from .vault_server import get_secret_for_server_use # Ensure this import is present
 from datetime import timedelta # Ensure timedelta is imported
 # Import the actual forwarding function
-from .payload_forwarder import forward_payload_to_hub
+from .payload_forwarder import forward_payload_to_hub, enqueue_payload_for_hub, ensure_hub_outbox_drain
+from .payload_store import store_payload, get_stored_payload
 import anvil.users as users
+from .sessions_server import is_admin_user
 import traceback
 
 
@@ -23,7 +34,63 @@ import traceback
 PADDLE_WEBHOOK_SECRET_VAULT_KEY = "paddle_webhook_secret"
 # Tolerance for webhook timestamp verification (e.g., 5 minutes)
 WEBHOOK_TIMESTAMP_TOLERANCE = timedelta(minutes=5)
-
+# Number of recently seen Paddle event_ids kept in memory in front of the webhook_log lookup
+EVENT_ID_CACHE_SIZE = 2000
+
+
+# --- Helper Functions: Paddle ID -> Row Lookup Cache ---
+# Linked-row lookups repeat within one event (e.g. one prices.get per line item) and
+# across events. Inside a lookup_cache_scope every lookup is memoised for the request;
+# found rows can also be kept process-wide for LOOKUP_CACHE_TTL_SECONDS (0 disables that layer).
+LOOKUP_CACHE_TTL_SECONDS = 0
+_request_lookup_state = threading.local()
+_process_lookup_cache = {} # (table_name, query) -> (row, cached_at)
+
+def lookup_cache_scope(func):
+  """Decorator giving a server function or background task its own request-scoped lookup cache."""
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    if getattr(_request_lookup_state, 'cache', None) is not None: # Nested scope; reuse the outer cache
+      return func(*args, **kwargs)
+    _request_lookup_state.cache = {}
+    try:
+      return func(*args, **kwargs)
+    finally:
+      _request_lookup_state.cache = None
+  return wrapper
+
+def _cached_get(table_name, **query):
+  """table.get(**query) through the request and process lookup caches. Misses are only cached per request."""
+  cache_key = (table_name, tuple(sorted(query.items())))
+  request_cache = getattr(_request_lookup_state, 'cache', None)
+  if request_cache is not None and cache_key in request_cache:
+    return request_cache[cache_key]
+
+  if LOOKUP_CACHE_TTL_SECONDS > 0:
+    cached = _process_lookup_cache.get(cache_key)
+    if cached and time.monotonic() - cached[1] <= LOOKUP_CACHE_TTL_SECONDS:
+      if request_cache is not None:
+        request_cache[cache_key] = cached[0]
+      return cached[0]
+
+  row = getattr(app_tables, table_name).get(**query)
+  if request_cache is not None:
+    request_cache[cache_key] = row
+  if row is not None and LOOKUP_CACHE_TTL_SECONDS > 0:
+    _process_lookup_cache[cache_key] = (row, time.monotonic())
+  return row
+
+def _invalidate_lookup_cache(table_name, **query):
+  """Drops cached lookups for table_name: the entry matching query, or every entry if no query is given."""
+  caches = [_process_lookup_cache]
+  request_cache = getattr(_request_lookup_state, 'cache', None)
+  if request_cache is not None:
+    caches.append(request_cache)
+  cache_key = (table_name, tuple(sorted(query.items())))
+  for cache in caches:
+    for key in list(cache.keys()):
+      if key == cache_key or (not query and key[0] == table_name):
+        cache.pop(key, None)
 
 # --- Helper Function: Get Linked Row ---
 def _get_linked_row(target_table_name, paddle_id):
@@ -31,8 +98,7 @@ def _get_linked_row(target_table_name, paddle_id):
     if not paddle_id:
         return None
     try:
-        target_table = getattr(app_tables, target_table_name)
-        return target_table.get(paddle_id=paddle_id)
+        return _cached_get(target_table_name, paddle_id=paddle_id)
     except AttributeError:
         print(f"Warning: Linked table '{target_table_name}' not found.")
         return None
@@ -40,6 +106,43 @@ def _get_linked_row(target_table_name, paddle_id):
         print(f"Warning: Error fetching linked row from '{target_table_name}' for id '{paddle_id}': {e}")
         return None
 
+# --- Helper Functions: Event ID Dedupe Index ---
+# Paddle redelivers events it believes were not received. webhook_log.event_id is the
+# durable index of events already taken in; an LRU of recent ids avoids the query for hot repeats.
+# Only deliveries that got past 'Received' count: a row left at 'Received' means the handler
+# died before processing it, so a later redelivery takes it over and processes it.
+ABANDONED_DELIVERY_MINUTES = 5 # A 'Received' row untouched this long is assumed abandoned, not in progress
+_seen_event_ids = OrderedDict()
+
+def _remember_event_id(event_id):
+  """Adds an event_id to the in-memory LRU, evicting the oldest entry when full."""
+  _seen_event_ids[event_id] = True
+  _seen_event_ids.move_to_end(event_id)
+  while len(_seen_event_ids) > EVENT_ID_CACHE_SIZE:
+    _seen_event_ids.popitem(last=False)
+
+def _check_duplicate_event(event_id):
+  """
+    Checks for an earlier delivery of this Paddle event_id (LRU first, then webhook_log).
+    Returns (is_duplicate, abandoned_log_row). An abandoned 'Received' row is claimed for this
+    delivery (is_duplicate False); a recent one is assumed still in progress (is_duplicate True).
+    Call inside the check-and-insert transaction.
+    """
+  if event_id in _seen_event_ids:
+    _seen_event_ids.move_to_end(event_id)
+    return True, None
+  now = datetime.now(timezone.utc)
+  for log_row in app_tables.webhook_log.search(event_id=event_id):
+    if log_row['status'] != 'Received':
+      _remember_event_id(event_id)
+      return True, None
+    last_touched = log_row['last_retry_timestamp'] or log_row['received_at']
+    if last_touched and last_touched < now - timedelta(minutes=ABANDONED_DELIVERY_MINUTES):
+      log_row['last_retry_timestamp'] = now # Claimed; a concurrent redelivery now sees it as in progress
+      return False, log_row
+    return True, None
+  return False, None
+
 # --- Helper Function: Parse Datetime ---
 def _parse_datetime(datetime_string):
     """Parses ISO 8601 datetime strings, returns None if invalid or empty."""
@@ -52,6 +155,43 @@ def _parse_datetime(datetime_string):
         print(f"Warning: Could not parse datetime string '{datetime_string}': {e}")
         return None
 
+# --- Helper Functions: Per-Resource Event Ordering ---
+# Paddle can deliver events for the same resource concurrently or out of order. Each
+# payload's updated_at (falling back to occurred_at) is compared against the stored
+# paddle_updated_at so an older event never overwrites a newer one.
+def _as_utc(dt):
+  """Treats naive datetimes as UTC so stored and parsed values compare safely."""
+  if dt is not None and dt.tzinfo is None:
+    return dt.replace(tzinfo=timezone.utc)
+  return dt
+
+def _payload_updated_at(data):
+  """Returns the payload's version timestamp: updated_at, else occurred_at."""
+  return _as_utc(_parse_datetime(data.get('updated_at') or data.get('occurred_at')))
+
+def _is_stale_event(existing_row, payload_updated_at):
+  """True if existing_row already reflects a state newer than payload_updated_at."""
+  if not existing_row or not payload_updated_at:
+    return False
+  stored_updated_at = _as_utc(existing_row['paddle_updated_at'])
+  return bool(stored_updated_at) and payload_updated_at < stored_updated_at
+
+def _update_row_if_not_stale(table, row, update_data, payload_updated_at, previous_values=None):
+  """
+    Re-checks staleness and applies update_data in one transaction, so a newer event
+    written by a parallel worker since the first check is not overwritten.
+    If previous_values (a dict) is given, it is filled with the row's values as they
+    were just before this update. Returns False if the update was skipped.
+    """
+  with anvil.server.Transaction():
+    fresh_row = table.get_by_id(row.get_id())
+    if fresh_row is None or _is_stale_event(fresh_row, payload_updated_at):
+      return False
+    if previous_values is not None:
+      previous_values.update(dict(fresh_row))
+    fresh_row.update(**update_data)
+    return True
+
 # --- Processing Functions for Specific Resources ---
 
 # Server Module: webhook_handler.py (Tenant App)
@@ -97,6 +237,12 @@ def _process_transaction(data):
     mybizz_transaction_row = transaction_table.get(paddle_id=paddle_transaction_id)
     current_time_anvil = datetime.now(timezone.utc)
 
+    # Drop out-of-order events before any linked-row lookups
+    payload_updated_at = _payload_updated_at(data)
+    if _is_stale_event(mybizz_transaction_row, payload_updated_at):
+      log("INFO", module_name, function_name, "Skipping stale transaction event; a newer update is already stored.", {**log_context, "payload_updated_at": str(payload_updated_at)})
+      return True, "Stale transaction event skipped (newer update already stored)."
+
     # Prepare data for the main transaction record
     details_data = data.get('details', {})
     totals_data = details_data.get('totals', {})
@@ -154,21 +300,21 @@ def _process_transaction(data):
         final_update_data_main_txn[k] = None
 
     mybizz_transaction_anvil_pk = None 
+    previous_txn_values = {} # Stays empty for a new transaction
 
     if mybizz_transaction_row:
       mybizz_transaction_anvil_pk = mybizz_transaction_row['transaction_id']
       log("INFO", module_name, function_name, f"Updating existing MyBizz transaction: {mybizz_transaction_anvil_pk}", log_context)
       final_update_data_main_txn['updated_at_anvil'] = current_time_anvil
-      mybizz_transaction_row.update(**final_update_data_main_txn)
+      if not _update_row_if_not_stale(transaction_table, mybizz_transaction_row, final_update_data_main_txn, payload_updated_at,
+                                      previous_values=previous_txn_values):
+        log("INFO", module_name, function_name, "Skipping stale transaction event; a newer update was stored concurrently.", log_context)
+        return True, "Stale transaction event skipped (newer update stored concurrently)."
     else:
       log("INFO", module_name, function_name, "Creating new MyBizz transaction.", log_context)
       final_update_data_main_txn['created_at_anvil'] = current_time_anvil
       final_update_data_main_txn['updated_at_anvil'] = current_time_anvil
-      timestamp_str = current_time_anvil.strftime("%Y%m%d%H%M%S%f")
-      anvil_transaction_id_pk = f"TRN-{timestamp_str}-{paddle_transaction_id[:8]}"
-      while app_tables.transaction.get(transaction_id=anvil_transaction_id_pk):
-        timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f") 
-        anvil_transaction_id_pk = f"TRN-{timestamp_str}-{paddle_transaction_id[:8]}"
+      anvil_transaction_id_pk = generate_id("TRN", paddle_transaction_id[:8])
       final_update_data_main_txn['transaction_id'] = anvil_transaction_id_pk
       mybizz_transaction_anvil_pk = anvil_transaction_id_pk
 
@@ -176,6 +322,18 @@ def _process_transaction(data):
 
     log_context['mybizz_transaction_id'] = mybizz_transaction_anvil_pk
 
+    # Keep the revenue_daily rollup in step when the transaction becomes/stops being paid
+    try:
+      apply_revenue_delta(previous_txn_values, {**previous_txn_values, **final_update_data_main_txn})
+    except Exception as e_rollup:
+      log("ERROR", module_name, function_name, "Failed to update revenue_daily rollup; run backfill_revenue_daily to repair.", {**log_context, "error": str(e_rollup)})
+
+    # Keep the subscription's last paid transaction columns current
+    try:
+      apply_last_paid_transaction(mybizz_transaction_row, previous_txn_values)
+    except Exception as e_pointer:
+      log("ERROR", module_name, function_name, "Failed to update subscription's last paid transaction; run backfill_last_paid_transactions to repair.", {**log_context, "error": str(e_pointer)})
+
     # --- Process Transaction Line Items ---
     paddle_line_items_data = data.get('items', []) 
     if not paddle_line_items_data and details_data: 
@@ -183,64 +341,7 @@ def _process_transaction(data):
 
     if paddle_line_items_data:
       log("INFO", module_name, function_name, f"Processing {len(paddle_line_items_data)} line item(s) for transaction {paddle_transaction_id}.", log_context)
-      transaction_items_table = app_tables.transaction_items
-
-      for line_item_payload in paddle_line_items_data:
-        paddle_line_item_id = line_item_payload.get('id') 
-
-        if not paddle_line_item_id:
-          log("WARNING", module_name, function_name, "Skipping a line item due to missing Paddle Line Item ID.", {**log_context, "line_item_payload": line_item_payload})
-          continue
-
-        line_item_log_context = {**log_context, "paddle_line_item_id": paddle_line_item_id}
-
-        paddle_price_id_from_line = line_item_payload.get('price', {}).get('id')
-        mybizz_price_row = None
-        if paddle_price_id_from_line:
-          mybizz_price_row = app_tables.prices.get(paddle_price_id=paddle_price_id_from_line)
-          if not mybizz_price_row:
-            log("WARNING", module_name, function_name, f"MyBizz 'prices' row not found for paddle_price_id '{paddle_price_id_from_line}' from line item. Line item will not be linked to a MyBizz price.", line_item_log_context)
-        else:
-          log("WARNING", module_name, function_name, "Paddle Price ID missing from line item payload. Cannot link to MyBizz price.", line_item_log_context)
-
-        proration_data = line_item_payload.get('proration', {})
-        line_item_totals_data = line_item_payload.get('totals', {})
-
-        update_data_line_item = {
-          'paddle_id': paddle_line_item_id, 
-          'transaction_id': mybizz_transaction_row, 
-          'price_id': mybizz_price_row, 
-          'quantity': line_item_payload.get('quantity'),
-          'proration_rate': proration_data.get('rate'),
-          'proration_billing_period_starts_at': _parse_datetime(proration_data.get('billing_period', {}).get('starts_at')),
-          'proration_billing_period_ends_at': _parse_datetime(proration_data.get('billing_period', {}).get('ends_at')),
-          'totals_subtotal': line_item_totals_data.get('subtotal'),
-          'totals_tax': line_item_totals_data.get('tax'),
-          'totals_discount': line_item_totals_data.get('discount'),
-          'totals_total': line_item_totals_data.get('total'),
-        }
-
-        final_update_data_line_item = {'paddle_id': paddle_line_item_id}
-        nullable_fields_line_item = list(update_data_line_item.keys()) 
-        for k, v in update_data_line_item.items():
-          if k == 'paddle_id': 
-            continue
-          if v is not None:
-            final_update_data_line_item[k] = v
-          elif k in nullable_fields_line_item:
-            final_update_data_line_item[k] = None
-
-        existing_txn_item_row = transaction_items_table.get(paddle_id=paddle_line_item_id, transaction_id=mybizz_transaction_row)
-
-        if existing_txn_item_row:
-          log("INFO", module_name, function_name, f"Updating existing transaction_item: {paddle_line_item_id}", line_item_log_context)
-          final_update_data_line_item['updated_at_anvil'] = current_time_anvil
-          existing_txn_item_row.update(**final_update_data_line_item)
-        else:
-          log("INFO", module_name, function_name, f"Creating new transaction_item: {paddle_line_item_id}", line_item_log_context)
-          final_update_data_line_item['created_at_anvil'] = current_time_anvil
-          final_update_data_line_item['updated_at_anvil'] = current_time_anvil
-          transaction_items_table.add_row(**final_update_data_line_item)
+      _reconcile_transaction_items(mybizz_transaction_row, paddle_line_items_data, current_time_anvil, log_context)
     else:
       log("INFO", module_name, function_name, f"No line items found in payload for transaction {paddle_transaction_id}.", log_context)
 
@@ -282,11 +383,7 @@ def _process_transaction(data):
         existing_failed_entry.update(**failed_data)
       else:
         log("INFO", module_name, function_name, "Creating new entry in failed_transactions.", log_context)
-        timestamp_ft_str = current_time_anvil.strftime("%Y%m%d%H%M%S%f")
-        failed_transaction_pk = f"FTX-{timestamp_ft_str}-{paddle_transaction_id[:8]}"
-        while failed_tx_table.get(failed_transaction_id=failed_transaction_pk):
-          timestamp_ft_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f") 
-          failed_transaction_pk = f"FTX-{timestamp_ft_str}-{paddle_transaction_id[:8]}"
+        failed_transaction_pk = generate_id("FTX", paddle_transaction_id[:8])
         failed_data['failed_transaction_id'] = failed_transaction_pk
         failed_tx_table.add_row(**failed_data)
 
@@ -298,6 +395,91 @@ def _process_transaction(data):
     log("CRITICAL", module_name, function_name, error_msg, {**log_context, "error": str(e), "trace": traceback.format_exc()})
     return False, error_msg
 
+def _get_prices_by_paddle_id(paddle_price_ids):
+  """Resolves many paddle_price_ids to MyBizz 'prices' rows with one query. Returns {paddle_price_id: row}."""
+  paddle_price_ids = {price_id for price_id in paddle_price_ids if price_id}
+  if not paddle_price_ids:
+    return {}
+  return {row['paddle_price_id']: row for row in app_tables.prices.search(paddle_price_id=q.any_of(*paddle_price_ids))}
+
+def _reconcile_transaction_items(mybizz_transaction_row, paddle_line_items_data, current_time_anvil, parent_log_context):
+  """
+    Brings the 'transaction_items' rows for a transaction in line with the payload's line items.
+    Loads the existing rows and the linked prices with one query each, then applies
+    adds, updates of changed rows and deletes of vanished rows in a single transaction.
+    """
+  module_name = "webhook_handler"
+  function_name = "_reconcile_transaction_items"
+  log_context = {**parent_log_context}
+  transaction_items_table = app_tables.transaction_items
+
+  price_rows_by_paddle_id = _get_prices_by_paddle_id(
+    line_item.get('price', {}).get('id') for line_item in paddle_line_items_data
+  )
+
+  desired_items = {}
+  skipped_line_item = False
+  for line_item_payload in paddle_line_items_data:
+    paddle_line_item_id = line_item_payload.get('id') 
+    if not paddle_line_item_id:
+      log("WARNING", module_name, function_name, "Skipping a line item due to missing Paddle Line Item ID.", {**log_context, "line_item_payload": line_item_payload})
+      skipped_line_item = True
+      continue
+
+    paddle_price_id_from_line = line_item_payload.get('price', {}).get('id')
+    mybizz_price_row = price_rows_by_paddle_id.get(paddle_price_id_from_line)
+    if not paddle_price_id_from_line:
+      log("WARNING", module_name, function_name, "Paddle Price ID missing from line item payload. Cannot link to MyBizz price.", {**log_context, "paddle_line_item_id": paddle_line_item_id})
+    elif not mybizz_price_row:
+      log("WARNING", module_name, function_name, f"MyBizz 'prices' row not found for paddle_price_id '{paddle_price_id_from_line}' from line item. Line item will not be linked to a MyBizz price.", {**log_context, "paddle_line_item_id": paddle_line_item_id})
+
+    proration_data = line_item_payload.get('proration', {})
+    line_item_totals_data = line_item_payload.get('totals', {})
+    desired_items[paddle_line_item_id] = {
+      'paddle_id': paddle_line_item_id, 
+      'transaction_id': mybizz_transaction_row, 
+      'price_id': mybizz_price_row, 
+      'quantity': line_item_payload.get('quantity'),
+      'proration_rate': proration_data.get('rate'),
+      'proration_billing_period_starts_at': _parse_datetime(proration_data.get('billing_period', {}).get('starts_at')),
+      'proration_billing_period_ends_at': _parse_datetime(proration_data.get('billing_period', {}).get('ends_at')),
+      'totals_subtotal': line_item_totals_data.get('subtotal'),
+      'totals_tax': line_item_totals_data.get('tax'),
+      'totals_discount': line_item_totals_data.get('discount'),
+      'totals_total': line_item_totals_data.get('total'),
+    }
+
+  rows_to_add = []
+  updated_count = 0
+  deleted_count = 0
+  with anvil.server.Transaction():
+    existing_rows = {row['paddle_id']: row for row in transaction_items_table.search(transaction_id=mybizz_transaction_row)}
+
+    for paddle_line_item_id, item_data in desired_items.items():
+      existing_row = existing_rows.pop(paddle_line_item_id, None)
+      if existing_row is None:
+        rows_to_add.append({**item_data, 'created_at_anvil': current_time_anvil, 'updated_at_anvil': current_time_anvil})
+        continue
+      changed_data = {k: v for k, v in item_data.items() if existing_row[k] != v}
+      if changed_data:
+        existing_row.update(**changed_data, updated_at_anvil=current_time_anvil)
+        updated_count += 1
+
+    # Whatever is left no longer appears on the transaction. A skipped line item cannot be
+    # matched to its row, so nothing is deleted rather than risk dropping a live item.
+    if skipped_line_item:
+      if existing_rows:
+        log("WARNING", module_name, function_name, f"Leaving {len(existing_rows)} unmatched transaction item(s) in place because a payload line item had no ID.", log_context)
+    else:
+      for stale_row in existing_rows.values():
+        stale_row.delete()
+        deleted_count += 1
+
+    if rows_to_add:
+      transaction_items_table.add_rows(rows_to_add)
+
+  log("INFO", module_name, function_name, f"Transaction items reconciled. Added: {len(rows_to_add)}, updated: {updated_count}, deleted: {deleted_count}, unchanged: {len(desired_items) - len(rows_to_add) - updated_count}.", log_context)
+
 def _process_subscription(data):
   """
     Processes subscription.created/updated/paused/resumed/canceled webhooks.
@@ -316,6 +498,15 @@ def _process_subscription(data):
     log("INFO", module_name, function_name, "Processing subscription payload.", log_context)
 
   try:
+    subs_table = tables.app_tables.subs
+    subs_row = subs_table.get(paddle_id=paddle_subscription_id)
+
+    # Drop out-of-order events before resolving the plan or any linked rows
+    payload_updated_at = _payload_updated_at(data)
+    if _is_stale_event(subs_row, payload_updated_at):
+      log("INFO", module_name, function_name, "Skipping stale subscription event; a newer update is already stored.", {**log_context, "payload_updated_at": str(payload_updated_at)})
+      return True, "Stale subscription event skipped (newer update already stored)."
+
     # 1. Identify the core MyBizz Plan (items row)
     mybizz_item_row = None
     subscription_group_row = None
@@ -339,7 +530,7 @@ def _process_subscription(data):
         log_context['glt_from_price_custom_data'] = glt_value
 
         if glt_value:
-          mybizz_item_row = tables.app_tables.items.get(glt=glt_value, item_type='subscription_plan')
+          mybizz_item_row = _cached_get('items', glt=glt_value, item_type='subscription_plan')
           if mybizz_item_row:
             log("INFO", module_name, function_name, f"Found MyBizz item row by GLT '{glt_value}'.", log_context)
             subscription_group_row = mybizz_item_row.get('subscription_group_id')
@@ -365,10 +556,7 @@ def _process_subscription(data):
     else:
       log("WARNING", module_name, function_name, "Subscription webhook payload does not contain 'items' array or it's empty.", log_context)
 
-      # 2. Prepare data for 'subs' table
-      subs_table = tables.app_tables.subs
-    subs_row = subs_table.get(paddle_id=paddle_subscription_id)
-
+    # 2. Prepare data for 'subs' table
     # Map data from Paddle payload to subs table columns
     update_data = {
       'paddle_id': paddle_subscription_id,
@@ -411,17 +599,19 @@ def _process_subscription(data):
     for k, v in update_data.items():
       if k == 'paddle_id': 
         continue
-        if v is not None:
-          final_update_data[k] = v
-        elif k in ['paused_at', 'canceled_at', 'discount_id', 'address_id', 'scheduled_change_action', 'scheduled_change_effective_at', 'scheduled_change_resume_at']: # Fields that can be nulled
-          final_update_data[k] = None
+      if v is not None:
+        final_update_data[k] = v
+      elif k in ['paused_at', 'canceled_at', 'discount_id', 'address_id', 'scheduled_change_action', 'scheduled_change_effective_at', 'scheduled_change_resume_at']: # Fields that can be nulled
+        final_update_data[k] = None
 
 
-      current_time_anvil = datetime.now(timezone.utc)
+    current_time_anvil = datetime.now(timezone.utc)
     if subs_row:
       log("INFO", module_name, function_name, "Updating existing MyBizz subscription.", {**log_context, "mybizz_subs_id": subs_row['subs_id']})
       final_update_data['updated_at_anvil'] = current_time_anvil
-      subs_row.update(**final_update_data)
+      if not _update_row_if_not_stale(subs_table, subs_row, final_update_data, payload_updated_at):
+        log("INFO", module_name, function_name, "Skipping stale subscription event; a newer update was stored concurrently.", log_context)
+        return True, "Stale subscription event skipped (newer update stored concurrently)."
     else:
       log("INFO", module_name, function_name, "Creating new MyBizz subscription.", log_context)
       final_update_data['created_at_anvil'] = current_time_anvil
@@ -431,9 +621,23 @@ def _process_subscription(data):
       if not mybizz_item_row:
         log("ERROR", module_name, function_name, "Cannot create new subscription instance in MyBizz as the corresponding plan definition (item) was not found.", log_context)
         return False, "Cannot create subscription, MyBizz plan definition missing."
-        subs_row = subs_table.add_row(**final_update_data) # Capture the newly created row
+      final_update_data['subs_id'] = generate_id("SUB", paddle_subscription_id[:8])
+      log_context['mybizz_subs_id'] = final_update_data['subs_id']
+      subs_row = subs_table.add_row(**final_update_data) # Capture the newly created row
 
-      log("DEBUG", module_name, function_name, "MyBizz 'subs' table processed.", log_context)
+    log("DEBUG", module_name, function_name, "MyBizz 'subs' table processed.", log_context)
+
+    # Append to subs_state_history when the status changed, for point-in-time reports
+    try:
+      record_subscription_state(
+        subs_row,
+        update_data['status'],
+        update_data['customer_id'] or subs_row['customer_id'],
+        update_data['started_at'],
+        state_changed_at(update_data['status'], update_data, payload_updated_at or current_time_anvil)
+      )
+    except Exception as e_history:
+      log("ERROR", module_name, function_name, "Failed to record subscription state history.", {**log_context, "error": str(e_history)})
 
     # 3. Process subscription line items
     # Pass the MyBizz subs_row (which is now guaranteed to exist)
@@ -461,6 +665,8 @@ def _process_subscription_items(mybizz_subs_row, paddle_line_items_data, parent_
   """
     Processes the 'items' array from a Paddle subscription webhook.
     Creates/updates/inactivates rows in the 'subscription_items' table.
+    Loads the subscription's current items and the referenced prices with one query each,
+    then writes only the rows that actually changed.
 
     Args:
         mybizz_subs_row (anvil.tables.Row): The parent subscription row from MyBizz 'subs' table.
@@ -469,109 +675,94 @@ def _process_subscription_items(mybizz_subs_row, paddle_line_items_data, parent_
     """
   module_name = "webhook_handler"
   function_name = "_process_subscription_items"
+
+  if not mybizz_subs_row: # Should not happen if called correctly
+    log("CRITICAL", module_name, function_name, "Parent MyBizz subscription row (mybizz_subs_row) is missing.", parent_log_context)
+    return False, "Parent MyBizz subscription row missing."
+
   log_context = {**parent_log_context, "mybizz_subs_id": mybizz_subs_row['subs_id']}
 
   if not isinstance(paddle_line_items_data, list):
     log("ERROR", module_name, function_name, "Paddle line items data is not a list.", log_context)
     return False, "Paddle line items data is not a list."
 
-    if not mybizz_subs_row: # Should not happen if called correctly
-      log("CRITICAL", module_name, function_name, "Parent MyBizz subscription row (mybizz_subs_row) is missing.", log_context)
-      return False, "Parent MyBizz subscription row missing."
-
   log("INFO", module_name, function_name, f"Processing {len(paddle_line_items_data)} line item(s) for subscription.", log_context)
 
-  processed_paddle_item_ids = set() # To track Paddle Subscription Line Item IDs (sli_...) from the webhook
-
   try:
     subscription_items_table = tables.app_tables.subscription_items
     current_time_anvil = datetime.now(timezone.utc)
 
-    for paddle_item_data in paddle_line_items_data:
-      item_log_context = {**log_context} # Copy for item-specific logging
+    # One query for every referenced price, one for the subscription's current items
+    price_rows_by_paddle_id = _get_prices_by_paddle_id(
+      paddle_item_data.get('price', {}).get('id') for paddle_item_data in paddle_line_items_data
+    )
+    existing_rows = {row['paddle_id']: row for row in subscription_items_table.search(subscription_id=mybizz_subs_row)}
 
-      paddle_subscription_line_item_id = paddle_item_data.get('id') # This is the sli_...
-      item_log_context['paddle_subscription_line_item_id'] = paddle_subscription_line_item_id
+    rows_to_add = []
+    updated_count = 0
+    inactivated_count = 0
+    processed_paddle_item_ids = set() # Paddle Subscription Line Item IDs (sli_...) present in the webhook
 
-      price_info = paddle_item_data.get('price', {})
-      paddle_price_id = price_info.get('id') # This is the pri_...
-      item_log_context['paddle_price_id'] = paddle_price_id
+    for paddle_item_data in paddle_line_items_data:
+      paddle_subscription_line_item_id = paddle_item_data.get('id') # This is the sli_...
+      paddle_price_id = paddle_item_data.get('price', {}).get('id') # This is the pri_...
+      item_log_context = {**log_context, "paddle_subscription_line_item_id": paddle_subscription_line_item_id, "paddle_price_id": paddle_price_id}
 
       if not paddle_subscription_line_item_id:
         log("WARNING", module_name, function_name, "Skipping subscription line item due to missing Paddle Subscription Line Item ID (sli_...).", item_log_context)
         continue
-        if not paddle_price_id:
-          log("WARNING", module_name, function_name, "Skipping subscription line item due to missing Paddle Price ID (pri_...).", item_log_context)
-          continue
-
-          processed_paddle_item_ids.add(paddle_subscription_line_item_id)
+      processed_paddle_item_ids.add(paddle_subscription_line_item_id)
+      if not paddle_price_id:
+        log("WARNING", module_name, function_name, "Skipping subscription line item due to missing Paddle Price ID (pri_...).", item_log_context)
+        continue
 
-      # Find the corresponding MyBizz 'prices' row
-      mybizz_price_row = tables.app_tables.prices.get(paddle_price_id=paddle_price_id)
+      mybizz_price_row = price_rows_by_paddle_id.get(paddle_price_id)
       if not mybizz_price_row:
         log("ERROR", module_name, function_name, f"MyBizz 'prices' row not found for paddle_price_id '{paddle_price_id}'. Cannot link line item.", item_log_context)
-        # Decide if this should be a partial failure or stop all item processing.
-        # For now, skip this item and continue with others.
         continue
-        item_log_context['mybizz_price_id'] = mybizz_price_row['price_id']
-
-      # Get existing subscription_items row or prepare for new one
-      sub_item_row = subscription_items_table.get(paddle_id=paddle_subscription_line_item_id)
 
       update_data = {
         'paddle_id': paddle_subscription_line_item_id,
         'subscription_id': mybizz_subs_row,
         'price_id': mybizz_price_row,
         'quantity': paddle_item_data.get('quantity'),
-        # 'status': paddle_item_data.get('status'), # Paddle API v1 subscription items don't typically have their own status distinct from the sub.
-        # If Paddle API v2 or specific events provide it, map it here. Default to 'active' or derive.
-        'status': 'active', # Assuming line items are active if the subscription is. Adjust if Paddle provides item-level status.
+        # Paddle subscription items don't carry their own status; they are active while listed on the subscription.
+        'status': 'active',
         'paddle_created_at': _parse_datetime(paddle_item_data.get('created_at')), # Timestamps for the line item itself
         'paddle_updated_at': _parse_datetime(paddle_item_data.get('updated_at')),
         'custom_data': paddle_item_data.get('custom_data'), # Custom data on the subscription line item
-        'proration_billing_mode': paddle_item_data.get('proration', {}).get('billing_mode'), # Example path, adjust to actual Paddle payload
+        'proration_billing_mode': paddle_item_data.get('proration', {}).get('billing_mode'),
         'next_billed_at': _parse_datetime(paddle_item_data.get('next_billed_at')), # If available per line item
       }
+      final_update_data = {k: v for k, v in update_data.items() if v is not None}
+
+      sub_item_row = existing_rows.get(paddle_subscription_line_item_id)
+      if sub_item_row is None:
+        final_update_data['sub_item_id'] = generate_id("SLI", paddle_subscription_line_item_id[:8])
+        final_update_data['created_at_anvil'] = current_time_anvil
+        final_update_data['updated_at_anvil'] = current_time_anvil
+        rows_to_add.append(final_update_data)
+        continue
+
+      changed_data = {k: v for k, v in final_update_data.items() if sub_item_row[k] != v}
+      if changed_data:
+        changed_data['updated_at_anvil'] = current_time_anvil
+        sub_item_row.update(**changed_data)
+        updated_count += 1
 
-      final_update_data = {'paddle_id': paddle_subscription_line_item_id}
-      for k, v in update_data.items():
-        if k == 'paddle_id': 
-          continue
-          if v is not None:
-            final_update_data[k] = v
-
-            if sub_item_row:
-              log("INFO", module_name, function_name, "Updating existing MyBizz subscription line item.", item_log_context)
-              final_update_data['updated_at_anvil'] = current_time_anvil
-              sub_item_row.update(**final_update_data)
-            else:
-              log("INFO", module_name, function_name, "Creating new MyBizz subscription line item.", item_log_context)
-              final_update_data['created_at_anvil'] = current_time_anvil
-              final_update_data['updated_at_anvil'] = current_time_anvil
-              # Generate a unique Anvil ID for sub_item_id
-              timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-              anvil_sub_item_id = f"SLI-{timestamp_str}-{paddle_subscription_line_item_id[:8]}" # Example unique ID
-              # Ensure it's truly unique if high concurrency is expected
-              while subscription_items_table.get(sub_item_id=anvil_sub_item_id):
-                timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f") # Regen
-                anvil_sub_item_id = f"SLI-{timestamp_str}-{paddle_subscription_line_item_id[:8]}"
-
-                final_update_data['sub_item_id'] = anvil_sub_item_id
-              subscription_items_table.add_row(**final_update_data)
-
-      # Reconciliation: Mark local items not in the webhook as 'inactive'
-      existing_db_items = subscription_items_table.search(subscription_id=mybizz_subs_row, status='active') # Only check active ones
-    for db_item in existing_db_items:
-      if db_item['paddle_id'] not in processed_paddle_item_ids:
-        log("INFO", module_name, function_name, "Marking MyBizz subscription line item as inactive (not in webhook).", 
-            {**log_context, "mybizz_sub_item_id": db_item['sub_item_id'], "paddle_subscription_line_item_id": db_item['paddle_id']})
+    # Reconciliation: mark active local items that are no longer on the subscription as 'inactive'
+    for paddle_id, db_item in existing_rows.items():
+      if paddle_id not in processed_paddle_item_ids and db_item['status'] == 'active':
         db_item.update(status='inactive', updated_at_anvil=current_time_anvil)
+        inactivated_count += 1
 
-        log("INFO", module_name, function_name, "Subscription line items processed.", log_context)
+    if rows_to_add:
+      subscription_items_table.add_rows(rows_to_add)
+
+    log("INFO", module_name, function_name, f"Subscription line items processed. Added: {len(rows_to_add)}, updated: {updated_count}, inactivated: {inactivated_count}.", log_context)
     return True, "Subscription items processed successfully."
 
   except Exception as e:
-    import traceback
     error_msg = f"Error processing subscription line items: {str(e)}"
     log("CRITICAL", module_name, function_name, error_msg, {**log_context, "error": str(e), "trace": traceback.format_exc()})
     return False, error_msg
@@ -664,6 +855,7 @@ def _process_product(data):
 
 
         log("INFO", module_name, function_name, f"Updating MyBizz item '{item_row['item_id']}'.", {**log_context, "update_payload": update_data})
+    _invalidate_lookup_cache('items') # Plan lookups by glt may return this row
     item_row.update(**update_data)
 
     log("INFO", module_name, function_name, "Product (item) processed successfully.", log_context)
@@ -698,9 +890,9 @@ def _process_price(data):
   if not paddle_price_id:
     log("ERROR", module_name, function_name, "Missing data.id (paddle_price_id) in price payload.", log_context)
     return False, "Missing paddle_price_id in price payload"
-    if not paddle_product_id_from_price:
-      log("ERROR", module_name, function_name, "Missing data.product_id (parent paddle_product_id) in price payload.", log_context)
-      return False, "Missing parent paddle_product_id in price payload"
+  if not paddle_product_id_from_price:
+    log("ERROR", module_name, function_name, "Missing data.product_id (parent paddle_product_id) in price payload.", log_context)
+    return False, "Missing parent paddle_product_id in price payload"
 
   log("INFO", module_name, function_name, "Processing price payload.", log_context)
 
@@ -712,7 +904,7 @@ def _process_price(data):
       # If the parent product doesn't exist in MyBizz, we can't link this price.
       # This might be a price for a product created directly in Paddle and not known to MyBizz.
       return False, f"Parent item for price '{paddle_price_id}' not found in MyBizz."
-      log_context['mybizz_parent_item_id'] = parent_item_row['item_id']
+    log_context['mybizz_parent_item_id'] = parent_item_row['item_id']
 
     # 2. Find or (optionally) create the MyBizz 'prices' row
     price_row = tables.app_tables.prices.get(paddle_price_id=paddle_price_id)
@@ -759,12 +951,13 @@ def _process_price(data):
       # For now, direct overwrite if present in webhook.
       update_data['custom_data'] = data.get('custom_data')
 
-      # Remove None values unless they are meant to explicitly nullify a field
-      # For price, most fields are defining characteristics.
-      final_update_data = {k: v for k, v in update_data.items() if v is not None}
+    # Remove None values unless they are meant to explicitly nullify a field
+    # For price, most fields are defining characteristics.
+    final_update_data = {k: v for k, v in update_data.items() if v is not None}
     final_update_data['paddle_price_id'] = paddle_price_id # Ensure this is present
     final_update_data['item_id'] = parent_item_row # Ensure link is present
 
+    _invalidate_lookup_cache('prices', paddle_price_id=paddle_price_id)
     if price_row:
       log("INFO", module_name, function_name, f"Updating MyBizz price '{price_row['price_id']}'.", {**log_context, "mybizz_price_id": price_row['price_id']})
       # Ensure all fields from final_update_data are applied
@@ -777,21 +970,17 @@ def _process_price(data):
       final_update_data['created_at_anvil'] = datetime.now(timezone.utc)
 
       # Generate a unique Anvil ID for price_id
-      timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-      anvil_price_id = f"PRC-{timestamp_str}-{paddle_price_id[:8]}"
-      while tables.app_tables.prices.get(price_id=anvil_price_id): # Ensure uniqueness
-        timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-        anvil_price_id = f"PRC-{timestamp_str}-{paddle_price_id[:8]}"
-        final_update_data['price_id'] = anvil_price_id
+      anvil_price_id = generate_id("PRC", paddle_price_id[:8])
+      final_update_data['price_id'] = anvil_price_id
 
       # Ensure all required fields for add_row are present
       if not final_update_data.get('description'): # Description is usually key
         final_update_data['description'] = f"Paddle Price {paddle_price_id}" # Default description
-        if not final_update_data.get('unit_price_amount') or not final_update_data.get('unit_price_currency_code'):
-          log("ERROR", module_name, function_name, "Cannot create new price, unit_price amount or currency_code missing from Paddle payload.", log_context)
-          return False, "Cannot create price, missing unit price details from payload."
+      if not final_update_data.get('unit_price_amount') or not final_update_data.get('unit_price_currency_code'):
+        log("ERROR", module_name, function_name, "Cannot create new price, unit_price amount or currency_code missing from Paddle payload.", log_context)
+        return False, "Cannot create price, missing unit price details from payload."
 
-          tables.app_tables.prices.add_row(**final_update_data)
+      tables.app_tables.prices.add_row(**final_update_data)
       log("INFO", module_name, function_name, f"New MyBizz price '{anvil_price_id}' created.", log_context)
 
       # TODO: Handle price.unit_price_overrides if Paddle sends them in this webhook
@@ -820,7 +1009,7 @@ def _parse_full_name(full_name_str):
   """Helper to attempt parsing first and last name from a full name string."""
   if not full_name_str or not isinstance(full_name_str, str):
     return None, None
-    parts = full_name_str.strip().split(maxsplit=1)
+  parts = full_name_str.strip().split(maxsplit=1)
   first_name = parts[0] if parts else None
   last_name = parts[1] if len(parts) > 1 else None
   return first_name, last_name
@@ -842,7 +1031,7 @@ def _process_customer(data):
     log("ERROR", module_name, function_name, "Missing data.id (paddle_customer_id) in customer payload.", log_context)
     return False, "Missing paddle_customer_id in customer payload"
 
-    log("INFO", module_name, function_name, "Processing customer payload.", log_context)
+  log("INFO", module_name, function_name, "Processing customer payload.", log_context)
 
   try:
     customer_table = tables.app_tables.customer
@@ -873,7 +1062,7 @@ def _process_customer(data):
       except Exception as e_user_mgmt:
         log("ERROR", module_name, function_name, f"Error during Anvil user lookup/creation for email '{email_from_payload}': {str(e_user_mgmt)}", log_context)
 
-        full_name_from_payload = data.get('name')
+    full_name_from_payload = data.get('name')
     first_name_parsed, last_name_parsed = _parse_full_name(full_name_from_payload)
 
     update_data = {
@@ -897,12 +1086,13 @@ def _process_customer(data):
     for k, v in update_data.items():
       if k == 'paddle_id': 
         continue
-        if v is not None:
-          final_update_data[k] = v
-        elif k in nullable_fields:
-          final_update_data[k] = None
+      if v is not None:
+        final_update_data[k] = v
+      elif k in nullable_fields:
+        final_update_data[k] = None
 
-      current_time_anvil = datetime.now(timezone.utc)
+    current_time_anvil = datetime.now(timezone.utc)
+    _invalidate_lookup_cache('customer', paddle_id=paddle_customer_id)
     if customer_row:
       mybizz_customer_id = customer_row['customer_id']
       log_context_update = {**log_context, "mybizz_customer_id": mybizz_customer_id}
@@ -915,12 +1105,8 @@ def _process_customer(data):
       final_update_data['created_at_anvil'] = current_time_anvil
       final_update_data['updated_at_anvil'] = current_time_anvil
 
-      timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-      anvil_customer_id = f"CUS-{timestamp_str}-{paddle_customer_id[:8]}"
-      while tables.app_tables.customer.get(customer_id=anvil_customer_id):
-        timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-        anvil_customer_id = f"CUS-{timestamp_str}-{paddle_customer_id[:8]}"
-        final_update_data['customer_id'] = anvil_customer_id
+      anvil_customer_id = generate_id("CUS", paddle_customer_id[:8])
+      final_update_data['customer_id'] = anvil_customer_id
 
       customer_table.add_row(**final_update_data)
 
@@ -951,7 +1137,7 @@ def _process_discount(data):
     log("ERROR", module_name, function_name, "Missing data.id (paddle_discount_id) in discount payload.", log_context)
     return False, "Missing paddle_discount_id in discount payload"
 
-    log("INFO", module_name, function_name, "Processing discount payload.", log_context)
+  log("INFO", module_name, function_name, "Processing discount payload.", log_context)
 
   try:
     discount_table = tables.app_tables.discount
@@ -1013,8 +1199,8 @@ def _process_discount(data):
       update_data['amount_currency_code'] = data.get('currency_code')
       update_data['amount_rate'] = None
 
-      # Clean update_data
-      final_update_data = {'paddle_id': paddle_discount_id}
+    # Clean update_data
+    final_update_data = {'paddle_id': paddle_discount_id}
     # Define fields that can be legitimately nulled if Paddle sends them as such
     nullable_fields = [
       'description', 'status', 'coupon_code', 'type', 'amount_type', 'amount_rate', 
@@ -1025,12 +1211,12 @@ def _process_discount(data):
     for k, v in update_data.items():
       if k == 'paddle_id': 
         continue
-        if v is not None:
-          final_update_data[k] = v
-        elif k in nullable_fields:
-          final_update_data[k] = None
+      if v is not None:
+        final_update_data[k] = v
+      elif k in nullable_fields:
+        final_update_data[k] = None
 
-      current_time_anvil = datetime.now(timezone.utc)
+    current_time_anvil = datetime.now(timezone.utc)
     if discount_row:
       mybizz_discount_id = discount_row['discount_id']
       log_context_update = {**log_context, "mybizz_discount_id": mybizz_discount_id}
@@ -1043,12 +1229,8 @@ def _process_discount(data):
       final_update_data['created_at_anvil'] = current_time_anvil
       final_update_data['updated_at_anvil'] = current_time_anvil
 
-      timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-      anvil_discount_id = f"DSC-{timestamp_str}-{paddle_discount_id[:8]}"
-      while tables.app_tables.discount.get(discount_id=anvil_discount_id):
-        timestamp_str = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-        anvil_discount_id = f"DSC-{timestamp_str}-{paddle_discount_id[:8]}"
-        final_update_data['discount_id'] = anvil_discount_id
+      anvil_discount_id = generate_id("DSC", paddle_discount_id[:8])
+      final_update_data['discount_id'] = anvil_discount_id
 
       # Ensure essential fields for a new discount are present
       if not final_update_data.get('coupon_code') and not final_update_data.get('description'):
@@ -1056,7 +1238,7 @@ def _process_discount(data):
         # Return False if a code/description is absolutely essential for a new discount record
         # For now, allow creation if Paddle sends it.
 
-        discount_table.add_row(**final_update_data)
+      discount_table.add_row(**final_update_data)
 
       log("INFO", module_name, function_name, "Discount processed successfully.", log_context)
     return True, "Discount processed successfully."
@@ -1087,7 +1269,7 @@ def verify_paddle_signature(request):
     if not signature_header:
       log("WARNING", module_name, function_name, "Missing 'Paddle-Signature' header.", log_context)
       raise anvil.server.HttpError(400, "Missing 'Paddle-Signature' header.")
-      log_context['raw_signature_header'] = signature_header
+    log_context['raw_signature_header'] = signature_header
 
     # 2. Parse Signature Header (Format: "ts=<timestamp>,h1=<signature>")
     parsed_header_parts = {}
@@ -1100,7 +1282,7 @@ def verify_paddle_signature(request):
       log("ERROR", module_name, function_name, "Malformed 'Paddle-Signature' header structure during parsing.", {"header": signature_header, "error": str(ve)})
       raise anvil.server.HttpError(400, "Malformed 'Paddle-Signature' header structure.")
 
-      timestamp_str = parsed_header_parts.get('ts')
+    timestamp_str = parsed_header_parts.get('ts')
     signature_h1 = parsed_header_parts.get('h1')
     log_context['parsed_timestamp_str'] = timestamp_str
     log_context['parsed_signature_h1_present'] = bool(signature_h1)
@@ -1109,12 +1291,12 @@ def verify_paddle_signature(request):
       log("ERROR", module_name, function_name, "Could not parse ts or h1 from Paddle-Signature header.", log_context)
       raise anvil.server.HttpError(400, "Malformed 'Paddle-Signature' header (missing ts or h1).")
 
-      # 3. Retrieve Tenant's Webhook Secret Key from MyBizz Vault
-      secret_key = get_secret_for_server_use(PADDLE_WEBHOOK_SECRET_VAULT_KEY)
+    # 3. Retrieve Tenant's Webhook Secret Key from MyBizz Vault
+    secret_key = get_secret_for_server_use(PADDLE_WEBHOOK_SECRET_VAULT_KEY)
     if not secret_key:
       log("CRITICAL", module_name, function_name, f"Secret key '{PADDLE_WEBHOOK_SECRET_VAULT_KEY}' not found in MyBizz Vault.", log_context)
       raise anvil.server.HttpError(500, "Webhook secret configuration error.")
-      log("DEBUG", module_name, function_name, f"Successfully retrieved '{PADDLE_WEBHOOK_SECRET_VAULT_KEY}' from vault.", log_context)
+    log("DEBUG", module_name, function_name, f"Successfully retrieved '{PADDLE_WEBHOOK_SECRET_VAULT_KEY}' from vault.", log_context)
 
     # 4. Construct Signed Payload (timestamp_string + ":" + raw_request_body_bytes)
     signed_payload_prefix = f"{timestamp_str}:".encode('utf-8')
@@ -1133,7 +1315,7 @@ def verify_paddle_signature(request):
     if not hmac.compare_digest(signature_h1, computed_signature_h1):
       log("WARNING", module_name, function_name, "Invalid webhook signature.", {"received_signature": signature_h1, "computed_signature": computed_signature_h1})
       raise anvil.server.HttpError(403, "Invalid webhook signature.")
-      log("INFO", module_name, function_name, "Webhook signature digest matches.", log_context)
+    log("INFO", module_name, function_name, "Webhook signature digest matches.", log_context)
 
     # 7. Verify Timestamp
     try:
@@ -1147,20 +1329,20 @@ def verify_paddle_signature(request):
       if abs(current_datetime - event_datetime) > WEBHOOK_TIMESTAMP_TOLERANCE:
         log("WARNING", module_name, function_name, "Webhook timestamp outside tolerance window.", log_context)
         raise anvil.server.HttpError(403, "Webhook timestamp outside tolerance window.")
-        log("INFO", module_name, function_name, "Webhook timestamp is within tolerance.", log_context)
+      log("INFO", module_name, function_name, "Webhook timestamp is within tolerance.", log_context)
 
     except ValueError:
       log("ERROR", module_name, function_name, "Invalid timestamp format in Paddle-Signature header (cannot convert to int).", {"timestamp_str": timestamp_str})
       raise anvil.server.HttpError(400, "Invalid timestamp format in signature.")
 
-      log("INFO", module_name, function_name, "Webhook signature and timestamp verified successfully.", log_context)
+    log("INFO", module_name, function_name, "Webhook signature and timestamp verified successfully.", log_context)
     return True
 
   except anvil.server.HttpError as e:
     # Log HttpErrors before re-raising if not already logged with sufficient detail
     if not log_context.get('http_error_logged'): # Avoid double logging if error originated here
       log("ERROR", module_name, function_name, f"HTTPError during signature verification: Status {e.status}, Message: {e.message}", {"http_status": e.status, **log_context})
-      raise e
+    raise e
   except Exception as e:
     import traceback
     log("CRITICAL", module_name, function_name, "Unexpected error during signature verification.", {"error": str(e), "trace": traceback.format_exc(), **log_context})
@@ -1204,13 +1386,196 @@ def _process_report(data):
   return True, "Report event received; no specific MyBizz processing."
 
 
+# --- Shared Processing Path (inline handler and queue worker) ---
+def _dispatch_mybizz_processing(event_type, data_payload):
+  """Routes a webhook's data payload to the matching _process_* function. Returns (success, details)."""
+  if event_type.startswith('transaction.'):
+    return _process_transaction(data_payload)
+  elif event_type.startswith('subscription.'):
+    return _process_subscription(data_payload)
+  return True, f"No specific MyBizz data processing for event type: {event_type}"
+
+def _invalidate_reports_for_event(event_type, log_context):
+  """Drops the cached reports that read the data an event changes. Call after its processing has finished."""
+  if event_type.startswith('transaction.'):
+    invalidate_reports_for('transaction', log_context)
+  elif event_type.startswith('subscription.'):
+    invalidate_reports_for('subscription', log_context)
+
+@lookup_cache_scope
+def _process_received_webhook(log_row, event_type, data_payload, raw_payload_string, log_context, forward_to_hub=True):
+  """
+    Runs MyBizz processing for a webhook already recorded in webhook_log, records the
+    outcome on the log row and queues the payload in the R2Hub outbox (unless forward_to_hub is False).
+    """
+  module_name = "webhook_handler"
+  function_name = "_process_received_webhook"
+
+  processing_success = False
+  processing_details_mybizz = "Event type not handled by MyBizz."
+  try:
+    processing_success, processing_details_mybizz = _dispatch_mybizz_processing(event_type, data_payload)
+
+    with anvil.server.Transaction():
+      log_row_to_update_mybizz = app_tables.webhook_log.get_by_id(log_row.get_id())
+      if log_row_to_update_mybizz:
+        log_row_to_update_mybizz['status'] = 'Processed by MyBizz' if processing_success else 'MyBizz Processing Error'
+        current_details = log_row_to_update_mybizz['processing_details'] or ""
+        separator = " | " if current_details and "Awaiting MyBizz processing" not in current_details else ""
+        if "Awaiting MyBizz processing" in current_details: 
+          current_details = ""
+          separator = ""
+        log_row_to_update_mybizz['processing_details'] = f"{current_details}{separator}MyBizz: {processing_details_mybizz}"
+
+  except Exception as e_mybizz_process:
+    processing_success = False # Ensure this is set
+    processing_details_mybizz = f"Unexpected error during MyBizz data processing: {str(e_mybizz_process)}"
+    log("CRITICAL", module_name, function_name, processing_details_mybizz, {**log_context, "error": str(e_mybizz_process), "trace": traceback.format_exc()})
+    try:
+      with anvil.server.Transaction():
+        log_row_to_update_mybizz_err = app_tables.webhook_log.get_by_id(log_row.get_id())
+        if log_row_to_update_mybizz_err:
+          log_row_to_update_mybizz_err['status'] = 'MyBizz Processing Error'
+    except Exception as db_err_mybizz:
+      log("CRITICAL", module_name, function_name, f"Failed to update log_row with MyBizz processing error: {db_err_mybizz}", log_context)
+  _invalidate_reports_for_event(event_type, log_context) # Even a failed event may have committed some changes
+
+  # Queue the payload for R2Hub forwarding; drain_hub_outbox delivers it in a batch
+  if forward_to_hub and raw_payload_string and log_row and log_row.get_id():
+    try:
+      log("INFO", module_name, function_name, "Queuing payload for R2Hub forwarding.", log_context)
+      with anvil.server.Transaction(): 
+        log_row_to_update_fwd_init = app_tables.webhook_log.get_by_id(log_row.get_id())
+        if log_row_to_update_fwd_init:
+          enqueue_payload_for_hub(log_row_to_update_fwd_init, raw_payload_string)
+          if 'Error' not in (log_row_to_update_fwd_init['status'] or ""): 
+            log_row_to_update_fwd_init['status'] = 'Forwarding Initiated'
+      ensure_hub_outbox_drain(log_context)
+    except Exception as e_bgtask:
+      log("ERROR", module_name, function_name, "Failed to queue payload for R2Hub forwarding.", {**log_context, "error": str(e_bgtask), "trace": traceback.format_exc()})
+
+  return processing_success, processing_details_mybizz
+
+
+# --- Ack-then-Process Webhook Queue ---
+# With the WEBHOOK_ACK_THEN_PROCESS setting on, the handler only verifies the signature,
+# stores the raw payload in webhook_queue and returns 200. process_webhook_queue drains
+# the queue in arrival order in the background.
+ACK_THEN_PROCESS_SETTING_NAME = 'WEBHOOK_ACK_THEN_PROCESS'
+WEBHOOK_QUEUE_BATCH_SIZE = 50
+WEBHOOK_QUEUE_STALE_CLAIM_MINUTES = 30 # 'Processing' rows claimed longer ago than this are assumed abandoned
+WEBHOOK_QUEUE_MAX_CLAIMS = 3 # An entry whose worker died this many times is marked Failed instead of reclaimed
+
+def _is_ack_then_process_enabled():
+  """Checks the app_settings flag that switches the webhook endpoint to ack-then-process mode."""
+  try:
+    setting = app_tables.app_settings.get(setting_name=ACK_THEN_PROCESS_SETTING_NAME)
+    return bool(setting and setting['value_bool'])
+  except Exception as e:
+    print(f"Warning: Could not read '{ACK_THEN_PROCESS_SETTING_NAME}' setting, processing inline: {e}")
+    return False
+
+def _ensure_webhook_queue_worker(log_context):
+  """Launches the queue worker unless one is already running."""
+  try:
+    for task in anvil.server.list_background_tasks():
+      if task.get_task_name() == 'process_webhook_queue' and task.is_running():
+        return
+    anvil.server.launch_background_task('process_webhook_queue')
+  except Exception as e:
+    # The scheduled run of process_webhook_queue will still pick the entry up
+    log("ERROR", "webhook_handler", "_ensure_webhook_queue_worker", "Failed to launch webhook queue worker.", {**log_context, "error": str(e)})
+
+def _claim_queue_entry(queue_row):
+  """
+    Moves a queue entry from Pending (or an abandoned Processing claim) to Processing.
+    started_at records when it was claimed. Returns False if another worker holds it.
+    """
+  now = datetime.now(timezone.utc)
+  stale_cutoff = now - timedelta(minutes=WEBHOOK_QUEUE_STALE_CLAIM_MINUTES)
+  with anvil.server.Transaction():
+    fresh_row = app_tables.webhook_queue.get_by_id(queue_row.get_id())
+    if fresh_row is None:
+      return False
+    is_stale_claim = fresh_row['status'] == 'Processing' and (fresh_row['started_at'] is None or fresh_row['started_at'] < stale_cutoff)
+    if fresh_row['status'] != 'Pending' and not is_stale_claim:
+      return False
+    claims = (fresh_row['claim_count'] or 0) + 1
+    if is_stale_claim and claims > WEBHOOK_QUEUE_MAX_CLAIMS:
+      fresh_row.update(status='Failed', finished_at=now,
+                       last_error=f"Worker stopped without finishing {WEBHOOK_QUEUE_MAX_CLAIMS} times; not reclaimed.")
+      return False
+    fresh_row.update(status='Processing', started_at=now, claim_count=claims)
+    return True
+
+@anvil.server.background_task
+@buffered_logging
+def process_webhook_queue():
+  """
+    Drains webhook_queue oldest-first, running the same processing and forwarding
+    as the inline handler for each entry. Also scheduled to pick up stragglers,
+    including entries left in Processing by a worker that died mid-batch.
+    """
+  module_name = "webhook_handler"
+  function_name = "process_webhook_queue"
+  processed_count = 0
+  failed_count = 0
+  log("INFO", module_name, function_name, "Webhook queue worker started.")
+
+  while True:
+    stale_cutoff = datetime.now(timezone.utc) - timedelta(minutes=WEBHOOK_QUEUE_STALE_CLAIM_MINUTES)
+    pending_rows = list(app_tables.webhook_queue.search(
+      tables.order_by("enqueued_at", ascending=True),
+      q.any_of(
+        q.all_of(status='Processing', started_at=q.less_than(stale_cutoff)),
+        status='Pending'
+      )
+    )[:WEBHOOK_QUEUE_BATCH_SIZE])
+    if not pending_rows:
+      break
+
+    claimed_any = False
+    for queue_row in pending_rows:
+      if not _claim_queue_entry(queue_row):
+        continue
+      claimed_any = True
+      log_row = queue_row['webhook_log']
+      log_context = {"event_id": queue_row['event_id'], "event_type": queue_row['event_type'], "mode": "queue"}
+      try:
+        raw_payload_string = queue_row['raw_payload']
+        data_payload = json.loads(raw_payload_string).get('data', {})
+        log_context['webhook_log_id'] = log_row.get_id()
+        success, details = _process_received_webhook(log_row, queue_row['event_type'], data_payload, raw_payload_string, log_context)
+        queue_row.update(status='Done' if success else 'Failed', finished_at=datetime.now(timezone.utc), last_error=None if success else details[:990])
+      except Exception as e:
+        success = False
+        log("CRITICAL", module_name, function_name, "Unexpected error processing queued webhook.", {**log_context, "error": str(e), "trace": traceback.format_exc()})
+        queue_row.update(status='Failed', finished_at=datetime.now(timezone.utc), last_error=str(e)[:990])
+      if success:
+        processed_count += 1
+      else:
+        failed_count += 1
+    if not claimed_any: # Every candidate was taken by another worker or retired; leave the rest to it
+      break
+
+  log("INFO", module_name, function_name, f"Webhook queue worker finished. Processed: {processed_count}. Failed: {failed_count}.")
+
+
 # --- Main Webhook Handler HTTP Endpoint ---
 @anvil.server.http_endpoint('/_/api/paddle_webhook', methods=['POST'])
+@buffered_logging
 def paddle_webhook_handler(**kwargs):
+  return _handle_paddle_webhook(anvil.server.request)
+
+def _handle_paddle_webhook(request, forward_to_hub=True):
+  """
+    Verifies, records and processes one Paddle webhook request. forward_to_hub=False is for
+    replays (see benchmark_webhook_log_settings_reads): the event is processed inline and is
+    not queued for R2Hub.
+    """
   module_name = "webhook_handler"
   function_name = "paddle_webhook_handler"
 
-  request = anvil.server.request
   raw_payload_bytes = request.body_bytes
   raw_payload_string = "" 
   received_time = datetime.now(timezone.utc)
@@ -1286,79 +1651,55 @@ def paddle_webhook_handler(**kwargs):
         log("CRITICAL", module_name, function_name, "Failed to log missing event_id/type error.", {"db_log_error": str(db_log_err)})
       raise anvil.server.HttpError(400, "Payload missing required fields (event_id or event_type).")
 
-    log_row = app_tables.webhook_log.add_row(
-      event_id=event_id,
-      received_at=received_time,
-      event_type=event_type,
-      resource_id=resource_id or 'N/A', 
-      status='Received', 
-      forwarded_to_hub=False, 
-      processing_details="Webhook received. Awaiting MyBizz processing."
-    )
+    ack_then_process = forward_to_hub and _is_ack_then_process_enabled()
+
+    # Check-and-insert in one transaction so concurrent redeliveries cannot both be taken in
+    with anvil.server.Transaction():
+      is_duplicate_event, log_row = _check_duplicate_event(event_id)
+      resumed_delivery = log_row is not None
+      if resumed_delivery:
+        log_row['processing_details'] = f"{log_row['processing_details'] or ''} | Redelivered after an abandoned delivery; processing now."
+      elif not is_duplicate_event:
+        log_row = app_tables.webhook_log.add_row(
+          event_id=event_id,
+          received_at=received_time,
+          event_type=event_type,
+          resource_id=resource_id or 'N/A', 
+          status='Received', 
+          forwarded_to_hub=False, 
+          processing_details="Webhook received. Awaiting MyBizz processing."
+        )
+      if not is_duplicate_event and ack_then_process:
+        log_row['status'] = 'Queued for Processing'
+        app_tables.webhook_queue.add_row(
+          webhook_log=log_row,
+          event_id=event_id,
+          event_type=event_type,
+          raw_payload=raw_payload_string,
+          status='Pending',
+          enqueued_at=received_time
+        )
+
+    if is_duplicate_event:
+      log("INFO", module_name, function_name, "Duplicate delivery of an already received event_id. Skipping processing and forwarding.", log_context)
+      return anvil.server.HttpResponse(200, "Webhook already received.")
+
     log_context['webhook_log_id'] = log_row.get_id()
-    log("INFO", module_name, function_name, "Initial entry created in webhook_log.", log_context)
+    if resumed_delivery:
+      log("WARNING", module_name, function_name, "Earlier delivery of this event was abandoned at 'Received'; processing this redelivery.", log_context)
+    else:
+      log("INFO", module_name, function_name, "Initial entry created in webhook_log.", log_context)
+    if not resumed_delivery or get_stored_payload(event_id) is None:
+      store_payload(log_row, raw_payload_string) # Local copy for retries, if enabled
 
-    # ... (MyBizz internal data processing logic as before) ...
-    processing_success = False
-    processing_details_mybizz = "Event type not handled by MyBizz."
-    try:
-      # ... (if/elif for event_type and calling _process_... functions) ...
-      if event_type.startswith('transaction.'):
-        processing_success, processing_details_mybizz = _process_transaction(data_payload)
-      elif event_type.startswith('subscription.'):
-        processing_success, processing_details_mybizz = _process_subscription(data_payload)
-        # ... (etc.) ...
-      else:
-        processing_success = True 
-        processing_details_mybizz = f"No specific MyBizz data processing for event type: {event_type}"
+    if ack_then_process:
+      _remember_event_id(event_id)
+      log("INFO", module_name, function_name, "Payload queued for background processing.", log_context)
+      _ensure_webhook_queue_worker(log_context)
+      return anvil.server.HttpResponse(200, "Webhook received.")
 
-      with anvil.server.Transaction():
-        log_row_to_update_mybizz = app_tables.webhook_log.get_by_id(log_row.get_id())
-        if log_row_to_update_mybizz:
-          log_row_to_update_mybizz['status'] = 'Processed by MyBizz' if processing_success else 'MyBizz Processing Error'
-          # ... (update processing_details carefully as before) ...
-          current_details = log_row_to_update_mybizz['processing_details'] or ""
-          separator = " | " if current_details and "Awaiting MyBizz processing" not in current_details else ""
-          if "Awaiting MyBizz processing" in current_details: 
-            current_details = ""
-            separator = ""
-          log_row_to_update_mybizz['processing_details'] = f"{current_details}{separator}MyBizz: {processing_details_mybizz}"
-
-    except Exception as e_mybizz_process:
-      # ... (log critical error and update log_row for MyBizz processing failure as before) ...
-      processing_success = False # Ensure this is set
-      processing_details_mybizz = f"Unexpected error during MyBizz data processing: {str(e_mybizz_process)}"
-      log("CRITICAL", module_name, function_name, processing_details_mybizz, {**log_context, "error": str(e_mybizz_process), "trace": traceback.format_exc()})
-      try:
-        with anvil.server.Transaction():
-          log_row_to_update_mybizz_err = app_tables.webhook_log.get_by_id(log_row.get_id())
-          if log_row_to_update_mybizz_err:
-            log_row_to_update_mybizz_err['status'] = 'MyBizz Processing Error'
-            # ... (update processing_details carefully) ...
-      except Exception as db_err_mybizz:
-        log("CRITICAL", module_name, function_name, f"Failed to update log_row with MyBizz processing error: {db_err_mybizz}", log_context)
-
-
-        # Launch Background Task for R2Hub Forwarding
-    if raw_payload_string and log_row and log_row.get_id():
-      # ... (launch background task and update log_row status to "Forwarding Initiated" as before) ...
-      try:
-        log("INFO", module_name, function_name, "Initiating background task to forward payload to R2Hub.", log_context)
-        anvil.server.launch_background_task(
-          'forward_payload_to_hub_background', 
-          log_row_id=log_row.get_id(),
-          raw_payload_string=raw_payload_string
-        )
-        with anvil.server.Transaction(): 
-          log_row_to_update_fwd_init = app_tables.webhook_log.get_by_id(log_row.get_id())
-          if log_row_to_update_fwd_init:
-            if 'Error' not in (log_row_to_update_fwd_init['status'] or ""): 
-              log_row_to_update_fwd_init['status'] = 'Forwarding Initiated'
-      except Exception as e_bgtask:
-        # ... (log error and update log_row for background task launch failure as before) ...
-        log("ERROR", module_name, function_name, "Failed to launch forwarding background task.", {**log_context, "error": str(e_bgtask), "trace": traceback.format_exc()})
-        # ... (update log_row with failure details) ...
-        # ... (handling for empty raw_payload_string or missing log_row as before) ...
+    _process_received_webhook(log_row, event_type, data_payload, raw_payload_string, log_context, forward_to_hub=forward_to_hub)
+    _remember_event_id(event_id)
 
     log("INFO", module_name, function_name, "Webhook handling complete. Returning 200 OK to Paddle.", log_context)
     return anvil.server.HttpResponse(200, "Webhook received.")
@@ -1373,4 +1714,84 @@ def paddle_webhook_handler(**kwargs):
     final_error_msg = f"Unexpected critical failure processing webhook: {str(e)}"
     log("CRITICAL", module_name, function_name, final_error_msg, {**log_context, "error": str(e), "trace": traceback.format_exc()})
     # ... (attempt to log to webhook_log as before) ...
-    return anvil.server.HttpResponse(500, "Internal Server Error")
\ No newline at end of file
+    return anvil.server.HttpResponse(500, "Internal Server Error")
+
+# --- Benchmark: logging settings reads per webhook ---
+class _ReplayedWebhookRequest:
+  """The parts of anvil.server.request that _handle_paddle_webhook reads, signed like Paddle does."""
+  def __init__(self, body_bytes, secret_key):
+    timestamp_str = str(int(time.time()))
+    signature_h1 = hmac.new(key=secret_key.encode('utf-8'), msg=f"{timestamp_str}:".encode('utf-8') + body_bytes, digestmod=hashlib.sha256).hexdigest()
+    self.body_bytes = body_bytes
+    self.headers = {'paddle-signature': f"ts={timestamp_str},h1={signature_h1}"}
+    self.remote_address = "benchmark-replay"
+
+@anvil.server.callable
+@buffered_logging
+def benchmark_webhook_log_settings_reads():
+  """
+    Replays a signed synthetic webhook through the handler twice: with the logging settings
+    snapshot on, then off (every log() call reading app_settings, as before the snapshot).
+    Returns the app_settings reads each run made. Replays are not forwarded to R2Hub, and
+    their webhook_log and payload store rows are deleted afterwards.
+    """
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Administrator privileges required.")
+  secret_key = get_secret_for_server_use(PADDLE_WEBHOOK_SECRET_VAULT_KEY)
+  if not secret_key:
+    raise Exception(f"Secret key '{PADDLE_WEBHOOK_SECRET_VAULT_KEY}' not found in MyBizz Vault.")
+
+  results = {}
+  event_ids = []
+  try:
+    for mode, use_snapshot in (('snapshot_on', True), ('snapshot_off', False)):
+      event_id = f"evt_logbenchmark_{int(time.time() * 1000)}_{mode}"
+      event_ids.append(event_id)
+      body = json.dumps({
+        "event_id": event_id,
+        "event_type": "payment_method.saved",
+        "occurred_at": datetime.now(timezone.utc).isoformat(),
+        "data": {"id": "paymtd_logbenchmark"}
+      }).encode('utf-8')
+      request = _ReplayedWebhookRequest(body, secret_key)
+      response, reads = measure_log_settings_reads(lambda: _handle_paddle_webhook(request, forward_to_hub=False), use_snapshot=use_snapshot)
+      results[mode] = {"http_status": getattr(response, 'status', None), "settings_reads": reads}
+  finally:
+    for log_row in app_tables.webhook_log.search(event_id=q.any_of(*event_ids)) if event_ids else []:
+      app_tables.webhook_payload_store.search(webhook_log=log_row).delete_all_rows()
+      log_row.delete()
+
+  log("INFO", "webhook_handler", "benchmark_webhook_log_settings_reads", "Logging settings read benchmark completed.", results)
+  return results
+
+# --- Test Function ---
+@anvil.server.callable
+def test_subscription_stale_event_skipped():
+  """
+    Checks the out-of-order guard on subscriptions with a throwaway subs row: a newer event
+    is applied, then an older event arriving afterwards is skipped and leaves the row alone.
+    """
+  if not is_admin_user():
+    raise anvil.server.PermissionDenied("Administrator privileges required.")
+
+  paddle_subscription_id = f"sub_test_stale_{int(datetime.now(timezone.utc).timestamp() * 1000)}"
+  base_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+  newer_time = base_time + timedelta(hours=2)
+  older_time = base_time + timedelta(hours=1)
+  subs_row = app_tables.subs.add_row(paddle_id=paddle_subscription_id, status='active', paddle_updated_at=base_time)
+  try:
+    newer_result = _process_subscription({'id': paddle_subscription_id, 'status': 'paused', 'updated_at': newer_time.isoformat()})
+    older_result = _process_subscription({'id': paddle_subscription_id, 'status': 'active', 'updated_at': older_time.isoformat()})
+    stored_row = app_tables.subs.get(paddle_id=paddle_subscription_id)
+    newer_applied = stored_row['status'] == 'paused' and _as_utc(stored_row['paddle_updated_at']) == newer_time
+    return {
+      "newer_event": newer_result,
+      "older_event": older_result,
+      "newer_event_applied": newer_applied,
+      "older_event_skipped": newer_applied and "Stale" in older_result[1],
+    }
+  finally:
+    for item_row in app_tables.subscription_items.search(subscription_id=subs_row):
+      item_row.delete()
+    app_tables.subs_state_history.search(subscription=subs_row).delete_all_rows()
+    subs_row.delete()